@@ -10,472 +10,361 @@ API Version support: (Get-AzResourceProvider -ProviderNamespace Microsoft.NetApp
 Default: 2020-02-01
 '''
 
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.anf_arm import MIN_POOL_SIZE, TIB, PoolCoordinator, ResultCache, arm_client, fleet_run, lazy_import, min_pool_size, pool_shrink, pool_sizes, pool_state, pool_step, pool_volumes, run_results, token_manager, update_state_file
 import requests
+import concurrent.futures
+import threading
+import hashlib
+import os
 import json
 import time
 import math
+import re
 
+API_VERSION = "2020-02-01"
 
 
-def volume_present(data):
 
-	if data['provider'] == "azure":
-		#get first access to azure api and the correct tenant/subscription
-		api_url = "https://login.microsoftonline.com/"+data['tenant']+"/oauth2/token"
-		body = "grant_type=client_credentials&client_id="+data['client_id']+"&client_secret="+data['secret']+"&resource=https://management.core.windows.net"
-		headers = {
-			'content-type': 'application/x-www-form-urlencoded'
-		}
-		token = requests.get(api_url, data=body, headers=headers)
-		meta = {token.status_code}
-		tokeninfo = token.json()
+#######################################################################################################################################################################################################
+############################## PRESENT ################################################################################################################################################################
 
-		if token.status_code == 200:
 
-			tokeninfo = token.json()
-			
-			if tokeninfo.get('token_type') == "Bearer":
-				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				#~~~~~ create the ANF account ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-				#----- get ANF account to check if existing already -----
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
+THROUGHPUT_PER_TIB = {"standard": 16, "premium": 64, "ultra": 128} # MiB/s per TiB quota with automatic qos
 
-				if httpreturn.status_code == 200:
-					#----- do nothing if already existing! -----
-					has_changed = False
-					is_failed = False
 
-				else:
-					#----- create ANF account -----
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"?api-version=2020-02-01"
-					body_raw = {
-						'location': data['location']
-					}
-					body = json.dumps(body_raw)
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
-
-					if httpreturn.status_code == 200:
-						has_changed = False
-						is_failed = False
+def volsize_raw(volsize):
+	#----- volsize in gb to usageThreshold in bytes -----
+	return (volsize - 1) * 1024 * 1024 * 1024
 
-					elif httpreturn.status_code == 201:
-						#----- check if async process is complete -----
-						checkasyncurl = httpreturn.headers["Azure-AsyncOperation"]
-						api_url = checkasyncurl
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
-
-						while returndata["status"] == "InProgress":
-							time.sleep(10) # ask all x seconds if status changes
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-						
-						#----- check if account is in provitioningState "Succeeded" -----
-						while True:
-							time.sleep(5)
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"?api-version=2020-02-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							if returndata["properties"]["provisioningState"] == "Succeeded":
-								break
-
-						time.sleep(10) # get secure on just waiting another 10s after creation. API sometimes says complete, but its not.
-
-						has_changed = True
-						is_failed = False
 
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.status_code}
-						return (is_failed, has_changed, meta)
+def throughput_volsize(sku, mibps):
+	#----- smallest volsize in gb whose quota delivers mibps at the service level, min. 100 gb -----
+	return max(100, int(math.ceil(mibps * 1024.0 / THROUGHPUT_PER_TIB[sku.lower()])) + 1)
 
 
-				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				#~~~~~ create capacity pool ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				
-				#----- get capacity pool to check if existing already -----
-				lowerpoolsize = 0
-				poolused = 0
-				poolfoundsamesize = 0
-				volumefound = 0
-				volumefoundsamesize = 0
+def throughput_ceiling(sku, volsizeraw):
+	#----- MiB/s a quota of volsizeraw bytes delivers at the service level -----
+	return round(volsizeraw * THROUGHPUT_PER_TIB[sku.lower()] / float(TIB), 1)
 
-				capacitypool = data['sku'].lower()
-				volsizeraw = (data['volsize'] - 1) * 1024 * 1024 * 1024
 
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
+def requested_volumes(data):
+	#----- the volumes list, or the single volname/volsize. volsize is raised to what throughput_mibps needs -----
+	if data.get('volumes'):
+		volumes = [{"volname": volume['volname'], "volsize": volume.get('volsize'), "throughput_mibps": volume.get('throughput_mibps') or data.get('throughput_mibps')} for volume in data['volumes']]
+	else:
+		volumes = [{"volname": data['volname'], "volsize": data.get('volsize'), "throughput_mibps": data.get('throughput_mibps')}]
+	for volume in volumes:
+		if volume["throughput_mibps"] and data['sku'].lower() in THROUGHPUT_PER_TIB:
+			volume["volsize"] = max(volume["volsize"] or 0, throughput_volsize(data['sku'], volume["throughput_mibps"]))
+	return volumes
+
+
+def account_put(client, data):
+	#----- create the ANF account and wait until it is "Succeeded" -----
+	api_url = client.account_url()
+	body_raw = {
+		'location': data['location']
+	}
+	httpreturn = client.put(api_url, body_raw)
+
+	if httpreturn.status_code == 200:
+		return (False, False, {"account exists"})
+
+	elif httpreturn.status_code == 201:
+		#----- wait for the async operation and the account in provisioningState "Succeeded" -----
+		lro_status, returndata = client.wait(httpreturn, api_url)
+		if lro_status != "Succeeded":
+			return (True, False, {"account creation "+lro_status+": "+json.dumps(returndata)})
+		return (False, True, {"account created"})
+
+	return (True, False, {httpreturn.status_code})
+
+
+def volume_put(client, data, capacitypool, volname, volsizeraw, exists):
+	#----- create the volume, or update its size only if it exists. returns the result of this volume -----
+	volresult = {"volname": volname, "size": volsizeraw}
+	exportpath = volname.lower()
+	anfsubnetid = "/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group_net']+"/providers/Microsoft.Network/virtualNetworks/"+data['virtualnetwork']+"/subnets/"+data['subnet']
+	api_url = client.volume_url(capacitypool, volname)
+
+	if exists:
+		#----- update volume size only instead of all parameters! -----
+		body_raw = {
+			'location': data['location'], # - Mandatory
+			'properties': {
+				'creationToken': exportpath, # - Mandatory
+				'subnetId': anfsubnetid, # - Mandatory
+				'usageThreshold': volsizeraw, # - Mandatory
+				'protocolTypes': ['NFSv4.1'],
+				'exportPolicy': {
+					'rules': [
+						{
+							'allowedClients': '0.0.0.0/0',
+							'nfsv3': 'false',
+							'nfsv41': 'true',
+							'ruleIndex': 1,
+							'unixReadOnly': 'false',
+							'unixReadWrite': 'true'
+						}
+					]
 				}
-				httpreturn = requests.get(api_url, headers=headers)
-
-				if httpreturn.status_code == 200:
-					#----- calculate new pool size -----
-					poolsize = 4398046511104
-					poolinfo = httpreturn.json()
-					actualpoolsize = poolinfo["properties"]["size"]
-					
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes?api-version=2020-02-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					volinfo = httpreturn.json()
-					#file = open ("/tmp/testfile.txt","w")
-					#file.write (httpreturn.text)
-
-					for i in volinfo["value"]:
-						poolused = poolused + i["properties"]["usageThreshold"]
-						#file.write (i["name"].split('/')[2])
-						if i["name"].split('/')[2] == data['volname']:
-							volumefound = 1
-							volumeactualsize = i["properties"]["usageThreshold"]
-					poolfreespace = actualpoolsize - poolused
-					#file.close
-
-					if volumefound == 1:
-						if volumeactualsize < volsizeraw:
-							neededadditionalspace = volsizeraw - volumeactualsize
-							if poolfreespace < neededadditionalspace:
-								reallyneeded = neededadditionalspace - poolfreespace
-								poolincrease = int(math.ceil(reallyneeded / 1099511627776.0) * 1099511627776.0)
-								poolsize = actualpoolsize + poolincrease
-							else:
-								poolsize = actualpoolsize
-						elif volumeactualsize > volsizeraw:
-							totalfree = poolfreespace + volumeactualsize - volsizeraw
-							if totalfree >= 1099511627776:
-								pooldecrease = int(math.floor(totalfree / 1099511627776.0) * 1099511627776.0)
-								newpoolsize = actualpoolsize - pooldecrease
-								if newpoolsize <= 4398046511104:
-									lowerpoolsize = 4398046511104
-								else:
-									lowerpoolsize = newpoolsize
-								poolsize = actualpoolsize
-						else:
-							poolfoundsamesize = 1
-							volumefoundsamesize = 1
-					else:
-						if poolfreespace < volsizeraw:
-							poolincrease = int(math.ceil((volsizeraw - poolfreespace) / 1099511627776.0) * 1099511627776.0)
-							poolsize = actualpoolsize + poolincrease
-						else:
-							poolfoundsamesize = 1
+			}
+		}
+		volresult["status"] = "resized"
 
-				else:
-					#----- if capacity pool is not existing, check if volume is larger than 4TB. If so, set vol size. Else set 4TB. -----
-					if volsizeraw <= 4398046511104:
-						poolsize = 4398046511104
-					else:
-						poolsize = volsizeraw
-
-				#----- run only if pool not exist or needs an update -----
-				if poolfoundsamesize == 0:
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-					body_raw = {
-						'location': data['location'],
-						'properties': {
-							'serviceLevel': data['sku'],
-							'size': poolsize
+	else:
+		#----- create volume -----
+		body_raw = {
+			'location': data['location'],
+			'properties': {
+				'serviceLevel': data['sku'],
+				'creationToken': exportpath,
+				'subnetId': anfsubnetid,
+				'usageThreshold': volsizeraw,
+				'protocolTypes': ['NFSv4.1'],
+				'exportPolicy': {
+					'rules': [
+						{
+							'allowedClients': '0.0.0.0/0',
+							'nfsv3': 'false',
+							'nfsv41': 'true',
+							'ruleIndex': 1,
+							'unixReadOnly': 'false',
+							'unixReadWrite': 'true'
 						}
-					}
-					body = json.dumps(body_raw)
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
-
-					if httpreturn.status_code == 200:
-						#----- check for Succeeded status after update -----
-						while True:
-							time.sleep(10)
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							if returndata["properties"]["provisioningState"] == "Succeeded":
-								break
-						
-						time.sleep(10)
-
-						has_changed = True
-						is_failed = False
+					]
+				}
+			}
+		}
+		volresult["status"] = "created"
+
+	try:
+		httpreturn = client.put(api_url, body_raw)
+
+		if httpreturn.status_code in (200, 201, 202):
+			#----- wait for the async operation and the volume in provisioningState "Succeeded", then get vol mount path -----
+			lro_status, returndata = client.wait(httpreturn, api_url)
+			if lro_status == "Failed":
+				volresult["status"] = "failed"
+				volresult["message"] = "Volume creation failed unexpected. Please contact your automation team."
+			elif lro_status == "Timeout":
+				volresult["status"] = "failed"
+				volresult["message"] = "Volume creation did not finish within "+str(data['lro_timeout'])+"s. Please re-run the job!"
+			else:
+				volresult["mountip"] = returndata["properties"]["mountTargets"][0]["ipAddress"]
+		else:
+			volresult["status"] = "failed"
+			volresult["message"] = httpreturn.text
+	except requests.exceptions.RequestException as error:
+		volresult["status"] = "failed"
+		volresult["message"] = str(error)
+
+	return volresult
+
+
+def present_plan(client, data):
+	#----- reads account, pool and its volumes once and returns (is_failed, meta, plan) -----
+	# plan["steps"] is the ordered list of mutations with before/after sizes, apply_plan() runs it without reading again
+	requested = requested_volumes(data)
+	if data['sku'].lower() not in THROUGHPUT_PER_TIB and len([volume for volume in requested if volume["throughput_mibps"]]) != 0:
+		return (True, {"throughput_mibps needs sku "+", ".join(sorted(sku.capitalize() for sku in THROUGHPUT_PER_TIB))+", not "+data['sku']}, None)
+	missing = [volume["volname"] for volume in requested if volume["volsize"] is None]
+	if len(missing) != 0:
+		return (True, {"volsize or throughput_mibps missing for: "+", ".join(missing)}, None)
+
+	capacitypool = data['sku'].lower()
+	plan = {"account": data['accountname'], "pool": capacitypool, "steps": [], "unchanged": {}}
+
+	#----- throughput ceiling of every volume after the run, and what was asked for -----
+	if capacitypool in THROUGHPUT_PER_TIB:
+		plan["throughput"] = {}
+		for volume in requested:
+			plan["throughput"][volume["volname"]] = {"volsize": volume["volsize"], "required_mibps": volume["throughput_mibps"], "ceiling_mibps": throughput_ceiling(data['sku'], volsize_raw(volume["volsize"]))}
+
+	#----- get ANF account to check if existing already, else create it -----
+	api_url = client.account_url()
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code != 200:
+		plan["steps"].append({"action": "create", "type": "account", "name": data['accountname']})
+
+	#----- read pool and all of its volumes once -----
+	actualpoolsize = None
+	volumes = {}
+
+	api_url = client.pool_url(capacitypool)
+	httpreturn = client.get(api_url)
+
+	if httpreturn.status_code == 200:
+		poolinfo = httpreturn.json()
+		actualpoolsize = poolinfo["properties"]["size"]
+
+		is_failed, volumes = pool_volumes(client, capacitypool)
+		if is_failed:
+			return (True, {"volumes of capacity pool "+capacitypool+" could not be read: "+volumes}, None)
+	elif httpreturn.status_code != 404:
+		return (True, {"capacity pool "+capacitypool+" could not be read: "+httpreturn.text}, None)
+
+	#----- one combined pool size for all volumes, resize at most once before and once after -----
+	poolvolumes = dict((volname, i["properties"]["usageThreshold"]) for volname, i in volumes.items())
+	poolsize, lowerpoolsize = pool_sizes(actualpoolsize, poolvolumes, dict((volume["volname"], volsize_raw(volume["volsize"])) for volume in requested))
+
+	if poolsize > 0:
+		plan["steps"].append({"action": "create" if actualpoolsize is None else "resize", "type": "pool", "name": capacitypool, "before": actualpoolsize, "after": poolsize})
+
+	#----- do nothing if already existing and no new size but return vol mount path -----
+	for volume in requested:
+		if poolvolumes.get(volume["volname"]) == volsize_raw(volume["volsize"]):
+			plan["unchanged"][volume["volname"]] = volumes[volume["volname"]]["properties"]["mountTargets"][0]["ipAddress"]
+
+	#----- shrinking volumes first (group 0), so growing ones (group 1) never overbook the pool -----
+	for group in (0, 1):
+		for volume in requested:
+			volname = volume["volname"]
+			volsizeraw = volsize_raw(volume["volsize"])
+			before = poolvolumes.get(volname)
+			if volname in plan["unchanged"]:
+				continue
+			shrinking = before is not None and before > volsizeraw
+			if (group == 0) == shrinking:
+				plan["steps"].append({"action": "create" if before is None else "resize", "type": "volume", "name": volname, "before": before, "after": volsizeraw, "group": group})
+
+	if lowerpoolsize > 0:
+		plan["steps"].append({"action": "resize", "type": "pool", "name": capacitypool, "before": poolsize or actualpoolsize, "after": lowerpoolsize})
+
+	return (False, None, plan)
+
+
+def plan_diff(plan):
+	#----- before/after view of a plan for ansible --diff -----
+	before = {}
+	after = {}
+	for step in plan["steps"]:
+		key = step["type"]+"/"+step["name"]
+		if key not in before:
+			before[key] = step.get("before")
+		after[key] = step.get("after", "present")
+	return {"before": before, "after": after}
+
+
+def apply_plan(client, data, plan):
+	#----- runs the steps of present_plan() in order, volume steps of one group in parallel -----
+	capacitypool = plan["pool"]
+	steps = list(plan["steps"])
+
+	#----- pool lease: register this run's volume sizes, every pool change and a pool check before the first growing volume run under the lease -----
+	coordinator = None
+	if data.get('pool_lease', True) and data.get('cache_dir') and len([step for step in steps if step["type"] != "account"]) != 0:
+		coordinator = PoolCoordinator(data, capacitypool)
+		coordinator.register(dict((step["name"], step["after"]) for step in steps if step["type"] == "volume"))
+		growing = [step for step in steps if step["type"] == "volume" and (step["before"] is None or step["after"] > step["before"])]
+		if len(growing) != 0:
+			first = steps.index(growing[0])
+			if len([step for step in steps[:first] if step["type"] == "pool"]) == 0:
+				steps.insert(first, {"action": "resize", "type": "pool", "name": capacitypool, "before": None, "after": None, "ensure": True})
+	try:
+		return apply_steps(client, data, capacitypool, coordinator, steps)
+	finally:
+		if coordinator is not None:
+			coordinator.release()
+			client.results["pool_coalescing"] = coordinator.stats
+
+
+def apply_steps(client, data, capacitypool, coordinator, steps):
+	has_changed = False
+	volresults = []
+
+	while len(steps) != 0:
+		step = steps.pop(0)
+
+		if step["type"] == "account":
+			is_failed, changed, meta = account_put(client, data)
+			if is_failed:
+				return (is_failed, has_changed, meta, volresults)
+			has_changed = has_changed or changed
+
+		elif step["type"] == "pool":
+			is_failed, changed, meta = pool_step(client, data, coordinator, capacitypool, step)
+			if is_failed:
+				return (is_failed, has_changed, meta, volresults)
+			has_changed = has_changed or changed
 
-					elif httpreturn.status_code == 201:
-						#----- check if async process is complete -----
-						#file = open ("/tmp/testfile.txt","w")
+		else:
+			#----- this and all following volume steps of the same group together -----
+			group = [step]
+			while len(steps) != 0 and steps[0]["type"] == "volume" and steps[0]["group"] == step["group"]:
+				group.append(steps.pop(0))
 
-						checkasyncurl = httpreturn.headers["Azure-AsyncOperation"]
-						#file.write (checkasyncurl)
-						api_url = checkasyncurl
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
-						#file.write (json.dumps( returndata ))
-						#file.write (returndata["status"])
-
-						while returndata["status"] == "InProgress":
-							time.sleep(10) # ask all x seconds if status changes
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							#file.write (json.dumps( returndata ))
-							#file.write (returndata["status"])
-						#file.close
-
-						# #check if pool is in provitioningState "Succeeded" 
-						while True:
-							time.sleep(5)
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							if returndata["properties"]["provisioningState"] == "Succeeded":
-								break
-						
-						time.sleep(10) # get secure on just waiting another 10s after creation. API sometimes says complete, but its not.
+			def put_one(volstep):
+				return volume_put(client, data, capacitypool, volstep["name"], volstep["after"], volstep["before"] is not None)
 
-						has_changed = True
-						is_failed = False
+			with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+				groupresults = list(executor.map(put_one, group))
+			volresults.extend(groupresults)
 
+			if len([volresult for volresult in groupresults if volresult["status"] in ("created", "resized")]) != 0:
+				has_changed = True
+			if len([volresult for volresult in groupresults if volresult["status"] == "failed"]) != 0:
+				return (True, has_changed, None, volresults)
 
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+	return (False, has_changed, None, volresults)
 
-		
-				
-				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				#~~~~~ create volume ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				if volumefoundsamesize == 1:
-					#----- do nothing if already existing and no new size but get vol mount path -----
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					returndata = httpreturn.json()
-					mountip = returndata["properties"]["mountTargets"][0]["ipAddress"]
-
-					has_changed = False
-					is_failed = False
-					meta = {mountip}
-				
-				else:
-					exportpath = data['volname'].lower()
-					anfsubnetid = "/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group_net']+"/providers/Microsoft.Network/virtualNetworks/"+data['virtualnetwork']+"/subnets/"+data['subnet']
-					volsizeraw = (data['volsize'] - 1) * 1024 * 1024 * 1024
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-
-					if volumefound == 1:
-						#----- update volume size only instead of all parameters! -----
-						body_raw = {
-							'location': data['location'], # - Mandatory
-							'properties': {
-								'creationToken': exportpath, # - Mandatory
-								'subnetId': anfsubnetid, # - Mandatory
-								'usageThreshold': volsizeraw, # - Mandatory
-								'protocolTypes': ['NFSv4.1'],
-								'exportPolicy': {
-									'rules': [
-										{
-											'allowedClients': '0.0.0.0/0',
-											'nfsv3': 'false',
-											'nfsv41': 'true',
-											'ruleIndex': 1,
-											'unixReadOnly': 'false',
-											'unixReadWrite': 'true'
-										}
-									]
-								}								
-							}
-						}
-						body = json.dumps(body_raw)
 
-					else:
-						#----- create volume -----
-						body_raw = {
-							'location': data['location'],
-							'properties': {
-								'serviceLevel': data['sku'],
-								'creationToken': exportpath,
-								'subnetId': anfsubnetid,
-								'usageThreshold': volsizeraw,
-								'protocolTypes': ['NFSv4.1'],
-								'exportPolicy': {
-									'rules': [
-										{
-											'allowedClients': '0.0.0.0/0',
-											'nfsv3': 'false',
-											'nfsv41': 'true',
-											'ruleIndex': 1,
-											'unixReadOnly': 'false',
-											'unixReadWrite': 'true'
-										}
-									]
-								}
-							}
-						}
-						body = json.dumps(body_raw)
+def volume_present(data):
 
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
 
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+		if token_status == 200:
 
-					if httpreturn.status_code == 200:
-						#----- get vol mount path -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
-						mountip = returndata["properties"]["mountTargets"][0]["ipAddress"]
+			if tokeninfo.get('token_type') == "Bearer":
 
-						has_changed = True
-						is_failed = False
-						meta = {mountip}
-
-					elif httpreturn.status_code == 201:
-						#----- check if async process is complete -----
-						checkasyncurl = httpreturn.headers["Azure-AsyncOperation"]
-						api_url = checkasyncurl
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
-
-						while returndata["status"] == "InProgress":
-							time.sleep(10) # ask all x seconds if status changes
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
+				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+				#~~~~~ plan: account, capacity pool and volumes, reads only ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-						has_changed = True
-						is_failed = False
+				if data.get('plan'):
+					#----- apply a plan from an earlier check_mode run as it is, but only to the account and pool it was made for -----
+					plan = data['plan']
+					if plan.get("account") != data['accountname'] or plan.get("pool") != data['sku'].lower():
+						return (True, False, {"plan was made for account "+str(plan.get("account"))+" pool "+str(plan.get("pool"))+", not for account "+data['accountname']+" pool "+data['sku'].lower()})
+				else:
+					is_failed, meta, plan = present_plan(client, data)
+					if is_failed:
+						return (is_failed, False, meta)
+				client.results["plan"] = plan
+				client.results["diff"] = plan_diff(plan)
+				if "throughput" in plan:
+					client.results["throughput"] = plan["throughput"]
 
-						while True:
-							time.sleep(10)
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-		#					file.write("Volume Status = "+str(returndata["properties"]["provisioningState"]))
-							if returndata["properties"]["provisioningState"] == "Succeeded":
-								break
-							elif returndata["properties"]["provisioningState"] == "Failed":
-								has_changed = False
-								is_failed = True
-								meta = {"Volume creation failed unexpected. Please contact your automation team."}
-								return (is_failed, has_changed, meta)
-									
-						mountip = returndata["properties"]["mountTargets"][0]["ipAddress"]
-						meta = {mountip}
-									
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+				if data.get('check_mode'):
+					return (False, len(plan["steps"]) != 0, plan["steps"])
 
 				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				#~~~~~ decrease capacity pool if needed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-				if lowerpoolsize > 0:
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-
-					body_raw = {
-						'location': data['location'],
-						'properties': {
-							'serviceLevel': data['sku'],
-							'size': lowerpoolsize
-						}
-					}
-					body = json.dumps(body_raw)
-
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-
-					httpreturn = requests.put(api_url, data=body, headers=headers)
-
-					if httpreturn.status_code == 200:
-
-						while True:
-							time.sleep(5)
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							if returndata["properties"]["provisioningState"] == "Succeeded":
-								break
-						
-						time.sleep(10)
+				#~~~~~ apply: create account, resize pool, create/resize volumes, decrease pool ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-						has_changed = True
-						is_failed = False
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+				is_failed, has_changed, meta, volresults = apply_plan(client, data, plan)
+				if is_failed and meta is not None:
+					return (is_failed, has_changed, meta)
+
+				for volname, mountip in plan["unchanged"].items():
+					volresults.append({"volname": volname, "status": "unchanged", "mountip": mountip})
+
+				failed = [volresult for volresult in volresults if volresult["status"] == "failed"]
+				if data.get('volumes') or len(volresults) > 1:
+					client.results["volumes"] = volresults
+					meta = dict((volresult["volname"], volresult.get("mountip", volresult.get("message"))) for volresult in volresults)
+				elif len(failed) != 0:
+					meta = {failed[0]["message"]}
+				elif len(volresults) != 0:
+					meta = {volresults[0]["mountip"]}
+				else:
+					meta = {"nothing to do"}
+
+				is_failed = len(failed) != 0
 			else:
 				has_changed = False
 				is_failed = True
@@ -483,13 +372,12 @@ def volume_present(data):
 		else:
 			has_changed = False
 			is_failed = True
-			tokeninfo = token.json()
 			meta = {tokeninfo["error_description"]}
 	else:
 		has_changed = False
 		is_failed = True
 		meta = {"Unsupported provider"}
-			
+
 	return (is_failed, has_changed, meta)
 
 
@@ -499,206 +387,319 @@ def volume_present(data):
 
 
 
+def delete_snapshots(client, capacitypool, volname, snapnames, workers):
+	#----- fire all snapshot DELETEs with at most "workers" in flight, then wait for all of them together -----
+	started = time.time()
+
+	def delete_one(snapname):
+		api_url = client.volume_url(capacitypool, volname, "/snapshots/"+snapname)
+		try:
+			httpreturn = client.delete(api_url)
+		except requests.exceptions.RequestException as error:
+			return {"name": snapname, "status": "Failed", "message": str(error)}
+		if httpreturn.status_code in (200, 204):
+			return {"name": snapname, "status": "Succeeded", "seconds": round(time.time() - started, 1)}
+		if httpreturn.status_code != 202:
+			return {"name": snapname, "status": "Failed", "message": httpreturn.text}
+		return {"name": snapname, "status": "Deleting", "api_url": api_url, "httpreturn": httpreturn}
+
+	def wait_one(snapresult):
+		if snapresult["status"] != "Deleting":
+			return snapresult
+		try:
+			lro_status, returndata = client.wait(snapresult.pop("httpreturn"), snapresult.pop("api_url"), deleted=True)
+		except requests.exceptions.RequestException as error:
+			lro_status, returndata = ("Failed", {"message": str(error)})
+		snapresult["status"] = lro_status
+		snapresult["seconds"] = round(time.time() - started, 1)
+		if lro_status != "Succeeded":
+			snapresult["message"] = json.dumps(returndata)
+		return snapresult
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+		snapresults = list(executor.map(delete_one, snapnames))
+		snapresults = list(executor.map(wait_one, snapresults))
+
+	deleted = len([snapresult for snapresult in snapresults if snapresult["status"] == "Succeeded"])
+	return {
+		"total": len(snapresults),
+		"deleted": deleted,
+		"failed": len(snapresults) - deleted,
+		"seconds": round(time.time() - started, 1),
+		"items": snapresults
+	}
+
+
+
+def volume_delete(client, data, capacitypool, volname):
+	#----- delete all snapshots of one volume and the volume itself. returns the result of this volume -----
+	volresult = {"volname": volname}
+
+	#----- check if volume exists -----
+	#GET https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/capacityPools/{poolName}/volumes/{volumeName}?api-version=2020-02-01
+	api_url = client.volume_url(capacitypool, volname)
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code != 200:
+		if "not found" in httpreturn.text:
+			volresult["status"] = "absent"
+		else:
+			volresult["status"] = "failed"
+		volresult["message"] = httpreturn.text
+		return volresult
+
+	#----- list all snapshots of a volume -----
+	api_url = client.volume_url(capacitypool, volname, "/snapshots")
+	httpreturn, snaps = client.list(api_url)
+
+	if httpreturn.status_code != 200:
+		volresult["status"] = "failed"
+		volresult["message"] = httpreturn.text
+		return volresult
+
+	#----- delete snapshots, all in parallel -----
+	snapnames = [snap["name"].split("/")[3] for snap in snaps]
+	if data.get('check_mode'):
+		volresult["status"] = "would delete"
+		volresult["message"] = "would delete volume and "+str(len(snapnames))+" snapshots"
+		return volresult
+	if len(snapnames) != 0:
+		snapresults = delete_snapshots(client, capacitypool, volname, snapnames, data['snapshot_workers'])
+		volresult["snapshots"] = snapresults
+		if snapresults["failed"] != 0:
+			volresult["status"] = "failed" if snapresults["deleted"] == 0 else "partial"
+			volresult["message"] = "snap deletion failed for "+str(snapresults["failed"])+" of "+str(snapresults["total"])+" snapshots"
+			return volresult
+
+	#----- delete volume -----
+	api_url = client.volume_url(capacitypool, volname)
+	httpreturn = client.delete(api_url)
+	if httpreturn.status_code == 202:
+		lro_status, returndata = client.wait(httpreturn, api_url, deleted=True)
+		if lro_status != "Succeeded":
+			volresult["status"] = "partial" if "snapshots" in volresult else "failed"
+			volresult["message"] = "vol deletion "+lro_status+": "+json.dumps(returndata)
+			return volresult
+		volresult["status"] = "deleted"
+		volresult["message"] = "vol deleted async"
+	else:
+		volresult["status"] = "partial" if "snapshots" in volresult else "failed"
+		volresult["message"] = httpreturn.text
+
+	return volresult
+
+
+POLICY_API_VERSION = "2021-10-01" # snapshot and backup policies are not in the module default api version
+
+
+def teardown_node(nodetype, name, api_url, children=()):
+	#----- one resource of the teardown graph. "after": siblings that have to be gone before this one, "uses": policy ids of a volume -----
+	return {"type": nodetype, "name": name, "url": api_url, "children": list(children), "after": [], "uses": set()}
+
+
+def teardown_graph(client, data, scope):
+	#----- everything below the pool (scope "pool") or the account (scope "account") as a tree: account -> pools and policies,
+	# pool -> volumes, volume -> snapshots. a policy comes after the pools whose volumes still use it. returns (httpreturn, root), root None if not found -----
+	api_url = client.account_url() if scope == "account" else client.pool_url(data['sku'].lower())
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code != 200:
+		return (httpreturn, None)
+
+	def volume_node(capacitypool, volume):
+		volname = volume["name"].split('/')[2]
+		api_url = client.volume_url(capacitypool, volname, "/snapshots")
+		snapreturn, snaps = client.list(api_url)
+		snapnodes = [teardown_node("snapshot", snap["name"].split('/')[3], client.volume_url(capacitypool, volname, "/snapshots/"+snap["name"].split('/')[3])) for snap in snaps]
+		volnode = teardown_node("volume", volname, client.volume_url(capacitypool, volname), snapnodes)
+		dataprotection = volume["properties"].get("dataProtection") or {}
+		for kind, key in (("snapshot", "snapshotPolicyId"), ("backup", "backupPolicyId")):
+			if (dataprotection.get(kind) or {}).get(key):
+				volnode["uses"].add(dataprotection[kind][key].lower())
+		return volnode
+
+	def pool_node(capacitypool):
+		api_url = client.pool_url(capacitypool, "/volumes")
+		poolreturn, volinfo = client.list(api_url)
+		volinfo = list(volinfo)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+			volnodes = list(executor.map(lambda volume: volume_node(capacitypool, volume), volinfo))
+		return teardown_node("pool", capacitypool, client.pool_url(capacitypool), volnodes)
+
+	if scope == "pool":
+		return (httpreturn, pool_node(data['sku'].lower()))
+
+	api_url = client.account_url("/capacityPools")
+	poolreturn, pools = client.list(api_url)
+	poolnames = [pool["name"].split('/')[1] for pool in pools]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+		poolnodes = list(executor.map(pool_node, poolnames))
+
+	policynodes = []
+	for collection, nodetype in (("/snapshotPolicies", "snapshot policy"), ("/backupPolicies", "backup policy")):
+		api_url = client.account_url(collection, api_version=POLICY_API_VERSION)
+		policyreturn, policies = client.list(api_url)
+		for policy in policies:
+			policynode = teardown_node(nodetype, policy["name"].split('/')[-1], client.resource_url(policy["id"], api_version=POLICY_API_VERSION))
+			policynode["after"] = [poolnode for poolnode in poolnodes if len([volnode for volnode in poolnode["children"] if policy["id"].lower() in volnode["uses"]]) != 0]
+			policynodes.append(policynode)
+
+	return (httpreturn, teardown_node("account", data['accountname'], client.account_url(), poolnodes + policynodes))
+
+
+def teardown(client, data, node, after=()):
+	#----- delete the children of node concurrently, each subtree on its own, and node itself as soon as all of them are confirmed gone -----
+	# after: futures of siblings this node waits for. returns {type, name, status, seconds, children, message}
+	started = time.time()
+	result = {"type": node["type"], "name": node["name"]}
+	if len([future for future in after if future.result()["status"] not in ("deleted", "absent")]) != 0:
+		result.update({"status": "blocked", "message": "still in use by a resource that was not deleted", "seconds": 0.0})
+		return result
+
+	if len(node["children"]) != 0:
+		#----- independent children first, so a child that waits for a sibling never holds a worker the sibling needs -----
+		futures = {}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['snapshot_workers'] if node["type"] == "volume" else data['volume_workers'])) as executor:
+			for child in sorted(node["children"], key=lambda child: len(child["after"])):
+				futures[id(child)] = executor.submit(teardown, client, data, child, [futures[id(sibling)] for sibling in child["after"]])
+			result["children"] = [futures[id(child)].result() for child in node["children"]]
+		left = [childresult for childresult in result["children"] if childresult["status"] not in ("deleted", "absent")]
+		if len(left) != 0:
+			result.update({"status": "blocked", "message": str(len(left))+" of "+str(len(result["children"]))+" nested resources not deleted", "seconds": round(time.time() - started, 1)})
+			return result
+
+	try:
+		httpreturn = client.delete(node["url"])
+		if httpreturn.status_code == 202:
+			lro_status, returndata = client.wait(httpreturn, node["url"], deleted=True)
+			result["status"] = "deleted" if lro_status == "Succeeded" else "failed"
+			if lro_status != "Succeeded":
+				result["message"] = node["type"]+" deletion "+lro_status+": "+json.dumps(returndata)
+		elif httpreturn.status_code in (200, 204):
+			result["status"] = "deleted"
+		elif httpreturn.status_code == 404:
+			result["status"] = "absent"
+		else:
+			result["status"] = "failed"
+			result["message"] = httpreturn.text
+	except requests.exceptions.RequestException as error:
+		result["status"] = "failed"
+		result["message"] = str(error)
+	result["seconds"] = round(time.time() - started, 1)
+	return result
+
+
+def teardown_counts(result, counts=None):
+	#----- {status: {type: count}} over a teardown result or graph -----
+	counts = counts if counts is not None else {}
+	status = result.get("status", "would delete")
+	counts.setdefault(status, {})[result["type"]] = counts.get(status, {}).get(result["type"], 0) + 1
+	for child in result.get("children", []):
+		if isinstance(child, dict) and "type" in child:
+			teardown_counts(child, counts)
+	return counts
+
+
+def volume_teardown(client, data):
+	#----- state absent with teardown pool/account: the whole pool or account in one run -----
+	scope = data['teardown']
+	started = time.time()
+	httpreturn, root = teardown_graph(client, data, scope)
+	if root is None:
+		if httpreturn.status_code == 404:
+			return (False, False, {scope+" not found, nothing to delete"})
+		return (True, False, {httpreturn.text})
+
+	if data.get('check_mode'):
+		client.results["teardown"] = {"scope": scope, "counts": teardown_counts(root)}
+		return (False, True, {"teardown "+scope+": would delete "+", ".join(str(count)+" "+nodetype for nodetype, count in sorted(teardown_counts(root)["would delete"].items()))})
+
+	result = teardown(client, data, root)
+	counts = teardown_counts(result)
+	client.results["teardown"] = {"scope": scope, "seconds": round(time.time() - started, 1), "counts": counts, "tree": result}
+	deleted = sum(counts.get("deleted", {}).values())
+	if result["status"] not in ("deleted", "absent"):
+		return (True, deleted != 0, {"teardown "+scope+" "+result["status"]+": "+result.get("message", "")})
+	return (False, True, {"teardown "+scope+": "+str(deleted)+" resources deleted in "+str(result["seconds"])+"s"})
+
+
 def volume_absent(data=None):
 
 	if data['provider'] == "azure":
 		#get first access to azure api and the correct tenant/subscription
-		api_url = "https://login.microsoftonline.com/"+data['tenant']+"/oauth2/token"
-		body = "grant_type=client_credentials&client_id="+data['client_id']+"&client_secret="+data['secret']+"&resource=https://management.core.windows.net"
-		headers = {
-			'content-type': 'application/x-www-form-urlencoded'
-		}
-		token = requests.get(api_url, data=body, headers=headers)
-		meta = {token.status_code}
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
 
-		if token.status_code == 200:
+		if token_status == 200:
 
-			tokeninfo = token.json()
-			
 			if tokeninfo.get('token_type') == "Bearer":
 
-				capacitypool = data['sku'].lower()
+				#----- whole pool or account: dependency graph, independent subtrees in parallel -----
+				if data.get('teardown', "volume") != "volume":
+					return volume_teardown(client, data)
 
-				#----- check if volume exists -----
-				#GET https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/capacityPools/{poolName}/volumes/{volumeName}?api-version=2020-02-01
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				if httpreturn.status_code == 200:
-					#----- list all snapshots of a volume -----
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots?api-version=2020-02-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					returndata = httpreturn.json()
-
-					if httpreturn.status_code == 200:
-						#----- delete snapshots -----
-						if len(returndata["value"]) != 0:
-							for snap in returndata["value"]:
-								snapname = snap["name"].split("/")[3]
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots/"+snapname+"?api-version=2020-02-01"
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.delete(api_url, headers=headers)
-								#meta = {snap["id"]}
-								if httpreturn.status_code == 200:
-									has_changed = True
-									is_failed = False
-									meta = {"snap deleted"}
-								elif httpreturn.status_code == 202:
-									loopcount = 0
-									loopmax = 12
-									while True:
-										loopcount += 1
-										time.sleep(10)
-										api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots/"+snapname+"?api-version=2020-02-01"
-										headers = {
-											'content-type': 'application/json',
-											'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-										}
-										httpreturn = requests.get(api_url, headers=headers)
-										if httpreturn.status_code != 200:
-											if ("not found" in httpreturn.text) or (loopcount == loopmax):
-												has_changed = True
-												is_failed = False
-												meta = {"snap deleted async"}
-												time.sleep(30)
-												break
-								else:
-									has_changed = False
-									is_failed = True
-									meta = {httpreturn.text}
-									return (is_failed, has_changed, meta)
-
-						#----- delete volume -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.delete(api_url, headers=headers)
-						if httpreturn.status_code == 202:
-							loopcount = 0
-							loopmax = 12
-							while True:
-								loopcount += 1
-								time.sleep(10)
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.get(api_url, headers=headers)
-								if httpreturn.status_code != 200:
-									if ("not found" in httpreturn.text) or (loopcount == loopmax):
-										has_changed = True
-										is_failed = False
-										meta = {"vol deleted async"}
-										time.sleep(60)
-										break
-						else:
-							has_changed = False
-							is_failed = True
-							meta = {httpreturn.text}
-							return (is_failed, has_changed, meta)
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+				capacitypool = data['sku'].lower()
+				has_changed = False
+				is_failed = False
+
+				#----- delete the volumes with their snapshots, in parallel for a volumes list -----
+				volnames = [volume["volname"] for volume in requested_volumes(data)]
+				if None in volnames:
+					return (True, False, {"state absent needs volname or volumes, or teardown pool/account"})
+				if len(volnames) > 1:
+					pool_volumes(client, capacitypool)
+				with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+					volresults = list(executor.map(lambda volname: volume_delete(client, data, capacitypool, volname), volnames))
+
+				failed = [volresult for volresult in volresults if volresult["status"] in ("failed", "partial")]
+				if len([volresult for volresult in volresults if volresult["status"] in ("deleted", "partial", "would delete")]) != 0:
+					has_changed = True
+
+				if data.get('volumes'):
+					client.results["volumes"] = volresults
+					meta = dict((volresult["volname"], volresult["message"]) for volresult in volresults)
 				else:
-					if "not found" in httpreturn.text:
-						has_changed = False
-						is_failed = False
-						meta = {httpreturn.text}
-		#				return (is_failed, has_changed, meta)
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
-				
+					if "snapshots" in volresults[0]:
+						client.results["snapshots"] = volresults[0]["snapshots"]
+					meta = {volresults[0]["message"]}
+
+				if len(failed) != 0:
+					is_failed = True
+					return (is_failed, has_changed, meta)
+
+				#----- check_mode: pool decrease/deletion and account deletion depend on the deleted volumes, stop here -----
+				if data.get('check_mode'):
+					return (is_failed, has_changed, meta)
+
 				#----- check if more volumes are in pool -----
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				returndata = httpreturn.json()
+				api_url = client.pool_url(capacitypool, "/volumes")
+				httpreturn, volinfo = client.list(api_url)
 
 				if httpreturn.status_code == 200:
-					if len(returndata["value"]) != 0:
+					#----- the remaining volumes are listed once and reused for the pool usage below -----
+					volinfo = list(volinfo)
+					if len(volinfo) != 0:
 						#----- decrease pool size -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2019-06-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
+						api_url = client.pool_url(capacitypool)
+						httpreturn = client.get(api_url)
 
 						if httpreturn.status_code == 200:
 							poolinfo = httpreturn.json()
 							actualpoolsize = poolinfo["properties"]["size"]
-							
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes?api-version=2019-06-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							volinfo = httpreturn.json()
 
 							poolused = 0
-							volumefound = 0
-
-							for i in volinfo["value"]:
+							for i in volinfo:
 								poolused = poolused + i["properties"]["usageThreshold"]
-								if i["name"].split('/')[2] == data['volname']:
-									volumefound = 1
-									volumeactualsize = i["properties"]["usageThreshold"]
-							
-							poolfreespace = actualpoolsize - poolused
-
-							if (poolfreespace > 1099511627776) and (actualpoolsize > 4398046511104):
-								pooldecrease = int(math.floor(poolfreespace / 1099511627776.0) * 1099511627776.0)
-								lowerpoolsize = actualpoolsize - pooldecrease
-								if lowerpoolsize < 4398046511104:
-									lowerpoolsize = 4398046511104
-
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2019-06-01"
-								body_raw = {
-									'location': data['location'],
-									'properties': {
-										'serviceLevel': data['sku'],
-										'size': lowerpoolsize
-									}
-								}
-								body = json.dumps(body_raw)
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.put(api_url, data=body, headers=headers)
-
-								if (httpreturn.status_code == 200) or (httpreturn.status_code == 202):
-									has_changed = True
-									is_failed = False
-									meta = {"capacity pool size decreased"}
-									return (is_failed, has_changed, meta)
-								else:
-									has_changed = False
-									is_failed = True
-									meta = {httpreturn.text}
-									return (is_failed, has_changed, meta)
+
+							#----- whole TiB that are free, under the pool lease: a concurrent present may just have grown the pool -----
+							lowerpoolsize = min_pool_size(poolused)
+							if lowerpoolsize < actualpoolsize:
+								shrink_failed, shrink_changed, shrinkmeta, stats = pool_shrink(client, data, capacitypool, actualpoolsize, lowerpoolsize)
+								if stats is not None:
+									client.results["pool_coalescing"] = stats
+								if shrink_failed:
+									return (True, has_changed, shrinkmeta)
+								if shrink_changed:
+									return (False, True, {"capacity pool size decreased"})
 						else:
 							has_changed = False
 							is_failed = True
@@ -706,31 +707,18 @@ def volume_absent(data=None):
 							return (is_failed, has_changed, meta)	
 					else:
 						#----- delete capacity pool -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.delete(api_url, headers=headers)
+						api_url = client.pool_url(capacitypool)
+						httpreturn = client.delete(api_url)
 						if httpreturn.status_code == 202:
-							loopcount = 0
-							loopmax = 12
-							while True:
-								loopcount += 1
-								time.sleep(10)
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"?api-version=2020-02-01"
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.get(api_url, headers=headers)
-								if httpreturn.status_code != 200:
-									if ("not found" in httpreturn.text) or (loopcount == loopmax):
-										has_changed = True
-										is_failed = False
-										meta = {"pool deleted async"}
-										time.sleep(60)
-										break
+							lro_status, returndata = client.wait(httpreturn, api_url, deleted=True)
+							if lro_status != "Succeeded":
+								has_changed = False
+								is_failed = True
+								meta = {"pool deletion "+lro_status+": "+json.dumps(returndata)}
+								return (is_failed, has_changed, meta)
+							has_changed = True
+							is_failed = False
+							meta = {"pool deleted async"}
 						else:
 							has_changed = False
 							is_failed = True
@@ -749,69 +737,24 @@ def volume_absent(data=None):
 						return (is_failed, has_changed, meta)	
 
 				#----- check if other capacity pools exist in account -----
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				returndata = httpreturn.json()
+				api_url = client.account_url("/capacityPools")
+				httpreturn, pools = client.list(api_url)
 
 				if httpreturn.status_code == 200:
-					if len(returndata["value"]) == 0:
-						#----- get all snapshot policies and delete them -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/snapshotPolicies?api-version=2021-10-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
-
-						for policy in returndata["value"]:
-							#DELETE https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/snapshotPolicies/{snapshotPolicyName}?api-version=2021-10-01
-							api_url = "https://management.azure.com/"+policy["id"]+"?api-version=2021-10-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.delete(api_url, headers=headers)
-							time.sleep(10)
-						
-						# additional wait for the next step to ensure not running into "still nested ressources"
-						time.sleep(60)
-
-						#----- delete ANF account -----
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"?api-version=2020-02-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.delete(api_url, headers=headers)
-						if httpreturn.status_code == 202:
-							loopcount = 0
-							loopmax = 12
-							while True:
-								loopcount += 1
-								time.sleep(10)
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"?api-version=2020-02-01"
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.get(api_url, headers=headers)
-								if httpreturn.status_code != 200:
-									if ("not found" in httpreturn.text) or (loopcount == loopmax):
-										has_changed = True
-										is_failed = False
-										meta = {"account deleted async"}
-										time.sleep(60)
-										break
-						else:
+					if next(pools, None) is None:
+						#----- last pool is gone: snapshot and backup policies in parallel, the ANF account as soon as they are gone -----
+						httpreturn, root = teardown_graph(client, data, "account")
+						if root is None:
+							return (httpreturn.status_code != 404, has_changed, {httpreturn.text})
+						accountresult = teardown(client, data, root)
+						if accountresult["status"] not in ("deleted", "absent"):
 							has_changed = False
 							is_failed = True
-							meta = {httpreturn.text}
+							meta = {"account deletion "+accountresult["status"]+": "+accountresult.get("message", "")}
 							return (is_failed, has_changed, meta)
+						has_changed = True
+						is_failed = False
+						meta = {"account deleted async"}
 
 					return (is_failed, has_changed, meta)
 				else:
@@ -832,7 +775,6 @@ def volume_absent(data=None):
 		else:
 			has_changed = False
 			is_failed = True
-			tokeninfo = token.json()
 			meta = {tokeninfo["error_description"]}
 	else:
 		has_changed = False
@@ -847,99 +789,369 @@ def volume_absent(data=None):
 
 
 
+METRICS = ("VolumeLogicalSize", "VolumeSnapshotSize")
+_metrics_caches = {}
+_metrics_lock = threading.Lock()
+
+
+def metrics_cache(data):
+	#----- metric results of this run and, for metrics_cache_ttl seconds, of the following tasks. one cache per cache_dir
+	# and ttl, so fleet and batch items with their own settings do not share the one of the first item -----
+	key = (data.get('cache_dir'), data.get('metrics_cache_ttl'))
+	with _metrics_lock:
+		if key not in _metrics_caches:
+			_metrics_caches[key] = ResultCache(data, "metrics", data.get('metrics_cache_ttl'))
+		return _metrics_caches[key]
+
+
+def volume_metrics(client, data, capacitypool, volname, cached=True):
+	#----- latest VolumeLogicalSize / VolumeSnapshotSize of one volume in bytes. returns (status, {metric: bytes} or error text) -----
+	# cached=False always asks azure monitor (watch: every cycle needs the usage of now), the answer still refreshes the cache.
+	# only the last metrics_window minutes at metrics_interval with metrics_aggregation are requested, so the answer
+	# is a handful of points. the newest point that has a value wins.
+	api_url = client.volume_url(capacitypool, volname, "/providers/Microsoft.Insights/metrics", api_version="2018-01-01")+"&metricnames="+",".join(METRICS)
+	aggregation = data.get('metrics_aggregation') or "Maximum"
+	cachekey = api_url+"&interval="+(data.get('metrics_interval') or "PT5M")+"&aggregation="+aggregation+"&window="+str(data.get('metrics_window') or 15)
+
+	metrics = metrics_cache(data).get(cachekey) if cached else None
+	if metrics is not None:
+		return (200, metrics)
+
+	end = time.time()
+	start = end - (data.get('metrics_window') or 15) * 60
+	timespan = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start))+"/"+time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(end))
+	# https://management.azure.com/subscriptions/30655b8f-5095-435e-ba1c-e25d1e997164/resourceGroups/cln01/providers/Microsoft.NetApp/netAppAccounts/cln01/capacityPools/ultra/volumes/cln01sapqcpexe/providers/Microsoft.Insights/metrics?metricnames=VolumeLogicalSize,VolumeSnapshotSize&api-version=2018-01-01"
+	httpreturn = client.get(api_url+"&timespan="+timespan+"&interval="+(data.get('metrics_interval') or "PT5M")+"&aggregation="+aggregation)
+	if httpreturn.status_code != 200:
+		return (httpreturn.status_code, httpreturn.text)
+
+	returndata = httpreturn.json()
+	if len(returndata["value"]) == 0:
+		return (404, httpreturn.text)
+
+	metrics = {}
+	for metric in returndata["value"]:
+		points = metric["timeseries"][0]["data"] if len(metric["timeseries"]) != 0 else []
+		for point in reversed(points):
+			if point.get(aggregation.lower()) is not None:
+				metrics[metric["name"]["value"]] = point[aggregation.lower()]
+				break
+
+	#----- no value in the window is no used space of 0: offline would shrink to 100gb and watch would plan a shrink -----
+	missing = [name for name in METRICS if name not in metrics]
+	if len(missing) != 0:
+		return (404, "no "+", ".join(missing)+" value for volume "+volname+" in the last "+str(data.get('metrics_window') or 15)+" minutes")
+
+	metrics_cache(data).put(cachekey, metrics)
+	return (200, metrics)
+
+
+def volume_used(client, data, capacitypool, volname):
+	#----- used space of one volume incl. snapshots, in gb rounded up to 100gb steps -----
+
+	#----- check if volume exists -----
+	#GET https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/capacityPools/{poolName}/volumes/{volumeName}?api-version=2020-02-01
+	api_url = client.volume_url(capacitypool, volname)
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code == 200:
+		#vol exists, now check used space here
+		metrics_status, metrics = volume_metrics(client, data, capacitypool, volname)
+
+		if metrics_status == 200:
+			has_changed = True
+			is_failed = False
+			vol_used_total = metrics["VolumeLogicalSize"] + metrics["VolumeSnapshotSize"]
+			#TEST for math part below: 
+			#vol_used_total = 266762854400 + 49773813760
+			
+			#vol_used_total = bytes. convert them to gb, set minimum 100gb and round to next 100gb step if required
+			if vol_used_total <= 107374182400:
+				vol_used_total = 100
+			else:
+				vol_used_total = int(math.ceil(vol_used_total / 1024 / 1024 / 1024 / 100.0)) * 100
+			meta = vol_used_total
+		else:
+			has_changed = False
+			is_failed = True
+			meta = metrics
+	else:
+		if "not found" in httpreturn.text:
+			has_changed = False
+			is_failed = False
+			meta = httpreturn.text
+		else:
+			has_changed = False
+			is_failed = True
+			meta = httpreturn.text
+
+	return (is_failed, has_changed, meta)
+
+
 def volume_offline(data=None):
 
 	if data['provider'] == "azure":
 		#get first access to azure api and the correct tenant/subscription
-		api_url = "https://login.microsoftonline.com/"+data['tenant']+"/oauth2/token"
-		body = "grant_type=client_credentials&client_id="+data['client_id']+"&client_secret="+data['secret']+"&resource=https://management.core.windows.net"
-		headers = {
-			'content-type': 'application/x-www-form-urlencoded'
-		}
-		token = requests.get(api_url, data=body, headers=headers)
-		meta = {token.status_code}
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
 
-		if token.status_code == 200:
+		if token_status == 200:
 
-			tokeninfo = token.json()
-			
 			if tokeninfo.get('token_type') == "Bearer":
 
 				capacitypool = data['sku'].lower()
 
-				#----- check if volume exists -----
-				#GET https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/capacityPools/{poolName}/volumes/{volumeName}?api-version=2020-02-01
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2020-02-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				if httpreturn.status_code == 200:
-					#vol exists, now check used space here
-					# https://management.azure.com/subscriptions/30655b8f-5095-435e-ba1c-e25d1e997164/resourceGroups/cln01/providers/Microsoft.NetApp/netAppAccounts/cln01/capacityPools/ultra/volumes/cln01sapqcpexe/providers/Microsoft.Insights/metrics?metricnames=VolumeLogicalSize,VolumeSnapshotSize&api-version=2018-01-01"
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/providers/Microsoft.Insights/metrics?metricnames=VolumeLogicalSize,VolumeSnapshotSize&api-version=2018-01-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					returndata = httpreturn.json()
-
-					volume_used = 0
-					snap_used = 0
-					vol_used_total = 0
-					if httpreturn.status_code == 200:
-						#loop through result and retun the values
-						if len(returndata["value"]) != 0:
-							for metric in returndata["value"]:
-								#file = open ("/tmp/testfile.txt","w")
-								#file.write (json.dumps( metric ))
-								#file.write (metric["name"]["value"])
-								
-								if metric["name"]["value"] == "VolumeLogicalSize":
-									numofvalues = len(metric["timeseries"][0]["data"])
-									volume_used = metric["timeseries"][0]["data"][numofvalues-1]["average"]
-									#file.write (metric["timeseries"][0]["data"][numofvalues-1]["timeStamp"])
-								if metric["name"]["value"] == "VolumeSnapshotSize":
-									numofvalues = len(metric["timeseries"][0]["data"])
-									snap_used = metric["timeseries"][0]["data"][numofvalues-1]["average"]
-									#file.write (metric["timeseries"][0]["data"][numofvalues-1]["timeStamp"])
-								#file.close
-							has_changed = True
-							is_failed = False
-							vol_used_total = volume_used + snap_used
-							#TEST for math part below: 
-							#vol_used_total = 266762854400 + 49773813760
-							
-							#vol_used_total = bytes. convert them to gb, set minimum 100gb and round to next 100gb step if required
-							if vol_used_total <= 107374182400:
-								vol_used_total = 100
-							else:
-								vol_used_total = int(math.ceil(vol_used_total / 1024 / 1024 / 1024 / 100.0)) * 100
-							meta = {vol_used_total}
-							return (is_failed, has_changed, meta)
-						else:
-							has_changed = False
-							is_failed = True
-							meta = {httpreturn.text}
-							return (is_failed, has_changed, meta)
-					else:
-						has_changed = False
-						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+				#----- used space per volume, in parallel for a volumes list -----
+				volnames = [volume["volname"] for volume in requested_volumes(data)]
+				if len(volnames) > 1:
+					pool_volumes(client, capacitypool)
+				with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+					volresults = list(executor.map(lambda volname: volume_used(client, data, capacitypool, volname), volnames))
+
+				is_failed = len([volresult for volresult in volresults if volresult[0]]) != 0
+				has_changed = len([volresult for volresult in volresults if volresult[1]]) != 0
+
+				if data.get('volumes'):
+					meta = dict((volname, volresult[2]) for volname, volresult in zip(volnames, volresults))
 				else:
+					meta = {volresults[0][2]}
+				return (is_failed, has_changed, meta)
+			else:
+				has_changed = False
+				is_failed = True
+				meta = {"Failed to get access token to azure! please check your credentials!"}
+		else:
+			has_changed = False
+			is_failed = True
+			meta = {tokeninfo["error_description"]}
+	else:
+		has_changed = False
+		is_failed = True
+		meta = {"Unsupported provider"}
+		return (is_failed, has_changed, meta)
+
+
+
+#######################################################################################################################################################################################################
+############################## COMPACT ################################################################################################################################################################
+
+
+
+def pool_compact(client, data, poolinfo):
+	#----- shrink one capacity pool to the sum of its volumes, rounded up to whole TiB. returns the result of this pool -----
+	capacitypool = poolinfo["name"].split('/')[1]
+	actualpoolsize = poolinfo["properties"]["size"]
+	poolresult = {"pool": capacitypool, "size": actualpoolsize}
+
+	#----- all volumes of the pool in one list call -----
+	api_url = client.pool_url(capacitypool, "/volumes")
+	httpreturn, volinfo = client.list(api_url)
+	if httpreturn.status_code != 200:
+		poolresult["status"] = "failed"
+		poolresult["message"] = httpreturn.text
+		return poolresult
+
+	poolused = 0
+	for i in volinfo:
+		poolused = poolused + i["properties"]["usageThreshold"]
+	poolresult["used"] = poolused
+
+	compactsize = min_pool_size(poolused)
+	if compactsize >= actualpoolsize:
+		poolresult["status"] = "unchanged"
+		return poolresult
+
+	if data.get('check_mode'):
+		poolresult["status"] = "would compact"
+		poolresult["saved"] = actualpoolsize - compactsize
+		return poolresult
+
+	#----- one resize straight to the compact size, under the pool lease: a concurrent present may just have grown the pool -----
+	pooldata = dict(data, sku=poolinfo["properties"].get("serviceLevel", data['sku']))
+	is_failed, has_changed, meta, stats = pool_shrink(client, pooldata, capacitypool, actualpoolsize, compactsize)
+	if stats is not None:
+		poolresult["pool_coalescing"] = stats
+	if is_failed:
+		poolresult["status"] = "failed"
+		poolresult["message"] = list(meta)[0]
+		return poolresult
+	if not has_changed:
+		poolresult["status"] = "unchanged"
+		return poolresult
+
+	#----- the size the lease holder settled on, from the run's snapshot of the finished resize -----
+	httpreturn = client.get(client.pool_url(capacitypool))
+	if httpreturn.status_code == 200:
+		poolresult["size"] = httpreturn.json()["properties"]["size"]
+	poolresult["status"] = "compacted"
+	poolresult["saved"] = actualpoolsize - poolresult["size"]
+
+	return poolresult
+
+
+def pool_compaction(data=None):
+
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
+
+		if token_status == 200:
+
+			if tokeninfo.get('token_type') == "Bearer":
+
+				#----- all capacity pools of the account -----
+				api_url = client.account_url("/capacityPools")
+				httpreturn, pools = client.list(api_url)
+
+				if httpreturn.status_code != 200:
 					if "not found" in httpreturn.text:
-						has_changed = False
-						is_failed = False
-						meta = {httpreturn.text}
-		#				return (is_failed, has_changed, meta)
-					else:
-						has_changed = False
+						return (False, False, {httpreturn.text})
+					return (True, False, {httpreturn.text})
+
+				with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+					poolresults = list(executor.map(lambda poolinfo: pool_compact(client, data, poolinfo), pools))
+
+				client.results["pools"] = poolresults
+				is_failed = len([poolresult for poolresult in poolresults if poolresult["status"] == "failed"]) != 0
+				has_changed = len([poolresult for poolresult in poolresults if poolresult["status"] in ("compacted", "would compact")]) != 0
+				meta = dict((poolresult["pool"], poolresult.get("message", poolresult["status"])) for poolresult in poolresults)
+				return (is_failed, has_changed, meta)
+			else:
+				has_changed = False
+				is_failed = True
+				meta = {"Failed to get access token to azure! please check your credentials!"}
+		else:
+			has_changed = False
+			is_failed = True
+			meta = {tokeninfo["error_description"]}
+	else:
+		has_changed = False
+		is_failed = True
+		meta = {"Unsupported provider"}
+
+	return (is_failed, has_changed, meta)
+
+
+
+#######################################################################################################################################################################################################
+############################## WATCH ##################################################################################################################################################################
+
+
+WATCH_STEP = 100 * 1024 * 1024 * 1024 # volume quotas in 100 GiB steps like state offline
+
+
+def watch_target(used, headroom):
+	#----- quota for used bytes plus headroom percent, rounded up to 100 GiB steps, at least 100 GiB -----
+	return max(WATCH_STEP, int(math.ceil(used * (1 + headroom / 100.0) / WATCH_STEP)) * WATCH_STEP)
+
+
+def watch_decision(data, quota, used, quiet, lastresize, now):
+	#----- ("grow"|"shrink"|None, target quota). grows above watch_grow_at, shrinks below watch_shrink_at in quiet hours only.
+	# both go to the headroom target, which lies between the two thresholds, and a volume rests watch_cooldown seconds after a resize -----
+	if now - lastresize < data['watch_cooldown']:
+		return (None, quota)
+	target = watch_target(used, data['watch_headroom'])
+	utilization = used / float(quota)
+	if utilization >= data['watch_grow_at'] / 100.0 and target > quota:
+		return ("grow", target)
+	if utilization <= data['watch_shrink_at'] / 100.0 and quiet and target < quota:
+		return ("shrink", target)
+	return (None, quota)
+
+
+def watch_cycle(client, data, capacitypool, resizes):
+	#----- one look at all watched volumes, all resizes of the cycle in one plan: at most one pool resize -----
+	is_failed, actualpoolsize, poolvolumes = pool_state(client, capacitypool)
+	if is_failed:
+		return (True, "capacity pool "+capacitypool+" could not be read: "+poolvolumes, [])
+	if actualpoolsize is None:
+		return (True, "capacity pool "+capacitypool+" not found", [])
+	if data.get('volumes'):
+		volnames = [volume["volname"] for volume in data['volumes'] if volume["volname"] in poolvolumes]
+	else:
+		volnames = sorted(poolvolumes)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+		usage = list(executor.map(lambda volname: volume_metrics(client, data, capacitypool, volname, cached=False), volnames))
+
+	now = time.time()
+	quiet = time.gmtime(now).tm_hour in (data.get('watch_quiet_hours') or [])
+	actions = []
+	for volname, (metrics_status, metrics) in zip(volnames, usage):
+		if metrics_status != 200:
+			continue
+		used = metrics["VolumeLogicalSize"] + metrics["VolumeSnapshotSize"]
+		action, target = watch_decision(data, poolvolumes[volname], used, quiet, resizes.get(volname, 0), now)
+		if action is not None:
+			actions.append({"volname": volname, "action": action, "before": poolvolumes[volname], "after": target, "utilization": round(used / float(poolvolumes[volname]), 3)})
+	if len(actions) == 0 or data.get('check_mode'):
+		return (False, None, actions)
+
+	#----- volsize in gb, volsize_raw() turns it back into exactly the target -----
+	cycledata = dict(data, volname=None, volsize=None, plan=None, volumes=[{"volname": action["volname"], "volsize": action["after"] // (1024 * 1024 * 1024) + 1} for action in actions])
+	is_failed, meta, plan = present_plan(client, cycledata)
+	if is_failed:
+		return (is_failed, meta, actions)
+	is_failed, has_changed, meta, volresults = apply_plan(client, cycledata, plan)
+	statuses = dict((volresult["volname"], volresult) for volresult in volresults)
+	for action in actions:
+		volresult = statuses.get(action["volname"], {"status": "failed", "message": meta})
+		action["status"] = volresult["status"]
+		if volresult["status"] != "failed":
+			resizes[action["volname"]] = now
+		else:
+			action["message"] = volresult.get("message")
+	return (len([action for action in actions if action["status"] == "failed"]) != 0, meta, actions)
+
+
+def volume_watch(data=None):
+
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
+
+		if token_status == 200:
+
+			if tokeninfo.get('token_type') == "Bearer":
+
+				if 100.0 / (100 + data['watch_headroom']) >= data['watch_grow_at'] / 100.0 or 100.0 / (100 + data['watch_headroom']) <= data['watch_shrink_at'] / 100.0:
+					return (True, False, {"watch_headroom must put a resized volume between watch_shrink_at and watch_grow_at"})
+
+				capacitypool = data['sku'].lower()
+				#----- last resize per volume, shared with following watch tasks through cache_dir -----
+				statefile = os.path.join(os.path.expanduser(data['cache_dir']), "watch-"+hashlib.sha256((data['subscription_id']+"/"+data['resource_group']+"/"+data['accountname']+"/"+capacitypool).encode("utf-8")).hexdigest()[:32]+".json") if data.get('cache_dir') else None
+				resizes = {}
+				if statefile is not None:
+					resizes = update_state_file(statefile, lambda state, now: dict(state), {})
+
+				cycle = 0
+				actions = []
+				is_failed = False
+				while True:
+					cycle = cycle + 1
+					cycle_failed, cycle_meta, cycle_actions = watch_cycle(client, data, capacitypool, resizes)
+					for action in cycle_actions:
+						action["cycle"] = cycle
+					actions.extend(cycle_actions)
+					if statefile is not None and not data.get('check_mode'):
+						update_state_file(statefile, lambda state, now: state.update(resizes), {})
+					if cycle_failed:
 						is_failed = True
-						meta = {httpreturn.text}
-						return (is_failed, has_changed, meta)
+						meta = {cycle_meta} if isinstance(cycle_meta, str) else cycle_meta
+						break
+					if data['watch_cycles'] != 0 and cycle >= data['watch_cycles']:
+						break
+					time.sleep(data['watch_interval'])
+
+				client.results["watch"] = {"cycles": cycle, "actions": actions}
+				done = [action for action in actions if action.get("status", "planned") != "failed"]
+				has_changed = not data.get('check_mode') and len(done) != 0
+				if not is_failed:
+					meta = {"cycles": cycle, "grown": len([action for action in done if action["action"] == "grow"]), "shrunk": len([action for action in done if action["action"] == "shrink"])}
 			else:
 				has_changed = False
 				is_failed = True
@@ -947,13 +1159,431 @@ def volume_offline(data=None):
 		else:
 			has_changed = False
 			is_failed = True
-			tokeninfo = token.json()
 			meta = {tokeninfo["error_description"]}
 	else:
 		has_changed = False
 		is_failed = True
 		meta = {"Unsupported provider"}
-		return (is_failed, has_changed, meta)
+
+	return (is_failed, has_changed, meta)
+
+
+
+#######################################################################################################################################################################################################
+############################## REPORT #################################################################################################################################################################
+
+
+
+METRICS_ENDPOINT = "https://{location}.metrics.monitor.azure.com"
+METRICS_RESOURCE = "https://metrics.monitor.azure.com"
+METRICS_BATCH_SIZE = 50 # resource ids per metrics:getBatch call
+GIB = 1073741824
+
+
+def metric_history(metricvalues, aggregation):
+	#----- azure monitor "value" list of one resource -> list of used bytes (logical + snapshot) per interval -----
+	series = []
+	for metric in metricvalues:
+		if metric["name"]["value"] not in METRICS or len(metric["timeseries"]) == 0:
+			continue
+		series.append([point.get(aggregation.lower()) for point in metric["timeseries"][0]["data"]])
+	if len(series) == 0:
+		return []
+	length = min(len(points) for points in series)
+	history = []
+	for i in range(length):
+		values = [points[len(points)-length+i] for points in series]
+		history.append(None if None in values else sum(values))
+	return history
+
+
+def history_batch(client, data, resourceids, timespan, aggregation):
+	#----- usage history of up to METRICS_BATCH_SIZE volumes in one metrics:getBatch call. returns (status, {id: history}) -----
+	tokens = token_manager(data, client.session, METRICS_RESOURCE)
+	token_status, tokeninfo = tokens.token()
+	if token_status != 200 or tokeninfo.get('token_type') != "Bearer":
+		return (token_status, {})
+
+	starttime, endtime = timespan.split("/")
+	api_url = METRICS_ENDPOINT.replace("{location}", data['location'])+"/subscriptions/"+data['subscription_id']+"/metrics:getBatch?starttime="+starttime+"&endtime="+endtime+"&interval="+data['report_interval']+"&aggregation="+aggregation.lower()+"&metricnamespace=Microsoft.NetApp/netAppAccounts/capacityPools/volumes&metricnames="+",".join(METRICS)+"&api-version=2023-10-01"
+	#----- through the client: rate limit, 429 retries and token renewal like every arm call. a transport error leaves
+	# the chunk to the per volume fallback -----
+	try:
+		httpreturn = client.request("POST", api_url, {"resourceids": resourceids}, tokens=tokens, read=True)
+	except requests.exceptions.RequestException:
+		return (0, {})
+	if httpreturn.status_code != 200:
+		return (httpreturn.status_code, {})
+
+	histories = {}
+	for value in httpreturn.json().get("values", []):
+		histories[value["resourceid"].lower()] = metric_history(value["value"], aggregation)
+	return (200, histories)
+
+
+def history_single(client, data, resourceid, timespan, aggregation):
+	#----- usage history of one volume from the arm metrics endpoint, fallback if getBatch is not reachable -----
+	api_url = client.resource_url(resourceid+"/providers/Microsoft.Insights/metrics", api_version="2018-01-01")+"&metricnames="+",".join(METRICS)+"&timespan="+timespan+"&interval="+data['report_interval']+"&aggregation="+aggregation
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code != 200:
+		return []
+	return metric_history(httpreturn.json().get("value", []), aggregation)
+
+
+def usage_histories(client, data, resourceids):
+	#----- {resource id: history} for all volumes: getBatch in chunks, per volume only for what the batch did not answer -----
+	end = time.time()
+	start = end - data['report_days'] * 86400
+	timespan = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start))+"/"+time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(end))
+	aggregation = data.get('metrics_aggregation') or "Maximum"
+	chunks = [resourceids[i:i+METRICS_BATCH_SIZE] for i in range(0, len(resourceids), METRICS_BATCH_SIZE)]
+
+	histories = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['volume_workers'])) as executor:
+		for batch_status, batch in executor.map(lambda chunk: history_batch(client, data, chunk, timespan, aggregation), chunks):
+			histories.update(batch)
+
+		missing = [resourceid for resourceid in resourceids if resourceid.lower() not in histories]
+		for resourceid, history in zip(missing, executor.map(lambda resourceid: history_single(client, data, resourceid, timespan, aggregation), missing)):
+			histories[resourceid.lower()] = history
+
+	client.results["report_metrics"] = {"batched": len(resourceids) - len(missing), "single": len(missing)}
+	return dict((resourceid, histories.get(resourceid.lower(), [])) for resourceid in resourceids)
+
+
+def usage_matrix(histories):
+	#----- histories padded at the front to one (volumes x intervals) array, missing points are nan -----
+	numpy = lazy_import("numpy")
+	width = max([len(history) for history in histories] + [1])
+	usage = numpy.full((len(histories), width), numpy.nan)
+	for i, history in enumerate(histories):
+		if len(history) != 0:
+			usage[i, width-len(history):] = numpy.array([numpy.nan if value is None else value for value in history], dtype=float)
+	return usage
+
+
+def account_volumes(client):
+	#----- all volumes of all capacity pools of the account. returns (httpreturn, {names, pools, quotas, resourceids, poolsizes, servicelevels}) -----
+	api_url = client.account_url("/capacityPools")
+	httpreturn, poolinfo = client.list(api_url)
+	if httpreturn.status_code != 200:
+		return (httpreturn, None)
+
+	volumes = {"names": [], "pools": [], "quotas": [], "resourceids": [], "poolsizes": {}, "servicelevels": {}}
+	for pool in poolinfo:
+		capacitypool = pool["name"].split('/')[1]
+		volumes["poolsizes"][capacitypool] = pool["properties"]["size"]
+		volumes["servicelevels"][capacitypool] = pool["properties"].get("serviceLevel", capacitypool.capitalize())
+		api_url = client.pool_url(capacitypool, "/volumes")
+		httpreturn, volinfo = client.list(api_url)
+		for i in volinfo:
+			volumes["names"].append(i["name"].split('/')[2])
+			volumes["pools"].append(capacitypool)
+			volumes["quotas"].append(i["properties"]["usageThreshold"])
+			volumes["resourceids"].append(i["id"])
+	return (httpreturn, volumes)
+
+
+def rightsizing(names, pools, quotas, histories, headroom):
+	#----- p50/p95/max usage and recommended quota per volume and the resulting pool sizes, vectorized over the fleet -----
+	numpy = lazy_import("numpy")
+	usage = usage_matrix(histories)
+
+	known = ~numpy.all(numpy.isnan(usage), axis=1)
+	p50 = numpy.zeros(len(histories))
+	p95 = numpy.zeros(len(histories))
+	peak = numpy.zeros(len(histories))
+	if known.any():
+		p50[known] = numpy.nanpercentile(usage[known], 50, axis=1)
+		p95[known] = numpy.nanpercentile(usage[known], 95, axis=1)
+		peak[known] = numpy.nanmax(usage[known], axis=1)
+
+	#----- same rounding as state offline: gb, min. 100 gb, next 100 gb step; volumes without metrics keep their quota -----
+	needed = peak * (1 + headroom / 100.0) / GIB
+	recommended = numpy.maximum(100, numpy.ceil(needed / 100.0) * 100).astype(numpy.int64)
+	quotas = numpy.array(quotas, dtype=numpy.int64)
+	current = (quotas // GIB) + 1
+	recommended = numpy.where(known, recommended, current)
+	recommendedraw = (recommended - 1) * GIB
+
+	#----- pool sizes: sum of recommended quotas per pool, whole TiB, min. 4 TiB -----
+	poolnames = sorted(set(pools))
+	poolindex = numpy.array([poolnames.index(pool) for pool in pools], dtype=numpy.int64)
+	poolused = numpy.bincount(poolindex, weights=recommendedraw, minlength=len(poolnames)) if len(pools) != 0 else numpy.zeros(0)
+	poolcurrent = numpy.bincount(poolindex, weights=quotas, minlength=len(poolnames)) if len(pools) != 0 else numpy.zeros(0)
+	poolsizes = numpy.maximum(MIN_POOL_SIZE, numpy.ceil(poolused / float(TIB)) * TIB).astype(numpy.int64)
+
+	volumerows = []
+	for i, name in enumerate(names):
+		volumerows.append({
+			"pool": pools[i],
+			"volname": name,
+			"quota_gb": int(current[i]),
+			"p50_bytes": int(p50[i]),
+			"p95_bytes": int(p95[i]),
+			"max_bytes": int(peak[i]),
+			"recommended_gb": int(recommended[i]),
+			"metrics": bool(known[i]),
+		})
+	poolrows = []
+	for i, pool in enumerate(poolnames):
+		poolrows.append({
+			"pool": pool,
+			"volumes_bytes": int(poolcurrent[i]),
+			"recommended_volumes_bytes": int(poolused[i]),
+			"recommended_size": int(poolsizes[i]),
+		})
+	return (volumerows, poolrows)
+
+
+def write_report(report, report_file, report_format):
+	#----- report as json, or as csv with one row per volume and the pool sizes in the pool columns -----
+	path = os.path.expanduser(report_file)
+	if report_format == "json":
+		with open(path, "w") as output:
+			json.dump(report, output, indent=2)
+		return
+	import csv
+	pools = dict((poolrow["pool"], poolrow) for poolrow in report["pools"])
+	columns = ["pool", "volname", "quota_gb", "p50_bytes", "p95_bytes", "max_bytes", "recommended_gb", "metrics", "pool_recommended_size"]
+	with open(path, "w") as output:
+		writer = csv.writer(output)
+		writer.writerow(columns)
+		for volumerow in report["volumes"]:
+			writer.writerow([volumerow.get(column, pools[volumerow["pool"]]["recommended_size"]) for column in columns])
+
+
+def volume_report(data=None):
+
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
+
+		if token_status == 200:
+
+			if tokeninfo.get('token_type') == "Bearer":
+
+				if lazy_import("numpy") is None:
+					return (True, False, {"state report needs the python package numpy"})
+
+				#----- all volumes of all capacity pools of the account -----
+				httpreturn, volumes = account_volumes(client)
+				if volumes is None:
+					return (True, False, {httpreturn.text})
+
+				histories = usage_histories(client, data, volumes["resourceids"])
+				volumerows, poolrows = rightsizing(volumes["names"], volumes["pools"], volumes["quotas"], [histories[resourceid] for resourceid in volumes["resourceids"]], data['report_headroom'])
+				report = {"volumes": volumerows, "pools": poolrows}
+				client.results["report"] = report
+
+				if data.get('report_file'):
+					try:
+						write_report(report, data['report_file'], data['report_format'])
+					except (IOError, OSError) as error:
+						return (True, False, {"report file: "+str(error)})
+
+				resize = [volumerow for volumerow in volumerows if volumerow["recommended_gb"] != volumerow["quota_gb"]]
+				meta = {"report: "+str(len(volumerows))+" volumes in "+str(len(poolrows))+" pools, "+str(len(resize))+" with a different recommended size"}
+				return (False, False, meta)
+			else:
+				has_changed = False
+				is_failed = True
+				meta = {"Failed to get access token to azure! please check your credentials!"}
+		else:
+			has_changed = False
+			is_failed = True
+			meta = {tokeninfo["error_description"]}
+	else:
+		has_changed = False
+		is_failed = True
+		meta = {"Unsupported provider"}
+
+	return (is_failed, has_changed, meta)
+
+
+
+#######################################################################################################################################################################################################
+############################## FORECAST ###############################################################################################################################################################
+
+
+
+FORECAST_ITERATIONS = 10 # reweighting rounds of the robust fit
+FORECAST_HUBER = 1.345 # huber tuning constant in units of the residual scale
+
+
+def interval_seconds(interval):
+	#----- iso 8601 duration of the metrics interval (PT5M, PT1H, P1D) -> seconds -----
+	match = re.match(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$", interval.upper())
+	if match is None or not any(match.groups()):
+		return None
+	days, hours, minutes, seconds = [int(value or 0) for value in match.groups()]
+	return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def growth_trend(usage, step_seconds, method):
+	#----- usage (volumes x intervals, nan = gap, last column = now) -> (bytes now, bytes/day) per volume, one weighted least squares for all rows -----
+	# x is in days and 0 at the last interval, so the intercept is the fitted usage of today
+	numpy = lazy_import("numpy")
+	x = (numpy.arange(usage.shape[1]) - (usage.shape[1] - 1)) * step_seconds / 86400.0
+	known = ~numpy.isnan(usage)
+	y = numpy.where(known, usage, 0.0)
+	weights = known.astype(float)
+
+	for iteration in range(FORECAST_ITERATIONS if method == "robust" else 1):
+		total = weights.sum(axis=1)
+		safe = numpy.where(total > 0, total, 1.0)
+		xmean = (weights * x).sum(axis=1) / safe
+		ymean = (weights * y).sum(axis=1) / safe
+		dx = x - xmean[:, None]
+		spread = (weights * dx * dx).sum(axis=1)
+		slope = numpy.where(spread > 0, (weights * dx * (y - ymean[:, None])).sum(axis=1) / numpy.where(spread > 0, spread, 1.0), 0.0)
+		intercept = ymean - slope * xmean
+		if method != "robust":
+			break
+
+		#----- huber weights from the residuals, scale = 1.4826 * median absolute residual per volume -----
+		residual = numpy.abs(y - (intercept[:, None] + slope[:, None] * x))
+		scale = numpy.zeros(usage.shape[0])
+		rows = known.any(axis=1)
+		if rows.any():
+			scale[rows] = 1.4826 * numpy.nanmedian(numpy.where(known, residual, numpy.nan)[rows], axis=1)
+		limit = FORECAST_HUBER * scale[:, None]
+		weights = numpy.where(known, numpy.where((residual <= limit) | (limit == 0), 1.0, limit / numpy.where(residual > 0, residual, 1.0)), 0.0)
+
+	return (intercept, slope)
+
+
+def forecast(names, pools, quotas, poolsizes, histories, step_seconds, days, headroom, method):
+	#----- runout date and the quota that covers the next days per volume, and the pool sizes for all of it, vectorized over the account -----
+	numpy = lazy_import("numpy")
+	usage = usage_matrix(histories)
+	known = (~numpy.isnan(usage)).sum(axis=1) >= 2
+	now, slope = growth_trend(usage, step_seconds, method)
+
+	#----- last measured point, the fit may lag behind a jump -----
+	lastindex = usage.shape[1] - 1 - numpy.argmax(~numpy.isnan(usage[:, ::-1]), axis=1)
+	last = numpy.nan_to_num(usage[numpy.arange(usage.shape[0]), lastindex])
+	quotas = numpy.array(quotas, dtype=numpy.int64)
+	current = numpy.maximum(now, last)
+
+	#----- days until the quota is full: only for growing volumes, 0 if it is already full -----
+	growing = known & (slope > 0)
+	runout = numpy.where(growing, numpy.maximum(0.0, (quotas - current) / numpy.where(growing, slope, 1.0)), numpy.inf)
+
+	#----- quota for the usage in days, never below today: same rounding as state offline, gb, min. 100 gb, next 100 gb step -----
+	future = numpy.maximum(current, now + slope * days)
+	needed = future * (1 + headroom / 100.0) / GIB
+	recommended = numpy.maximum(100, numpy.ceil(needed / 100.0) * 100).astype(numpy.int64)
+	quotagb = (quotas // GIB) + 1
+	recommended = numpy.where(known, recommended, quotagb)
+	grow = recommended > quotagb
+	targetraw = numpy.where(grow, (recommended - 1) * GIB, quotas)
+
+	#----- pool sizes for all grown quotas at once: whole TiB, min. 4 TiB, never below the pool today -----
+	poolnames = sorted(set(pools))
+	poolindex = numpy.array([poolnames.index(pool) for pool in pools], dtype=numpy.int64)
+	poolneeded = numpy.bincount(poolindex, weights=targetraw, minlength=len(poolnames)) if len(pools) != 0 else numpy.zeros(0)
+	poolactual = numpy.array([poolsizes.get(pool, 0) for pool in poolnames], dtype=numpy.int64)
+	pooltarget = numpy.maximum(poolactual, numpy.maximum(MIN_POOL_SIZE, numpy.ceil(poolneeded / float(TIB)) * TIB)).astype(numpy.int64)
+
+	volumerows = []
+	for i, name in enumerate(names):
+		volumerows.append({
+			"pool": pools[i],
+			"volname": name,
+			"quota_gb": int(quotagb[i]),
+			"used_bytes": int(current[i]),
+			"growth_bytes_per_day": int(slope[i]) if known[i] else 0,
+			"days_until_full": None if numpy.isinf(runout[i]) else round(float(runout[i]), 1),
+			"full_on": None if numpy.isinf(runout[i]) or runout[i] > 36500 else time.strftime("%Y-%m-%d", time.gmtime(time.time() + runout[i] * 86400)),
+			"recommended_gb": int(recommended[i]),
+			"grow": bool(grow[i]),
+			"metrics": bool(known[i]),
+		})
+	poolrows = []
+	for i, pool in enumerate(poolnames):
+		poolrows.append({
+			"pool": pool,
+			"size": int(poolactual[i]),
+			"recommended_size": int(pooltarget[i]),
+			"volumes": [{"volname": names[j], "volsize": int(recommended[j])} for j in range(len(names)) if pools[j] == pool and grow[j]],
+		})
+	return (volumerows, poolrows)
+
+
+def volume_forecast(data=None):
+
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
+
+		if token_status == 200:
+
+			if tokeninfo.get('token_type') == "Bearer":
+
+				if lazy_import("numpy") is None:
+					return (True, False, {"state forecast needs the python package numpy"})
+				step_seconds = interval_seconds(data['report_interval'])
+				if not step_seconds:
+					return (True, False, {"report_interval "+data['report_interval']+" is no iso 8601 duration"})
+
+				#----- all volumes of all capacity pools of the account -----
+				httpreturn, volumes = account_volumes(client)
+				if volumes is None:
+					return (True, False, {httpreturn.text})
+
+				histories = usage_histories(client, data, volumes["resourceids"])
+				volumerows, poolrows = forecast(volumes["names"], volumes["pools"], volumes["quotas"], volumes["poolsizes"], [histories[resourceid] for resourceid in volumes["resourceids"]], step_seconds, data['forecast_days'], data['report_headroom'], data['forecast_method'])
+				client.results["forecast"] = {"days": data['forecast_days'], "method": data['forecast_method'], "volumes": volumerows, "pools": poolrows}
+
+				runout = [volumerow for volumerow in volumerows if volumerow["days_until_full"] is not None and volumerow["days_until_full"] <= data['forecast_days']]
+				meta = {"forecast: "+str(len(volumerows))+" volumes, "+str(len(runout))+" full within "+str(data['forecast_days'])+" days, "+str(len([volumerow for volumerow in volumerows if volumerow["grow"]]))+" to grow"}
+				if not data.get('forecast_apply') or data.get('check_mode'):
+					return (False, False, meta)
+
+				#----- provisioning: every pool with growing volumes gets one plan, so at most one pool resize per pool -----
+				is_failed = False
+				has_changed = False
+				for poolrow in poolrows:
+					if len(poolrow["volumes"]) == 0:
+						continue
+					#----- state present names the pool after its service level, other pools are only reported -----
+					sku = volumes["servicelevels"][poolrow["pool"]]
+					if sku.lower() != poolrow["pool"]:
+						poolrow["status"] = "skipped"
+						continue
+					pooldata = dict(data, sku=sku, volname=None, volsize=None, plan=None, volumes=poolrow["volumes"])
+					plan_failed, planmeta, plan = present_plan(client, pooldata)
+					if plan_failed:
+						poolrow["status"] = "failed"
+						poolrow["message"] = planmeta
+						is_failed = True
+						continue
+					pool_failed, pool_changed, poolmeta, volresults = apply_plan(client, pooldata, plan)
+					poolrow["status"] = "failed" if pool_failed else ("changed" if pool_changed else "ok")
+					if pool_failed:
+						poolrow["message"] = poolmeta
+					is_failed = is_failed or pool_failed
+					has_changed = has_changed or pool_changed
+				return (is_failed, has_changed, meta)
+			else:
+				has_changed = False
+				is_failed = True
+				meta = {"Failed to get access token to azure! please check your credentials!"}
+		else:
+			has_changed = False
+			is_failed = True
+			meta = {tokeninfo["error_description"]}
+	else:
+		has_changed = False
+		is_failed = True
+		meta = {"Unsupported provider"}
+
+	return (is_failed, has_changed, meta)
 
 
 
@@ -994,25 +1624,230 @@ def main():
 			"default": "Standard",
 			"type": "str"
 		},
-		"volname": {"required": True, "type": "str"},
-		"volsize": {"required": True, "type": "int"},
+		"volname": {"required": False, "type": "str"},
+		"volsize": {"required": False, "type": "int"},
+		"volumes": {
+			"required": False,
+			"type": "list",
+			"elements": "dict",
+			"options": {
+				"volname": {"required": True, "type": "str"},
+				"volsize": {"required": False, "type": "int"},
+				"throughput_mibps": {"required": False, "type": "float"}
+			}
+		},
+		"throughput_mibps": {"required": False, "type": "float"},
 		"state": {
 			"required": False, 
 			"default": "present",
-			"choices": ["present", "absent", "offline"],
+			"choices": ["present", "absent", "offline", "compact", "report", "watch", "forecast"],
+			"type": "str"
+		},
+		"teardown": {
+			"required": False,
+			"default": "volume",
+			"choices": ["volume", "pool", "account"],
+			"type": "str"
+		},
+		"volume_workers": {
+			"required": False,
+			"default": 8,
+			"type": "int"
+		},
+		"snapshot_workers": {
+			"required": False,
+			"default": 8,
+			"type": "int"
+		},
+		"lro_timeout": {
+			"required": False,
+			"default": 1800,
+			"type": "int"
+		},
+		"http_pool_size": {
+			"required": False,
+			"default": 10,
+			"type": "int"
+		},
+		"token_cache": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"etag_cache": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"rate_limit": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"max_retries": {
+			"required": False,
+			"default": 5,
+			"type": "int"
+		},
+		"cache_dir": {
+			"required": False,
+			"default": "~/.ansible/anf_cache",
+			"type": "str"
+		},
+		"plan": {"required": False, "type": "dict"},
+		"pool_lease": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"pool_coalesce_window": {
+			"required": False,
+			"default": 0,
+			"type": "int"
+		},
+		"metrics_window": {
+			"required": False,
+			"default": 15,
+			"type": "int"
+		},
+		"metrics_interval": {
+			"required": False,
+			"default": "PT5M",
+			"type": "str"
+		},
+		"metrics_aggregation": {
+			"required": False,
+			"default": "Maximum",
+			"choices": ["Average", "Maximum", "Minimum"],
+			"type": "str"
+		},
+		"report_days": {
+			"required": False,
+			"default": 7,
+			"type": "int"
+		},
+		"report_interval": {
+			"required": False,
+			"default": "PT1H",
 			"type": "str"
 		},
+		"report_headroom": {
+			"required": False,
+			"default": 10,
+			"type": "int"
+		},
+		"report_file": {"required": False, "type": "str"},
+		"report_format": {
+			"required": False,
+			"default": "json",
+			"choices": ["json", "csv"],
+			"type": "str"
+		},
+		"forecast_days": {
+			"required": False,
+			"default": 30,
+			"type": "int"
+		},
+		"forecast_method": {
+			"required": False,
+			"default": "robust",
+			"choices": ["linear", "robust"],
+			"type": "str"
+		},
+		"forecast_apply": {
+			"required": False,
+			"default": False,
+			"type": "bool"
+		},
+		"metrics_cache_ttl": {
+			"required": False,
+			"default": 300,
+			"type": "int"
+		},
+		"watch_cycles": {
+			"required": False,
+			"default": 1,
+			"type": "int"
+		},
+		"watch_interval": {
+			"required": False,
+			"default": 300,
+			"type": "int"
+		},
+		"watch_grow_at": {
+			"required": False,
+			"default": 80,
+			"type": "int"
+		},
+		"watch_shrink_at": {
+			"required": False,
+			"default": 50,
+			"type": "int"
+		},
+		"watch_headroom": {
+			"required": False,
+			"default": 30,
+			"type": "int"
+		},
+		"watch_quiet_hours": {
+			"required": False,
+			"default": [],
+			"type": "list",
+			"elements": "int"
+		},
+		"watch_cooldown": {
+			"required": False,
+			"default": 3600,
+			"type": "int"
+		},
+		"timings": {
+			"required": False,
+			"default": False,
+			"type": "bool"
+		},
+		"fleet": {
+			"required": False,
+			"type": "list",
+			"elements": "dict"
+		},
+		"fleet_workers": {
+			"required": False,
+			"default": 32,
+			"type": "int"
+		},
+		"fleet_subscription_limit": {
+			"required": False,
+			"default": 8,
+			"type": "int"
+		},
 	}
 
 	choice_map = {
 		"present": volume_present,
 		"absent": volume_absent,
 		"offline": volume_offline,
+		"compact": pool_compaction,
+		"report": volume_report,
+		"watch": volume_watch,
+		"forecast": volume_forecast,
 	}
 
-	module = AnsibleModule(argument_spec=fields)
-	is_failed, has_changed, result = choice_map.get(module.params["state"])(module.params)
-	module.exit_json(failed=is_failed, changed=has_changed, msg=result)
+	module = AnsibleModule(
+		argument_spec=fields,
+		supports_check_mode=True,
+		required_if=[
+			["state", "present", ["volname", "volumes", "fleet", "plan"], True],
+			["state", "offline", ["volname", "volumes", "fleet"], True]
+		],
+		mutually_exclusive=[["volname", "volumes"]]
+	)
+	#----- check_mode: present returns its plan, absent/compact only report, offline reads anyway -----
+	module.params["check_mode"] = module.check_mode
+	if module.params["fleet"]:
+		is_failed, has_changed, result = fleet_run(module.params, choice_map, exclusive=("present", "absent", "compact", "watch", "forecast"))
+	else:
+		is_failed, has_changed, result = choice_map.get(module.params["state"])(module.params)
+	module.exit_json(failed=is_failed, changed=has_changed, msg=result, **run_results(module.params))
 
 
 
@@ -15,11 +15,148 @@ API Version support: (Get-AzResourceProvider -ProviderNamespace Microsoft.NetApp
 2022-01-01
 '''
 
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.anf_arm import PoolCoordinator, arm_client, fleet_run, pool_sizes, pool_state, pool_step, run_results
 import requests
+import concurrent.futures
+import threading
 import json
 import time
 import datetime
+import calendar
+import bisect
+
+API_VERSION = "2021-10-01"
+
+
+
+#######################################################################################################################################################################################################
+############################## RETENTION ##############################################################################################################################################################
+
+
+RETENTION_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def created_epoch(item):
+	#----- creation time of a snapshot ("created") or backup ("creationDate") in utc epoch seconds, None if missing -----
+	created = item.get("properties", {}).get("created") or item.get("properties", {}).get("creationDate")
+	if not created:
+		return None
+	return calendar.timegm(time.strptime(created[:19], RETENTION_FORMAT))
+
+
+def retention_expired(items, retention_days, now=None):
+	#----- all creation times parsed once into one sorted array, the cutoff found by binary search -----
+	# returns the expired items (older than retention_days) oldest first and the number of items kept
+	dated = sorted((created, item["name"].split('/')[-1], item) for created, item in ((created_epoch(item), item) for item in items) if created is not None)
+	timestamps = [created for created, name, item in dated]
+	cutoff = (now or time.time()) - retention_days * 86400
+	index = bisect.bisect_left(timestamps, cutoff)
+	return ([item for created, name, item in dated[:index]], len(dated) - index)
+
+
+def delete_expired(client, expired, workers):
+	#----- expired = [(collection_url, item)]. fire all DELETEs with at most "workers" in flight, then wait until every one is gone -----
+	started = time.time()
+
+	def delete_one(entry):
+		collection_url, item = entry
+		path, _, query = collection_url.partition("?")
+		name = item["name"].split('/')[-1]
+		api_url = path+"/"+name+"?"+query
+		itemresult = {"name": item["name"], "bytes": item.get("properties", {}).get("size") or 0}
+		try:
+			httpreturn = client.delete(api_url)
+		except requests.exceptions.RequestException as error:
+			return dict(itemresult, status="Failed", message=str(error))
+		if httpreturn.status_code in (200, 204):
+			return dict(itemresult, status="Succeeded", seconds=round(time.time() - started, 1))
+		if httpreturn.status_code != 202:
+			return dict(itemresult, status="Failed", message=httpreturn.text)
+		return dict(itemresult, status="Deleting", api_url=api_url, httpreturn=httpreturn)
+
+	def wait_one(itemresult):
+		if itemresult["status"] != "Deleting":
+			return itemresult
+		try:
+			lro_status, returndata = client.wait(itemresult.pop("httpreturn"), itemresult.pop("api_url"), deleted=True)
+		except requests.exceptions.RequestException as error:
+			lro_status, returndata = ("Failed", {"message": str(error)})
+		itemresult["status"] = lro_status
+		itemresult["seconds"] = round(time.time() - started, 1)
+		if lro_status != "Succeeded":
+			itemresult["message"] = json.dumps(returndata)
+		return itemresult
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+		itemresults = list(executor.map(client.phased(delete_one), expired))
+		itemresults = list(executor.map(client.phased(wait_one), itemresults))
+	return itemresults
+
+
+def retention(client, data, collection_url):
+	#----- delete everything of the collection older than retention_days. returns (is_failed, retention result) -----
+	started = time.time()
+	httpreturn, items = client.list(collection_url)
+	if httpreturn.status_code != 200:
+		return (True, {"message": httpreturn.text})
+
+	expired, kept = retention_expired(items, data['retention_days'])
+	itemresults = delete_expired(client, [(collection_url, item) for item in expired], data['retention_workers'])
+	return retention_result(itemresults, kept, started)
+
+
+def group_retention(client, data, collection_urls):
+	#----- retention of a snapshot group: snapshots of the same name on all members are one set, dated by its newest member -----
+	# a set expires as a whole, so a group never keeps a partial set of a point in time
+	started = time.time()
+
+	def list_one(collection_url):
+		httpreturn, items = client.list(collection_url)
+		return (httpreturn, [(collection_url, item) for item in items])
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(collection_urls), data['retention_workers']))) as executor:
+		listings = list(executor.map(client.phased(list_one), collection_urls))
+	failed = [httpreturn for httpreturn, members in listings if httpreturn.status_code != 200]
+	if len(failed) != 0:
+		return (True, {"message": failed[0].text})
+
+	sets = {}
+	for httpreturn, members in listings:
+		for collection_url, item in members:
+			sets.setdefault(item["name"].split('/')[-1], []).append((collection_url, item))
+	newest = []
+	for name, members in sets.items():
+		dated = [item for collection_url, item in members if created_epoch(item) is not None]
+		if len(dated) != 0:
+			newest.append(dict(max(dated, key=created_epoch), name=name))
+
+	expired, kept = retention_expired(newest, data['retention_days'])
+	itemresults = delete_expired(client, [member for item in expired for member in sets[item["name"]]], data['retention_workers'])
+	is_failed, result = retention_result(itemresults, kept, started)
+	result["sets"] = len(expired)
+	return (is_failed, result)
+
+
+def retention_result(itemresults, kept, started):
+	deleted = [itemresult for itemresult in itemresults if itemresult["status"] == "Succeeded"]
+	result = {
+		"kept": kept,
+		"expired": len(itemresults),
+		"deleted": len(deleted),
+		"failed": len(itemresults) - len(deleted),
+		"bytes": sum(itemresult["bytes"] for itemresult in deleted),
+		"seconds": round(time.time() - started, 1),
+		"items": itemresults
+	}
+	if result["failed"] != 0:
+		result["message"] = str(result["failed"])+" of "+str(result["expired"])+" expired not deleted"
+	return (result["failed"] != 0, result)
+
+
+
+#######################################################################################################################################################################################################
+############################## SETUP ##################################################################################################################################################################
 
 
 
@@ -29,31 +166,20 @@ def setup(data):
 
 	if data['provider'] == "azure":
 		#get first access to azure api and the correct tenant/subscription
-		api_url = "https://login.microsoftonline.com/"+data['tenant']+"/oauth2/token"
-		body = "grant_type=client_credentials&client_id="+data['client_id']+"&client_secret="+data['secret']+"&resource=https://management.core.windows.net"
-		headers = {
-			'content-type': 'application/x-www-form-urlencoded'
-		}
-		token = requests.get(api_url, data=body, headers=headers)
-		meta = {token.status_code}
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
 
-		if token.status_code == 200:
+		if token_status == 200:
 
-			tokeninfo = token.json()
-			
 			if tokeninfo.get('token_type') == "Bearer":
 
 				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 				#~~~~~ list snap policies ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 				#https://docs.microsoft.com/en-us/rest/api/netapp/snapshot-policies/list?tabs=HTTP
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/snapshotPolicies?api-version=2021-10-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				returndata = httpreturn.json()
+				api_url = client.account_url("/snapshotPolicies")
+				httpreturn, policies = client.list(api_url)
 
 				has_changed = False
 				is_failed = False
@@ -64,7 +190,7 @@ def setup(data):
 				found_primary5d = 0
 				found_primarycustpolicy = 0
 
-				for policy in returndata["value"]:
+				for policy in policies:
 					if "primary5d" in policy["name"]:
 						found_primary5d = 1
 					if primarypolicyname in policy["name"]:
@@ -75,7 +201,7 @@ def setup(data):
 
 				if found_primary5d == 0:
 					#create snapshot policy
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/snapshotPolicies/primary5d?api-version=2021-10-01"
+					api_url = client.account_url("/snapshotPolicies/primary5d")
 
 					body_raw = {
 						'location': data['location'],
@@ -104,13 +230,8 @@ def setup(data):
 							},
 						}
 					}
-					body = json.dumps(body_raw)
 
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+					httpreturn = client.put(api_url, body_raw)
 
 					if httpreturn.status_code == 201:
 						has_changed = True
@@ -127,7 +248,7 @@ def setup(data):
 
 				if found_primarycustpolicy == 0:
 					#create snapshot policy
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/snapshotPolicies/"+primarypolicyname+"?api-version=2021-10-01"
+					api_url = client.account_url("/snapshotPolicies/"+primarypolicyname)
 
 					body_raw = {
 						'location': data['location'],
@@ -156,13 +277,8 @@ def setup(data):
 							},
 						}
 					}
-					body = json.dumps(body_raw)
 
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+					httpreturn = client.put(api_url, body_raw)
 
 					if httpreturn.status_code == 201:
 						has_changed = True
@@ -178,13 +294,8 @@ def setup(data):
 				#~~~~~ list backup policies ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 				#https://docs.microsoft.com/en-us/rest/api/netapp/backup-policies/list?tabs=HTTP
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/backupPolicies?api-version=2021-10-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				returndata = httpreturn.json()
+				api_url = client.account_url("/backupPolicies")
+				httpreturn, policies = client.list(api_url)
 
 				#file = open ("/tmp/testfile.txt","w")
 				#file.write (httpreturn.text)
@@ -203,7 +314,7 @@ def setup(data):
 				
 				found_backuppolicy = 0
 
-				for policy in returndata["value"]:
+				for policy in policies:
 					if backuppolicyname in policy["name"]:
 						found_backuppolicy = 1
 
@@ -211,7 +322,7 @@ def setup(data):
 				#~~~~~ if no backup policy with retention name exist, create one ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 				if found_backuppolicy == 0:
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/backupPolicies/"+backuppolicyname+"?api-version=2021-10-01"
+					api_url = client.account_url("/backupPolicies/"+backuppolicyname)
 
 					body_raw = {
 						'location': data['location'],
@@ -222,13 +333,8 @@ def setup(data):
 							'monthlyBackupsToKeep': '0',
 						}
 					}
-					body = json.dumps(body_raw)
 
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+					httpreturn = client.put(api_url, body_raw)
 
 					if httpreturn.status_code == 201:
 						has_changed = True
@@ -242,12 +348,8 @@ def setup(data):
 							#~~~~~ backup feature is not allowed/enabled! -> set only snapshot policy on volume for now! ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 							#check if snap policy already assigned on volume!
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2021-10-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
+							api_url = client.volume_url(capacitypool, data['volname'])
+							httpreturn = client.get(api_url)
 							returndata = httpreturn.json()
 
 							#file = open ("/tmp/testfile.txt","w")
@@ -258,7 +360,7 @@ def setup(data):
 
 							try:
 								if primarypolicyname not in returndata["properties"]["dataProtection"]["snapshot"]["snapshotPolicyId"]:
-									api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2021-10-01"
+									api_url = client.volume_url(capacitypool, data['volname'])
 
 									body_raw = {
 										'properties': {
@@ -270,13 +372,8 @@ def setup(data):
 											}
 										}
 									}
-									body = json.dumps(body_raw)
 
-									headers = {
-										'content-type': 'application/json',
-										'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-									}
-									httpreturn = requests.patch(api_url, data=body, headers=headers)
+									httpreturn = client.patch(api_url, body_raw)
 
 									if httpreturn.status_code == 202:
 										has_changed = True
@@ -289,7 +386,7 @@ def setup(data):
 										meta = {"snapshot policy set failed - " + httpreturn.text}
 										return (is_failed, has_changed, meta)
 							except KeyError:
-								api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2021-10-01"
+								api_url = client.volume_url(capacitypool, data['volname'])
 
 								body_raw = {
 									'properties': {
@@ -301,13 +398,8 @@ def setup(data):
 										}
 									}
 								}
-								body = json.dumps(body_raw)
 
-								headers = {
-									'content-type': 'application/json',
-									'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-								}
-								httpreturn = requests.patch(api_url, data=body, headers=headers)
+								httpreturn = client.patch(api_url, body_raw)
 
 								if httpreturn.status_code == 202:
 									has_changed = True
@@ -329,12 +421,8 @@ def setup(data):
 				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 				#~~~~~ check if backup is already enabled/set on volume ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2021-10-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
+				api_url = client.volume_url(capacitypool, data['volname'])
+				httpreturn = client.get(api_url)
 				returndata = httpreturn.json()
 
 				#file = open ("/tmp/testfile.txt","w")
@@ -350,22 +438,17 @@ def setup(data):
 					if returndata["properties"]["dataProtection"]["backup"]["backupEnabled"] == False:
 						
 						#get netapp backup vaults
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/vaults?api-version=2021-10-01"
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.get(api_url, headers=headers)
-						returndata = httpreturn.json()
+						api_url = client.account_url("/vaults")
+						httpreturn, vaults = client.list(api_url)
 
-						backupvault = returndata["value"][0]["id"]
+						backupvault = next(vaults)["id"]
 						#file = open ("/tmp/testfile.txt","w")
 						#file.write (httpreturn.text)
 						#file.write (returndata["value"][0]["id"])
 						#file.write (str(httpreturn.status_code))
 						#file.close()
 
-						api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"?api-version=2021-10-01"
+						api_url = client.volume_url(capacitypool, data['volname'])
 						body_raw = {
 							'properties': {
 								'dataProtection': {
@@ -381,13 +464,8 @@ def setup(data):
 								}
 							}
 						}
-						body = json.dumps(body_raw)
 
-						headers = {
-							'content-type': 'application/json',
-							'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-						}
-						httpreturn = requests.patch(api_url, data=body, headers=headers)
+						httpreturn = client.patch(api_url, body_raw)
 
 						if httpreturn.status_code == 202:
 							has_changed = True
@@ -410,7 +488,6 @@ def setup(data):
 		else:
 			has_changed = False
 			is_failed = True
-			tokeninfo = token.json()
 			meta = {tokeninfo["error_description"]}
 	else:
 		has_changed = False
@@ -422,36 +499,94 @@ def setup(data):
 
 
 
+def group_backup(client, data, capacitypool):
+	#----- one crash consistent snapshot of all "volumes": prepared up front, all PUTs released at the same moment -----
+	started = time.time()
+	volnames = [volume["volname"] for volume in data['volumes']]
+	if data['backup_id'] == 0:
+		snapname = "ansible-volume-backup-"+datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+	else:
+		snapname = "ansible-volume-backup-"+str(data['backup_id'])
+	collection_urls = [client.volume_url(capacitypool, volname, "/snapshots", api_version="2020-08-01") for volname in volnames]
+	body_raw = {
+		'location': data['location']
+	}
+
+	#----- prepare: all members must exist before any snap is taken, this also opens one connection per member -----
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(volnames)) as executor:
+		missing = [volname for volname, httpreturn in zip(volnames, executor.map(lambda volname: client.get(client.volume_url(capacitypool, volname)), volnames)) if httpreturn.status_code != 200]
+	if len(missing) != 0:
+		return (True, False, {"snap group not started, volumes not found: "+", ".join(missing)})
+	client.authorize()
+	barrier = threading.Barrier(len(volnames))
+
+	def snap_one(volname):
+		member = {"volname": volname}
+		api_url = client.volume_url(capacitypool, volname, "/snapshots/"+snapname, api_version="2020-08-01")
+		barrier.wait()
+		member["sent"] = time.time()
+		try:
+			httpreturn = client.put(api_url, body_raw)
+			if httpreturn.status_code != 201:
+				return dict(member, status="failed", message=httpreturn.text)
+			lro_status, returndata = client.wait(httpreturn, api_url, timeout=300)
+		except requests.exceptions.RequestException as error:
+			return dict(member, status="failed", message=str(error))
+		if lro_status != "Succeeded":
+			return dict(member, status="failed", message=lro_status+": "+json.dumps(returndata))
+		return dict(member, status="created", created=returndata.get("properties", {}).get("created"), seconds=round(time.time() - member["sent"], 1))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(volnames)) as executor:
+		members = list(executor.map(snap_one, volnames))
+
+	created = [member for member in members if member["status"] == "created"]
+	sent = [member["sent"] for member in members]
+	epochs = [created_epoch({"properties": member}) for member in created if member.get("created")]
+	client.results["group"] = {
+		"snapname": snapname,
+		"members": members,
+		"skew_seconds": max(epochs) - min(epochs) if len(epochs) != 0 else None,
+		"put_spread_seconds": round(max(sent) - min(sent), 3),
+		"seconds": round(time.time() - started, 1)
+	}
+
+	if len(created) != len(members):
+		#----- a partial set is no consistent point in time, remove the members that were created -----
+		delete_expired(client, [(collection_url, {"name": snapname}) for collection_url, member in zip(collection_urls, members) if member["status"] == "created"], data['retention_workers'])
+		failed = [member for member in members if member["status"] == "failed"]
+		return (True, False, {"snap group "+snapname+" failed on "+", ".join(member["volname"] for member in failed)+": "+failed[0]["message"]})
+
+	client.phase("retention")
+	retention_failed, client.results["retention"] = group_retention(client, data, collection_urls)
+	client.phase(None)
+	if retention_failed:
+		return (True, True, {"snap group created successfully, but snapshot retention failed: "+client.results["retention"]["message"]})
+	return (False, True, {"snap group "+snapname+" created on "+str(len(members))+" volumes, skew "+str(client.results["group"]["skew_seconds"])+"s"})
+
+
 def backup(data):
 
 	if data['provider'] == "azure":
 		#get first access to azure api and the correct tenant/subscription
-		api_url = "https://login.microsoftonline.com/"+data['tenant']+"/oauth2/token"
-		body = "grant_type=client_credentials&client_id="+data['client_id']+"&client_secret="+data['secret']+"&resource=https://management.core.windows.net"
-		headers = {
-			'content-type': 'application/x-www-form-urlencoded'
-		}
-		token = requests.get(api_url, data=body, headers=headers)
-		meta = {token.status_code}
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
 
-		if token.status_code == 200:
+		if token_status == 200:
 
-			tokeninfo = token.json()
-			
 			if tokeninfo.get('token_type') == "Bearer":
 				capacitypool = data['sku'].lower()
 
+				if data.get('volumes'):
+					#----- snapshot group of several volumes, always volume snaps -----
+					return group_backup(client, data, capacitypool)
+
 				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 				#~~~~~ list backup policies ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 				#https://docs.microsoft.com/en-us/rest/api/netapp/backup-policies/list?tabs=HTTP
-				api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/backupPolicies?api-version=2021-10-01"
-				headers = {
-					'content-type': 'application/json',
-					'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-				}
-				httpreturn = requests.get(api_url, headers=headers)
-				returndata = httpreturn.json()
+				api_url = client.account_url("/backupPolicies")
+				httpreturn, policies = client.list(api_url)
 
 				#file = open ("/tmp/testfile.txt","w")
 				#file.write (httpreturn.text)
@@ -470,7 +605,7 @@ def backup(data):
 				
 				found_backuppolicy = 0
 
-				for policy in returndata["value"]:
+				for policy in policies:
 					if backuppolicyname in policy["name"]:
 						found_backuppolicy = 1
 
@@ -488,50 +623,28 @@ def backup(data):
 						snapname = "ansible-volume-backup-"+mytimenow
 					else:
 						snapname = "ansible-volume-backup-"+str(data['backup_id'])
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots/"+snapname+"?api-version=2020-08-01"
+					api_url = client.volume_url(capacitypool, data['volname'], "/snapshots/"+snapname, api_version="2020-08-01")
 
 					body_raw = {
 						'location': data['location']
 					}
-					body = json.dumps(body_raw)
 
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+					httpreturn = client.put(api_url, body_raw)
 					#httpreturn = requests.put(api_url, headers=headers)
 
 					if httpreturn.status_code == 201:
 						has_changed = True
 						is_failed = False
 						meta = {"snap created successfully."}
-						#check if snap is in provitioningState "Succeeded"
-						maxrun = 30
-						time.sleep(30) # give Azrue some time to create the snapshot!
-						while True:
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots/"+snapname+"?api-version=2020-08-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							maxrun = maxrun + 10
-							try:
-								if returndata["properties"]["provisioningState"] == "Succeeded":
-									break
-								else:
-									time.sleep(10)
-							except KeyError:
-								time.sleep(10)
-							#return failure if snap takes longer than 5 min!
-							maxrun = maxrun + 10
-							if maxrun == 300:
-								has_changed = False
-								is_failed = True
-								meta = {"Error: Runtime of snap creation was longer than 5 min. Please re-run the job!"}
-								return (is_failed, has_changed, meta)
+						#check if snap is in provitioningState "Succeeded", return failure if snap takes longer than 5 min!
+						lro_status, returndata = client.wait(httpreturn, api_url, timeout=300)
+						if lro_status != "Succeeded":
+							has_changed = False
+							is_failed = True
+							meta = {"Error: Runtime of snap creation was longer than 5 min. Please re-run the job!"}
+							if lro_status == "Failed":
+								meta = {"Error: snap creation failed - "+json.dumps(returndata)}
+							return (is_failed, has_changed, meta)
 					else:
 						has_changed = False
 						is_failed = True
@@ -541,32 +654,13 @@ def backup(data):
 
 					#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 					#~~~~~ ensure snapshot retention ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots?api-version=2020-08-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					returndata = httpreturn.json()
-
-					#file = open ("/tmp/testfile.txt","w")
-					#file.write (returndata["value"][0]["properties"]["name"])
-					#file.write (returndata["value"][0]["properties"]["created"])
-
-					#meta = {httpreturn.text}
-					#meta = {returndata[0]["properties"]["name"]}
-					for snap in returndata["value"]:
-						x_days_ago = datetime.datetime.now()-datetime.timedelta(data['retention_days'])
-						returntime = datetime.datetime.strptime(snap["properties"]["created"], "%Y-%m-%dT%H:%M:%SZ")
-						if returntime < x_days_ago:
-							snapname = snap["name"].split('/')[3]
-
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/snapshots/"+snapname+"?api-version=2020-08-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.delete(api_url, headers=headers)
+					client.phase("retention")
+					api_url = client.volume_url(capacitypool, data['volname'], "/snapshots", api_version="2020-08-01")
+					retention_failed, client.results["retention"] = retention(client, data, api_url)
+					if retention_failed:
+						is_failed = True
+						meta = {"snap created successfully, but snapshot retention failed: "+client.results["retention"]["message"]}
+					client.phase(None)
 
 				#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 				#~~~~~ if backup policy exist, feature is enabled so run ANF backup ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -580,50 +674,29 @@ def backup(data):
 					else:
 						snapname = "ansible-volume-backup-"+str(data['backup_id'])
 
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/backups/"+snapname+"?api-version=2021-02-01"
+					api_url = client.volume_url(capacitypool, data['volname'], "/backups/"+snapname, api_version="2021-02-01")
 					body_raw = {
 						'location': data['location'],
 						'properties': {
 							'label': ''
 						}
 					}
-					body = json.dumps(body_raw)
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.put(api_url, data=body, headers=headers)
+					httpreturn = client.put(api_url, body_raw)
 
 					if httpreturn.status_code == 201:
 						has_changed = True
 						is_failed = False
 						meta = {"Backup created successfully."}
-						#check if backup is in provitioningState "Succeeded"
-						maxrun = 30
-						time.sleep(30) # give Azrue some time to create the snapshot!
-						while True:
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/backups/"+snapname+"?api-version=2021-10-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.get(api_url, headers=headers)
-							returndata = httpreturn.json()
-							maxrun = maxrun + 10
-							try:
-								if returndata["properties"]["provisioningState"] == "Succeeded":
-									break
-								else:
-									time.sleep(10)
-							except KeyError:
-								time.sleep(10)
-							#return failure if snap takes longer than 5 min!
-							maxrun = maxrun + 10
-							if maxrun == 300:
-								has_changed = False
-								is_failed = True
-								meta = {"Error: Runtime of backup creation was longer than 5 min. Please re-run the job or ask a devops engineer!"}
-								return (is_failed, has_changed, meta)
+						#check if backup is in provitioningState "Succeeded", return failure if backup takes longer than 5 min!
+						api_url = client.volume_url(capacitypool, data['volname'], "/backups/"+snapname)
+						lro_status, returndata = client.wait(httpreturn, api_url, timeout=300)
+						if lro_status != "Succeeded":
+							has_changed = False
+							is_failed = True
+							meta = {"Error: Runtime of backup creation was longer than 5 min. Please re-run the job or ask a devops engineer!"}
+							if lro_status == "Failed":
+								meta = {"Error: backup creation failed - "+json.dumps(returndata)}
+							return (is_failed, has_changed, meta)
 					else:
 						has_changed = False
 						is_failed = True
@@ -632,32 +705,13 @@ def backup(data):
 
 					#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 					#~~~~~ ensure backup retention ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-					api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/backups?api-version=2021-10-01"
-					headers = {
-						'content-type': 'application/json',
-						'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-					}
-					httpreturn = requests.get(api_url, headers=headers)
-					returndata = httpreturn.json()
-
-					#file = open ("/tmp/testfile.txt","w")
-					#file.write (returndata["value"][0]["properties"]["name"])
-					#file.write (returndata["value"][0]["properties"]["created"])
-
-					#meta = {httpreturn.text}
-					#meta = {returndata[0]["properties"]["name"]}
-					for snap in returndata["value"]:
-						x_days_ago = datetime.datetime.now()-datetime.timedelta(data['retention_days'])
-						returntime = datetime.datetime.strptime(snap["properties"]["created"], "%Y-%m-%dT%H:%M:%SZ")
-						if returntime < x_days_ago:
-							snapname = snap["name"].split('/')[3]
-
-							api_url = "https://management.azure.com/subscriptions/"+data['subscription_id']+"/resourceGroups/"+data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+data['accountname']+"/capacityPools/"+capacitypool+"/volumes/"+data['volname']+"/backups/"+snapname+"?api-version=2021-10-01"
-							headers = {
-								'content-type': 'application/json',
-								'Authorization': tokeninfo['token_type']+' '+tokeninfo['access_token']
-							}
-							httpreturn = requests.delete(api_url, headers=headers)
+					client.phase("retention")
+					api_url = client.volume_url(capacitypool, data['volname'], "/backups")
+					retention_failed, client.results["retention"] = retention(client, data, api_url)
+					if retention_failed:
+						is_failed = True
+						meta = {"Backup created successfully, but backup retention failed: "+client.results["retention"]["message"]}
+					client.phase(None)
 
 			else:
 				has_changed = False
@@ -666,7 +720,6 @@ def backup(data):
 		else:
 			has_changed = False
 			is_failed = True
-			tokeninfo = token.json()
 			meta = {tokeninfo["error_description"]}
 	else:
 		has_changed = False
@@ -677,10 +730,164 @@ def backup(data):
 
 
 
+def restore_source(client, data, capacitypool):
+	#----- snapshot or ANF backup to restore from: "ansible-volume-backup-<backup_id>", backup_id 0 = the newest one -----
+	collection = "/backups" if data['restore_from'] == "backup" else "/snapshots"
+	if data['backup_id'] != 0:
+		api_url = client.volume_url(capacitypool, data['volname'], collection+"/ansible-volume-backup-"+str(data['backup_id']))
+		httpreturn = client.get(api_url)
+		if httpreturn.status_code != 200:
+			return (True, httpreturn.text)
+		return (False, httpreturn.json())
+
+	api_url = client.volume_url(capacitypool, data['volname'], collection)
+	httpreturn, items = client.list(api_url)
+	if httpreturn.status_code != 200:
+		return (True, httpreturn.text)
+	dated = [(created_epoch(item), item) for item in items if item["name"].split('/')[-1].startswith("ansible-volume-backup-")]
+	dated = [(created, item) for created, item in dated if created is not None]
+	if len(dated) == 0:
+		return (True, "no "+collection.strip("/")+" of volume "+data['volname']+" to restore from")
+	return (False, max(dated, key=lambda entry: entry[0])[1])
+
+
+def restore_revert(client, data, capacitypool, source):
+	#----- revert the volume in place to the snapshot, the volume keeps its name and mount path -----
+	#POST https://management.azure.com/subscriptions/{subscriptionId}/resourceGroups/{resourceGroupName}/providers/Microsoft.NetApp/netAppAccounts/{accountName}/capacityPools/{poolName}/volumes/{volumeName}/revert?api-version=2021-10-01
+	api_url = client.volume_url(capacitypool, data['volname'], "/revert")
+	httpreturn = client.post(api_url, {'snapshotId': source["properties"]["snapshotId"]})
+	if httpreturn.status_code not in (200, 202):
+		return ("Failed", {"message": httpreturn.text})
+	return client.wait(httpreturn, client.volume_url(capacitypool, data['volname']))
+
+
+def restore_pool(client, data, coordinator, capacitypool, volsizeraw):
+	#----- grow the capacity pool for the new volume first, a pool without room would only fail the volume PUT. same sizing
+	# as present, and with a coordinator the same pool lease, so a concurrent present on this host is not resized over -----
+	is_failed, actualpoolsize, poolvolumes = pool_state(client, capacitypool)
+	if is_failed:
+		return ("Failed", {"message": poolvolumes})
+	if actualpoolsize is None:
+		return ("Failed", {"message": "capacity pool "+capacitypool+" not found"})
+
+	poolsize, lowerpoolsize = pool_sizes(actualpoolsize, poolvolumes, {data['restore_volname']: volsizeraw})
+	if poolsize == 0:
+		return ("Succeeded", None)
+	step = {"action": "resize", "type": "pool", "name": capacitypool, "before": actualpoolsize, "after": poolsize}
+	is_failed, has_changed, meta = pool_step(client, data, coordinator, capacitypool, step)
+	if is_failed:
+		return ("Failed", {"message": list(meta)[0]})
+	if has_changed:
+		httpreturn = client.get(client.pool_url(capacitypool))
+		client.results["pool"] = {"before": actualpoolsize, "after": httpreturn.json()["properties"]["size"] if httpreturn.status_code == 200 else poolsize}
+	return ("Succeeded", None)
+
+
+def restore_volume(client, data, capacitypool, source):
+	#----- new volume restore_volname from the snapshot or backup, network and export settings of the original volume -----
+	api_url = client.volume_url(capacitypool, data['volname'])
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code != 200:
+		return ("Failed", {"message": httpreturn.text})
+	original = httpreturn.json()["properties"]
+
+	properties = {
+		'creationToken': data['restore_volname'].lower(),
+		'subnetId': original["subnetId"],
+		'usageThreshold': original["usageThreshold"],
+		'serviceLevel': original.get("serviceLevel", data['sku']),
+		'protocolTypes': original.get("protocolTypes", ['NFSv4.1']),
+		'exportPolicy': original.get("exportPolicy", {})
+	}
+	if data['restore_from'] == "backup":
+		properties['backupId'] = source["properties"]["backupId"]
+	else:
+		properties['snapshotId'] = source["properties"]["snapshotId"]
+
+	#----- the restored volume is registered at the pool lease until it exists, so no compact or absent shrinks it away -----
+	coordinator = None
+	if data.get('pool_lease', True) and data.get('cache_dir'):
+		coordinator = PoolCoordinator(data, capacitypool)
+		coordinator.register({data['restore_volname']: original["usageThreshold"]})
+	try:
+		lro_status, returndata = restore_pool(client, data, coordinator, capacitypool, original["usageThreshold"])
+		if lro_status != "Succeeded":
+			return (lro_status, "capacity pool "+capacitypool+" could not be grown for the restored volume: "+(returndata or {}).get("message", json.dumps(returndata)))
+
+		api_url = client.volume_url(capacitypool, data['restore_volname'])
+		httpreturn = client.put(api_url, {'location': data['location'], 'properties': properties})
+		if httpreturn.status_code not in (200, 201):
+			return ("Failed", {"message": httpreturn.text})
+		return client.wait(httpreturn, api_url)
+	finally:
+		if coordinator is not None:
+			coordinator.release()
+			client.results["pool_coalescing"] = coordinator.stats
+
+
 def restore(data=None):
-	has_changed = False
-	is_failed = False
-	meta = {"restore": "not yet implemented"}
+
+	if data['provider'] == "azure":
+		#get first access to azure api and the correct tenant/subscription
+		client = arm_client(data, API_VERSION)
+		token_status, tokeninfo = client.login()
+		meta = {token_status}
+
+		if token_status == 200:
+
+			if tokeninfo.get('token_type') == "Bearer":
+				capacitypool = data['sku'].lower()
+				started = time.time()
+
+				if data['restore_mode'] == "revert" and data['restore_from'] == "backup":
+					return (True, False, {"restore_mode revert needs a snapshot, ANF backups can only be restored to a new volume"})
+
+				is_failed, source = restore_source(client, data, capacitypool)
+				if is_failed:
+					return (is_failed, False, {source})
+				sourcename = source["name"].split('/')[-1]
+
+				#----- revert: seconds, in place / new_volume: the original stays intact -----
+				if data['restore_mode'] == "revert":
+					targetname = data['volname']
+					lro_status, returndata = restore_revert(client, data, capacitypool, source)
+				else:
+					targetname = data['restore_volname']
+					lro_status, returndata = restore_volume(client, data, capacitypool, source)
+
+				client.results["restore"] = {
+					"mode": data['restore_mode'],
+					"source": sourcename,
+					"volname": targetname,
+					"status": lro_status,
+					"seconds": round(time.time() - started, 1)
+				}
+				if lro_status != "Succeeded":
+					has_changed = data['restore_mode'] == "new_volume"
+					is_failed = True
+					meta = {"restore of "+targetname+" from "+sourcename+" "+lro_status+": "+json.dumps(returndata)}
+					return (is_failed, has_changed, meta)
+
+				has_changed = True
+				is_failed = False
+				if data['restore_mode'] == "revert":
+					meta = {"volume "+targetname+" reverted to "+sourcename+" in "+str(client.results["restore"]["seconds"])+"s"}
+				else:
+					client.results["restore"]["mountip"] = returndata["properties"]["mountTargets"][0]["ipAddress"]
+					meta = {"volume "+targetname+" restored from "+sourcename+" in "+str(client.results["restore"]["seconds"])+"s"}
+			else:
+				has_changed = False
+				is_failed = True
+				meta = {"Failed to get access token to azure! please check your credentials!"}
+		else:
+			has_changed = False
+			is_failed = True
+			meta = {tokeninfo["error_description"]}
+	else:
+		has_changed = False
+		is_failed = True
+		meta = {"Unsupported provider"}
+
 	return (is_failed, has_changed, meta)
 
 
@@ -710,7 +917,15 @@ def main():
 			"default": "Premium",
 			"type": "str"
 		},
-		"volname": {"required": True, "type": "str"},
+		"volname": {"required": False, "type": "str"},
+		"volumes": {
+			"required": False,
+			"type": "list",
+			"elements": "dict",
+			"options": {
+				"volname": {"required": True, "type": "str"}
+			}
+		},
 		"retention_days": {
 			"required": False,
 			"default": 30,
@@ -727,6 +942,79 @@ def main():
 			"default": 0,
 			"type": "int"
 		},
+		"retention_workers": {
+			"required": False,
+			"default": 8,
+			"type": "int"
+		},
+		"restore_mode": {
+			"required": False,
+			"default": "revert",
+			"choices": ["revert", "new_volume"],
+			"type": "str"
+		},
+		"restore_from": {
+			"required": False,
+			"default": "snapshot",
+			"choices": ["snapshot", "backup"],
+			"type": "str"
+		},
+		"restore_volname": {"required": False, "type": "str"},
+		"lro_timeout": {
+			"required": False,
+			"default": 1800,
+			"type": "int"
+		},
+		"http_pool_size": {
+			"required": False,
+			"default": 10,
+			"type": "int"
+		},
+		"token_cache": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"etag_cache": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"rate_limit": {
+			"required": False,
+			"default": True,
+			"type": "bool"
+		},
+		"max_retries": {
+			"required": False,
+			"default": 5,
+			"type": "int"
+		},
+		"cache_dir": {
+			"required": False,
+			"default": "~/.ansible/anf_cache",
+			"type": "str"
+		},
+		"timings": {
+			"required": False,
+			"default": False,
+			"type": "bool"
+		},
+		"fleet": {
+			"required": False,
+			"type": "list",
+			"elements": "dict"
+		},
+		"fleet_workers": {
+			"required": False,
+			"default": 32,
+			"type": "int"
+		},
+		"fleet_subscription_limit": {
+			"required": False,
+			"default": 8,
+			"type": "int"
+		},
 	}
 
 	choice_map = {
@@ -735,9 +1023,21 @@ def main():
 		"restore": restore,
 	}
 
-	module = AnsibleModule(argument_spec=fields)
-	is_failed, has_changed, result = choice_map.get(module.params["state"])(module.params)
-	module.exit_json(failed=is_failed, changed=has_changed, msg=result)
+	module = AnsibleModule(
+		argument_spec=fields,
+		required_one_of=[["volname", "volumes", "fleet"]],
+		mutually_exclusive=[["volname", "volumes"]],
+		required_if=[
+			["restore_mode", "new_volume", ["restore_volname"]],
+			["state", "setup", ["volname", "fleet"], True],
+			["state", "restore", ["volname", "fleet"], True]
+		]
+	)
+	if module.params["fleet"]:
+		is_failed, has_changed, result = fleet_run(module.params, choice_map, exclusive=("setup",))
+	else:
+		is_failed, has_changed, result = choice_map.get(module.params["state"])(module.params)
+	module.exit_json(failed=is_failed, changed=has_changed, msg=result, **run_results(module.params))
 
 
 
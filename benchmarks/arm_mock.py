@@ -0,0 +1,401 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+script: arm_mock
+short_description: local stand-in for the azure endpoints used by anf_volume / anf_volume_backup.
+
+Serves the oauth token endpoint, Microsoft.NetApp accounts/pools/volumes/snapshots/policies/backups/vaults,
+Microsoft.Insights metrics and the azure monitor metrics:getBatch endpoint from memory. Long running operations answer 201/202 with an Azure-AsyncOperation and
+Location header and finish after lro_duration seconds. GET answers carry an ETag and honour If-None-Match. Latency, failures and subscription throttling (429) can be injected.
+
+Usage: python arm_mock.py --port 8990 --latency 0.02 --lro-duration 2 --fail PUT:capacityPools:500:1
+'''
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import argparse
+import hashlib
+import json
+import time
+import uuid
+import re
+
+
+# collection name -> name depth below the account, used to build arm "name" fields (acc/pool/vol/snap)
+COLLECTIONS = ("netAppAccounts", "capacityPools", "volumes", "snapshots", "backups", "snapshotPolicies", "backupPolicies", "vaults")
+
+
+class ArmMock(object):
+
+	def __init__(self, latency=0.0, lro_duration=1.0, delete_duration=None, failures=None, retry_after=None, metrics_bytes=None, page_size=None, rate_limit=None):
+		self.latency = latency
+		self.lro_duration = lro_duration
+		self.delete_duration = lro_duration if delete_duration is None else delete_duration
+		self.failures = failures or [] # [{"method": "PUT", "match": "capacityPools", "status": 500, "count": 1}]
+		self.retry_after = retry_after
+		self.metrics_bytes = metrics_bytes or {} # volname -> (logical, snapshot) bytes
+		self.page_size = page_size # list calls answer page_size items per page plus a nextLink
+		self.rate_limit = rate_limit # requests per second and kind (reads/writes/deletes), bursts up to 2s worth, then 429
+		self.buckets = {}
+		self.resources = {}
+		self.operations = {}
+		self.lock = threading.Lock()
+		self.reset_counters()
+
+	def reset_counters(self):
+		self.requests = {}
+		self.total = 0
+		self.not_modified = 0
+		self.throttled = 0
+		self.first_request = None # epoch seconds of the first request since the reset
+
+	#----- helpers -----
+	def key(self, path):
+		return path.rstrip("/").lower()
+
+	def count(self, method, path):
+		with self.lock:
+			if self.first_request is None:
+				self.first_request = time.time()
+			self.total += 1
+			self.requests[method] = self.requests.get(method, 0) + 1
+
+	def injected(self, method, path):
+		with self.lock:
+			for rule in self.failures:
+				if rule.get("count", 1) <= 0:
+					continue
+				if rule.get("method", method) == method and rule.get("match", "") in path:
+					rule["count"] = rule.get("count", 1) - 1
+					return rule
+		return None
+
+	def state(self, resource):
+		now = time.time()
+		if resource.get("deleting_at") is not None:
+			return "Deleting"
+		if now < resource["ready_at"]:
+			return resource.get("pending", "Creating")
+		return "Succeeded"
+
+	def alive(self, key):
+		resource = self.resources.get(key)
+		if resource is None:
+			return None
+		if resource.get("deleting_at") is not None and time.time() >= resource["deleting_at"]:
+			del self.resources[key]
+			return None
+		return resource
+
+	def view(self, key):
+		resource = self.alive(key)
+		if resource is None:
+			return None
+		body = json.loads(json.dumps(resource["body"]))
+		body.setdefault("properties", {})["provisioningState"] = self.state(resource)
+		return body
+
+	def children(self, key):
+		prefix = key + "/"
+		result = []
+		for other in sorted(self.resources):
+			if other.startswith(prefix) and other[len(prefix):].count("/") == 1 and self.alive(other):
+				result.append(other)
+		return result
+
+	def operation(self, done_at, failed=False):
+		opid = str(uuid.uuid4())
+		self.operations[opid] = {"done_at": done_at, "failed": failed}
+		return "/providers/Microsoft.NetApp/locations/mock/operationResults/"+opid
+
+	def armname(self, path):
+		parts = path.strip("/").split("/")
+		names = []
+		for i in range(len(parts) - 1):
+			if parts[i] in COLLECTIONS:
+				names.append(parts[i+1])
+		return "/".join(names)
+
+	def limit(self, method):
+		#----- arm style subscription throttling: remaining count header on every answer, 429 + Retry-After when empty -----
+		kind = {"GET": "reads", "DELETE": "deletes"}.get(method, "writes")
+		with self.lock:
+			now = time.time()
+			size = self.rate_limit * 2
+			bucket = self.buckets.setdefault(kind, {"tokens": size, "stamp": now})
+			bucket["tokens"] = min(size, bucket["tokens"] + (now - bucket["stamp"]) * self.rate_limit)
+			bucket["stamp"] = now
+			if bucket["tokens"] < 1:
+				self.throttled += 1
+				return (False, {"Retry-After": str(int((1 - bucket["tokens"]) / self.rate_limit) + 1)})
+			bucket["tokens"] -= 1
+			return (True, {"x-ms-ratelimit-remaining-subscription-"+kind: str(int(bucket["tokens"]))})
+
+	#----- verbs -----
+	def handle(self, method, path, query, body, host):
+		if self.latency:
+			time.sleep(self.latency)
+		self.count(method, path)
+
+		if self.rate_limit and "/oauth2/token" not in path:
+			allowed, headers = self.limit(method)
+			if not allowed:
+				return (429, {"error": {"code": "TooManyRequests", "message": "subscription throttled"}}, headers)
+			status, payload, answerheaders = self.answer(method, path, query, body, host)
+			return (status, payload, dict(answerheaders, **headers))
+		return self.answer(method, path, query, body, host)
+
+	def answer(self, method, path, query, body, host):
+		rule = self.injected(method, path)
+		if rule is not None:
+			headers = {}
+			if rule.get("retry_after") is not None:
+				headers["Retry-After"] = str(rule["retry_after"])
+			return (rule.get("status", 500), {"error": {"code": "Injected", "message": "injected failure"}}, headers)
+
+		if "/oauth2/token" in path:
+			return (200, {"token_type": "Bearer", "access_token": "mock-"+str(uuid.uuid4()), "expires_in": "3600", "expires_on": str(int(time.time()) + 3600)}, {})
+
+		if "/operationResults/" in path:
+			op = self.operations.get(path.rsplit("/", 1)[1])
+			if op is None:
+				return (404, {"error": {"code": "NotFound", "message": "operation not found"}}, {})
+			if time.time() < op["done_at"]:
+				return (200, {"status": "InProgress"}, self.retry_headers())
+			return (200, {"status": "Failed" if op["failed"] else "Succeeded"}, {})
+
+		if "metrics:getBatch" in path:
+			return self.metrics_batch(body)
+
+		if "/providers/Microsoft.Insights/metrics" in path:
+			return self.metrics(path, query)
+
+		key = self.key(path)
+		with self.lock:
+			if method == "GET":
+				return self.get(key, path, query, host)
+			if method == "PUT":
+				return self.put(key, path, body, host)
+			if method == "PATCH":
+				return self.patch(key, path, body, host)
+			if method == "DELETE":
+				return self.delete(key, path, host)
+			if method == "POST":
+				return self.post(key, path, body, host)
+		return (405, {"error": {"code": "MethodNotAllowed"}}, {})
+
+	def retry_headers(self):
+		if self.retry_after is None:
+			return {}
+		return {"Retry-After": str(self.retry_after)}
+
+	def notfound(self, path):
+		return (404, {"error": {"code": "ResourceNotFound", "message": "The Resource '"+path+"' was not found."}}, {})
+
+	def get(self, key, path, query="", host=""):
+		last = path.rstrip("/").split("/")[-1]
+		if last in COLLECTIONS:
+			parent = key.rsplit("/", 1)[0]
+			if self.alive(parent) is None:
+				return self.notfound(path)
+			value = [self.view(child) for child in self.children(parent) if child.split("/")[-2] == last.lower()]
+			if not self.page_size:
+				return (200, {"value": value}, {})
+			skip = 0
+			match = re.search(r"\$skipToken=(\d+)", query or "")
+			if match:
+				skip = int(match.group(1))
+			body = {"value": value[skip:skip + self.page_size]}
+			if skip + self.page_size < len(value):
+				body["nextLink"] = host+path+"?"+re.sub(r"&?\$skipToken=\d+", "", query or "")+"&$skipToken="+str(skip + self.page_size)
+			return (200, body, {})
+		body = self.view(key)
+		if body is None:
+			return self.notfound(path)
+		return (200, body, {})
+
+	def put(self, key, path, body, host):
+		existing = self.alive(key)
+		now = time.time()
+		if existing is not None and existing.get("deleting_at") is not None:
+			return (409, {"error": {"code": "Conflict", "message": "resource is being deleted"}}, {})
+		resource = existing or {"body": {"id": path, "name": self.armname(path), "type": "Microsoft.NetApp/"+path.strip("/").split("/")[-2]}}
+		resource["body"].setdefault("properties", {})
+		for field, value in (body or {}).items():
+			if field == "properties":
+				resource["body"]["properties"].update(value)
+			else:
+				resource["body"][field] = value
+		self.defaults(resource, path)
+		resource["ready_at"] = now + self.lro_duration
+		resource["pending"] = "Updating" if existing else "Creating"
+		resource["etag"] = str(uuid.uuid4())
+		self.resources[key] = resource
+		headers = {"Azure-AsyncOperation": host+self.operation(resource["ready_at"])}
+		return (200 if existing else 201, self.view(key), headers)
+
+	def defaults(self, resource, path):
+		properties = resource["body"]["properties"]
+		if "/volumes/" in path and "/snapshots/" not in path and "/backups/" not in path:
+			properties.setdefault("mountTargets", [{"ipAddress": "10.0.0.4"}])
+			properties.setdefault("fileSystemId", str(uuid.uuid4()))
+		if "/snapshots/" in path or "/backups/" in path:
+			properties.setdefault("created", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+		if "/snapshots/" in path:
+			properties.setdefault("snapshotId", str(uuid.uuid4()))
+		if "/backups/" in path:
+			properties.setdefault("size", 0)
+			properties.setdefault("backupId", str(uuid.uuid4()))
+
+	def patch(self, key, path, body, host):
+		existing = self.alive(key)
+		if existing is None:
+			return self.notfound(path)
+		for field, value in (body or {}).get("properties", {}).items():
+			existing["body"]["properties"][field] = value
+		existing["ready_at"] = time.time() + self.lro_duration
+		existing["pending"] = "Patching"
+		headers = {"Azure-AsyncOperation": host+self.operation(existing["ready_at"]), "Location": host+path}
+		return (202, {}, headers)
+
+	def delete(self, key, path, host):
+		existing = self.alive(key)
+		if existing is None:
+			return (204, {}, {})
+		for child in list(self.resources):
+			if child.startswith(key+"/") and "/backups/" not in child and self.alive(child) is not None:
+				return (409, {"error": {"code": "CannotDeleteResource", "message": "Can not delete resource before nested resources are deleted."}}, {})
+		existing["deleting_at"] = time.time() + self.delete_duration
+		headers = {"Azure-AsyncOperation": host+self.operation(existing["deleting_at"]), "Location": host+path}
+		return (202, {}, headers)
+
+	def post(self, key, path, body, host):
+		target = key.rsplit("/", 1)[0]
+		existing = self.alive(target)
+		if existing is None:
+			return self.notfound(path)
+		existing["ready_at"] = time.time() + self.lro_duration
+		existing["pending"] = "Reverting"
+		headers = {"Azure-AsyncOperation": host+self.operation(existing["ready_at"]), "Location": host+path}
+		return (202, {}, headers)
+
+	def metrics(self, path, query):
+		volname = path.split("/providers/Microsoft.Insights/metrics")[0].rstrip("/").split("/")[-1]
+		logical, snapshot = self.metrics_bytes.get(volname, (200 * 1024 ** 3, 10 * 1024 ** 3))
+		now = time.time()
+		value = []
+		for name, amount in (("VolumeLogicalSize", logical), ("VolumeSnapshotSize", snapshot)):
+			points = []
+			for i in range(12):
+				stamp = time.strftime("%Y-%m-%dT%H:%M:00Z", time.gmtime(now - (11 - i) * 300))
+				points.append({"timeStamp": stamp, "average": amount * (0.9 + i / 110.0), "maximum": amount * (0.9 + i / 110.0)})
+			value.append({"name": {"value": name}, "timeseries": [{"data": points}]})
+		return (200, {"value": value}, {})
+
+	def metrics_batch(self, body):
+		#----- azure monitor metrics:getBatch, max. 50 resource ids per call -----
+		resourceids = (body or {}).get("resourceids", [])
+		if len(resourceids) > 50:
+			return (400, {"error": {"code": "BadRequest", "message": "max. 50 resourceids"}}, {})
+		values = []
+		for resourceid in resourceids:
+			status, payload, headers = self.metrics(resourceid+"/providers/Microsoft.Insights/metrics", "")
+			values.append({"resourceid": resourceid, "value": payload["value"]})
+		return (200, {"values": values}, {})
+
+
+class MockHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	mock = None
+
+	def log_message(self, *args):
+		pass
+
+	def dispatch(self, method):
+		path, _, query = self.path.partition("?")
+		length = int(self.headers.get("Content-Length") or 0)
+		raw = self.rfile.read(length) if length else b""
+		body = None
+		if raw and "json" in (self.headers.get("content-type") or ""):
+			try:
+				body = json.loads(raw.decode("utf-8"))
+			except ValueError:
+				body = None
+		host = "http://"+self.headers.get("Host", "127.0.0.1")
+		status, payload, headers = self.mock.handle(method, path, query, body, host)
+		data = json.dumps(payload).encode("utf-8")
+		if method == "GET" and status == 200:
+			#----- ETag of the returned body, a matching If-None-Match is answered with an empty 304 -----
+			etag = '"'+hashlib.sha1(data).hexdigest()+'"'
+			headers = dict(headers, ETag=etag)
+			if self.headers.get("If-None-Match") == etag:
+				status = 304
+				data = b""
+				self.mock.not_modified += 1
+		self.send_response(status)
+		if status != 304:
+			self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		self.dispatch("GET")
+
+	def do_PUT(self):
+		self.dispatch("PUT")
+
+	def do_PATCH(self):
+		self.dispatch("PATCH")
+
+	def do_DELETE(self):
+		self.dispatch("DELETE")
+
+	def do_POST(self):
+		self.dispatch("POST")
+
+
+def serve(mock, port=0):
+	#----- start the mock in a background thread, returns (server, base url) -----
+	handler = type("BoundMockHandler", (MockHandler,), {"mock": mock})
+	server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+	server.daemon_threads = True
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return (server, "http://127.0.0.1:"+str(server.server_port))
+
+
+def main():
+	parser = argparse.ArgumentParser(description="local azure netapp files / arm mock")
+	parser.add_argument("--port", type=int, default=8990)
+	parser.add_argument("--latency", type=float, default=0.0)
+	parser.add_argument("--lro-duration", type=float, default=1.0)
+	parser.add_argument("--delete-duration", type=float, default=None)
+	parser.add_argument("--retry-after", type=int, default=None)
+	parser.add_argument("--page-size", type=int, default=None)
+	parser.add_argument("--rate-limit", type=float, default=None, help="requests per second and kind before 429")
+	parser.add_argument("--fail", action="append", default=[], help="METHOD:match:status[:count], e.g. PUT:capacityPools:500:1")
+	args = parser.parse_args()
+
+	failures = []
+	for fail in args.fail:
+		parts = fail.split(":")
+		failures.append({"method": parts[0], "match": parts[1], "status": int(parts[2]), "count": int(parts[3]) if len(parts) > 3 else 1})
+
+	mock = ArmMock(latency=args.latency, lro_duration=args.lro_duration, delete_duration=args.delete_duration, failures=failures, retry_after=args.retry_after, page_size=args.page_size, rate_limit=args.rate_limit)
+	server, url = serve(mock, args.port)
+	print("arm mock listening on "+url)
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
+
+
+
+if __name__ == '__main__':
+	main()
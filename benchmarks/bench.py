@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+script: bench
+short_description: end-to-end benchmark of anf_volume / anf_volume_backup against the local arm mock.
+
+Runs present, offline, setup, backup and absent for every fleet size (1 = single volume task, more = one fleet task)
+and reports wall-clock seconds, number of azure requests and seconds the modules spent in time.sleep per flow.
+
+Usage: python benchmarks/bench.py --fleet-sizes 1,10,50 --latency 0.02 --lro-duration 1 [--json result.json]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+#----- the repo's module_utils, as ansible adds them when it packs a module -----
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(os.path.dirname(BENCH_DIR), "module_utils"))
+
+import arm_mock
+import anf_volume
+import anf_volume_backup
+from ansible.module_utils import anf_arm
+
+MODULE_FILES = (os.path.abspath(anf_volume.__file__), os.path.abspath(anf_volume_backup.__file__), os.path.abspath(anf_arm.__file__))
+FLOWS = ("present", "offline", "setup", "backup", "absent")
+
+
+class SleepCounter(object):
+	# wraps time.sleep and adds up the seconds slept by module code only, the mock sleeps for its latency itself
+
+	def __init__(self):
+		self.original = time.sleep
+		self.seconds = 0.0
+
+	def sleep(self, seconds):
+		if os.path.abspath(sys._getframe(1).f_code.co_filename) in MODULE_FILES:
+			self.seconds += seconds
+		self.original(seconds)
+
+	def __enter__(self):
+		time.sleep = self.sleep
+		return self
+
+	def __exit__(self, *args):
+		time.sleep = self.original
+
+
+def params(url, fleetsize):
+	data = {
+		'provider': 'azure', 'tenant': 'bench', 'subscription_id': 'bench', 'client_id': 'bench', 'secret': 'bench',
+		'resource_group': 'bench', 'resource_group_net': 'bench', 'virtualnetwork': 'vnet', 'subnet': 'sto',
+		'location': 'westeurope', 'accountname': 'bench0', 'sku': 'Standard', 'volname': 'vol0', 'volsize': 500,
+		'volumes': None, 'volume_workers': 8, 'snapshot_workers': 8, 'retention_days': 7, 'retention_workers': 8, 'backup_id': 0,
+		'lro_timeout': 600, 'http_pool_size': 32, 'token_cache': False, 'cache_dir': None,
+		'fleet': None, 'fleet_workers': 32, 'fleet_subscription_limit': 16,
+	}
+	if fleetsize > 1:
+		#----- spread the volumes over 4 accounts -----
+		data['fleet'] = [{'accountname': 'bench'+str(i % 4), 'volname': 'vol'+str(i)} for i in range(fleetsize)]
+	return data
+
+
+def run_flow(flow, data):
+	#----- same choice maps and exclusive states as the modules' main() -----
+	if flow in ("present", "offline", "absent"):
+		module, exclusive = anf_volume, ("present", "absent", "compact")
+		choice_map = {"present": anf_volume.volume_present, "absent": anf_volume.volume_absent, "offline": anf_volume.volume_offline}
+	else:
+		module, exclusive = anf_volume_backup, ("setup",)
+		choice_map = {"setup": anf_volume_backup.setup, "backup": anf_volume_backup.backup}
+	data = dict(data, state=flow)
+	if data['fleet']:
+		return module.fleet_run(data, choice_map, exclusive=exclusive)
+	return choice_map[flow](data)
+
+
+def bench(args):
+	results = []
+	for fleetsize in args.fleet_sizes:
+		mock = arm_mock.ArmMock(latency=args.latency, lro_duration=args.lro_duration, page_size=args.page_size)
+		server, url = arm_mock.serve(mock)
+		anf_arm.ARM_ENDPOINT = url
+		anf_arm.LOGIN_ENDPOINT = url
+
+		data = params(url, fleetsize)
+		for flow in args.flows:
+			mock.reset_counters()
+			started = time.time()
+			with SleepCounter() as sleeps:
+				is_failed, has_changed, meta = run_flow(flow, data)
+			results.append({
+				"flow": flow,
+				"fleet_size": fleetsize,
+				"seconds": round(time.time() - started, 3),
+				"requests": mock.total,
+				"requests_by_method": mock.requests,
+				"sleep_seconds": round(sleeps.seconds, 3),
+				"failed": is_failed,
+				"changed": has_changed,
+			})
+		server.shutdown()
+		server.server_close()
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="anf module benchmark against the local arm mock")
+	parser.add_argument("--fleet-sizes", default="1,10", help="comma separated, 1 = single volume")
+	parser.add_argument("--flows", default=",".join(FLOWS))
+	parser.add_argument("--latency", type=float, default=0.02)
+	parser.add_argument("--lro-duration", type=float, default=1.0)
+	parser.add_argument("--page-size", type=int, default=None)
+	parser.add_argument("--json", default=None, help="write the results to this file as well")
+	args = parser.parse_args()
+	args.fleet_sizes = [int(size) for size in args.fleet_sizes.split(",")]
+	args.flows = args.flows.split(",")
+
+	results = bench(args)
+
+	print("%-10s %6s %10s %9s %10s %7s" % ("flow", "fleet", "seconds", "requests", "sleep(s)", "failed"))
+	for result in results:
+		print("%-10s %6d %10.3f %9d %10.3f %7s" % (result["flow"], result["fleet_size"], result["seconds"], result["requests"], result["sleep_seconds"], result["failed"]))
+
+	if args.json:
+		with open(args.json, "w") as output:
+			json.dump(results, output, indent=2)
+
+
+
+if __name__ == '__main__':
+	main()
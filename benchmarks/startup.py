@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+script: startup
+short_description: import-to-first-request time of every state of anf_volume / anf_volume_backup.
+
+Every state runs in a fresh python process through the module's main(), like ansible runs it, against the local arm mock.
+Reports per state the seconds to import the module, the seconds from process start to the first request the mock sees,
+the total seconds, the number of loaded python modules and which of the optional packages (numpy, ijson, asyncio)
+the state pulled in. Every state runs --repeat times, the median is reported.
+
+Usage: python benchmarks/startup.py --repeat 5 --latency 0.02 --lro-duration 0.5 [--json startup.json]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import arm_mock
+
+LAZY = ("numpy", "ijson", "asyncio")
+
+# runs in the child: stamps the start, imports the module, runs main() with the task args and prints the stamps
+DRIVER = '''
+import sys, time, json
+started = time.time()
+import ansible.module_utils
+ansible.module_utils.__path__.append(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+module = __import__(sys.argv[3])
+imported = time.time()
+from ansible.module_utils import anf_arm
+anf_arm.ARM_ENDPOINT = anf_arm.LOGIN_ENDPOINT = sys.argv[4]
+if hasattr(module, "METRICS_ENDPOINT"):
+	module.METRICS_ENDPOINT = sys.argv[4]
+#----- task args the way a module is started by hand: as json in argv[1] -----
+sys.argv = [sys.argv[3], json.dumps({"ANSIBLE_MODULE_ARGS": json.loads(sys.argv[5])})]
+stdout = sys.stdout
+sys.stdout = sys.stderr
+try:
+	module.main()
+except SystemExit:
+	pass
+sys.stdout = stdout
+print(json.dumps({"started": started, "imported": imported, "finished": time.time(), "modules": len(sys.modules), "lazy": [name for name in %r if name in sys.modules]}))
+''' % (LAZY,)
+
+# (module, state, task args on top of the common ones), in an order that leaves the mock with what the next state needs
+STATES = (
+	("anf_volume", "present", {"volname": "vol0", "volsize": 500}),
+	("anf_volume", "offline", {"volname": "vol0"}),
+	("anf_volume", "report", {}),
+	("anf_volume", "forecast", {}),
+	("anf_volume", "watch", {"watch_cycles": 1}),
+	("anf_volume", "compact", {}),
+	("anf_volume_backup", "setup", {"volname": "vol0"}),
+	("anf_volume_backup", "backup", {"volname": "vol0"}),
+	("anf_volume_backup", "restore", {"volname": "vol0"}),
+	("anf_volume", "absent", {"volname": "vol0"}),
+)
+
+
+def task_args(cache_dir, module, state, extra):
+	args = {
+		'tenant': 'bench', 'subscription_id': 'bench', 'client_id': 'bench', 'secret': 'bench',
+		'resource_group': 'bench', 'accountname': 'bench0', 'sku': 'Standard', 'state': state,
+		'token_cache': False, 'cache_dir': cache_dir,
+	}
+	if module == "anf_volume":
+		args.update({'resource_group_net': 'bench', 'virtualnetwork': 'vnet'})
+	args.update(extra)
+	return args
+
+
+def run_state(mock, url, cache_dir, module, state, extra):
+	mock.reset_counters()
+	process = subprocess.run([sys.executable, "-c", DRIVER, os.path.join(REPO_DIR, "module_utils"), REPO_DIR, module, url, json.dumps(task_args(cache_dir, module, state, extra))], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stamps = json.loads(process.stdout.decode("utf-8").strip().splitlines()[-1])
+	return {
+		"import_seconds": stamps["imported"] - stamps["started"],
+		"first_request_seconds": (mock.first_request - stamps["started"]) if mock.first_request else None,
+		"total_seconds": stamps["finished"] - stamps["started"],
+		"modules": stamps["modules"],
+		"lazy": stamps["lazy"],
+	}
+
+
+def median(values):
+	values = sorted(value for value in values if value is not None)
+	return round(values[len(values) // 2], 4) if len(values) != 0 else None
+
+
+def startup(args):
+	results = []
+	runs = dict((state, []) for module, state, extra in STATES)
+	for repeat in range(args.repeat):
+		mock = arm_mock.ArmMock(latency=args.latency, lro_duration=args.lro_duration)
+		server, url = arm_mock.serve(mock)
+		cache_dir = tempfile.mkdtemp(prefix="anf_startup_")
+		for module, state, extra in STATES:
+			if state in args.states:
+				runs[state].append(run_state(mock, url, cache_dir, module, state, extra))
+		server.shutdown()
+		server.server_close()
+
+	for module, state, extra in STATES:
+		if len(runs[state]) == 0:
+			continue
+		results.append({
+			"module": module,
+			"state": state,
+			"import_seconds": median([run["import_seconds"] for run in runs[state]]),
+			"first_request_seconds": median([run["first_request_seconds"] for run in runs[state]]),
+			"total_seconds": median([run["total_seconds"] for run in runs[state]]),
+			"modules": runs[state][-1]["modules"],
+			"lazy": runs[state][-1]["lazy"],
+		})
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="anf module startup benchmark against the local arm mock")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--states", default=",".join(state for module, state, extra in STATES))
+	parser.add_argument("--latency", type=float, default=0.02)
+	parser.add_argument("--lro-duration", type=float, default=0.5)
+	parser.add_argument("--json", default=None, help="write the results to this file as well")
+	args = parser.parse_args()
+	args.states = args.states.split(",")
+
+	results = startup(args)
+
+	print("%-18s %-9s %9s %14s %9s %8s  %s" % ("module", "state", "import", "first request", "total", "modules", "lazy loaded"))
+	for result in results:
+		first = "%.3f" % result["first_request_seconds"] if result["first_request_seconds"] is not None else "-"
+		print("%-18s %-9s %9.3f %14s %9.3f %8d  %s" % (result["module"], result["state"], result["import_seconds"], first, result["total_seconds"], result["modules"], ",".join(result["lazy"]) or "-"))
+
+	if args.json:
+		with open(args.json, "w") as output:
+			json.dump(results, output, indent=2)
+
+
+
+if __name__ == '__main__':
+	main()
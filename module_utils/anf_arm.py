@@ -0,0 +1,1099 @@
+# anf_arm: code shared by anf_volume and anf_volume_backup - pooled arm client, oauth tokens, long running operation
+# polling, read caches, rate limiting, capacity pool sizing and the fleet engine. ansible ships it with every module
+# that imports it.
+#
+# only what every state needs is imported here. ijson, asyncio and the modules' numpy are loaded on first use, so a
+# state that does not stream large lists or run a fleet does not pay for them.
+
+import requests
+import concurrent.futures
+import importlib
+import threading
+import hashlib
+import fcntl
+import os
+import json
+import time
+import math
+import random
+
+
+
+#######################################################################################################################################################################################################
+############################## ARM CLIENT #############################################################################################################################################################
+
+
+
+ARM_ENDPOINT = "https://management.azure.com"
+LOGIN_ENDPOINT = "https://login.microsoftonline.com"
+CACHE_DIR = "~/.ansible/anf_cache"
+TOKEN_REFRESH_AHEAD = 300 # seconds before expiry a token gets renewed
+MANAGEMENT_RESOURCE = "https://management.core.windows.net"
+
+
+_lazy_modules = {}
+
+def lazy_import(name):
+	#----- import an optional package on first use, None if it is not installed -----
+	if name not in _lazy_modules:
+		try:
+			_lazy_modules[name] = importlib.import_module(name)
+		except ImportError:
+			_lazy_modules[name] = None
+	return _lazy_modules[name]
+
+
+class TokenManager(object):
+	# oauth client credential tokens cached per tenant/client_id in a 0600 file below cache_dir. the file is locked
+	# while it gets read or renewed, so parallel ansible forks share one token instead of each fetching their own.
+
+	def __init__(self, data, session, resource=MANAGEMENT_RESOURCE):
+		self.data = data
+		self.session = session
+		self.resource = resource
+		self.tokeninfo = None
+		self.lock = threading.Lock()
+
+		self.cachefile = None
+		if data.get('token_cache', True):
+			cachedir = os.path.expanduser(data.get('cache_dir') or CACHE_DIR)
+			cachekey = data['tenant']+"/"+data['client_id']
+			if resource != MANAGEMENT_RESOURCE:
+				cachekey = cachekey+"/"+resource
+			cachekey = hashlib.sha256(cachekey.encode("utf-8")).hexdigest()[:32]
+			self.cachefile = os.path.join(cachedir, "token-"+cachekey+".json")
+
+	def expiring(self, tokeninfo=None):
+		tokeninfo = tokeninfo or self.tokeninfo
+		if not tokeninfo:
+			return True
+		return int(tokeninfo.get('expires_on', 0)) - TOKEN_REFRESH_AHEAD < time.time()
+
+	def token(self):
+		with self.lock:
+			if not self.expiring():
+				return (200, self.tokeninfo)
+
+			if self.cachefile is None:
+				return self.fetch()
+
+			#----- one fork renews, the others wait for the lock and read the fresh token from the file -----
+			cachedir = os.path.dirname(self.cachefile)
+			if not os.path.isdir(cachedir):
+				os.makedirs(cachedir, 0o700)
+			lockfile = open(self.cachefile+".lock", "a")
+			try:
+				fcntl.flock(lockfile, fcntl.LOCK_EX)
+				try:
+					with open(self.cachefile) as cached:
+						tokeninfo = json.load(cached)
+					if not self.expiring(tokeninfo):
+						self.tokeninfo = tokeninfo
+						return (200, tokeninfo)
+				except (IOError, OSError, ValueError):
+					pass
+
+				token_status, tokeninfo = self.fetch()
+				if token_status == 200 and tokeninfo.get('token_type') == "Bearer":
+					tmpfile = self.cachefile+"."+str(os.getpid())
+					fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+					with os.fdopen(fd, "w") as cached:
+						json.dump(tokeninfo, cached)
+					os.rename(tmpfile, self.cachefile)
+				return (token_status, tokeninfo)
+			finally:
+				fcntl.flock(lockfile, fcntl.LOCK_UN)
+				lockfile.close()
+
+	def fetch(self):
+		api_url = LOGIN_ENDPOINT+"/"+self.data['tenant']+"/oauth2/token"
+		body = "grant_type=client_credentials&client_id="+self.data['client_id']+"&client_secret="+self.data['secret']+"&resource="+self.resource
+		headers = {
+			'content-type': 'application/x-www-form-urlencoded'
+		}
+		token = self.session.get(api_url, data=body, headers=headers)
+		tokeninfo = token.json()
+
+		if token.status_code == 200 and tokeninfo.get('token_type') == "Bearer":
+			#----- v1 endpoint sends expires_on, fall back to expires_in -----
+			if not tokeninfo.get('expires_on'):
+				tokeninfo['expires_on'] = int(time.time()) + int(tokeninfo.get('expires_in', 0))
+			self.tokeninfo = tokeninfo
+
+		return (token.status_code, tokeninfo)
+
+
+class ResultCache(object):
+	# json results (e.g. metrics) cached below cache_dir for ttl seconds, one 0600 file per key, so the following tasks
+	# of a play reuse them. ttl 0 switches the cache off.
+
+	def __init__(self, data, name, ttl):
+		self.name = name
+		self.ttl = ttl or 0
+		self.memory = {}
+		self.cachedir = None
+		if data.get('cache_dir') and self.ttl > 0:
+			self.cachedir = os.path.expanduser(data['cache_dir'])
+
+	def path(self, key):
+		return os.path.join(self.cachedir, self.name+"-"+hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]+".json")
+
+	def get(self, key):
+		if self.ttl <= 0:
+			return None
+		entry = self.memory.get(key)
+		if entry is None and self.cachedir is not None:
+			try:
+				with open(self.path(key)) as cached:
+					entry = json.load(cached)
+			except (IOError, OSError, ValueError):
+				entry = None
+		if entry is None or entry.get("expires", 0) < time.time():
+			return None
+		self.memory[key] = entry
+		return entry["value"]
+
+	def put(self, key, value):
+		if self.ttl <= 0:
+			return
+		entry = {"expires": time.time() + self.ttl, "value": value}
+		self.memory[key] = entry
+		if self.cachedir is None:
+			return
+		try:
+			if not os.path.isdir(self.cachedir):
+				os.makedirs(self.cachedir, 0o700)
+			tmpfile = self.path(key)+"."+str(os.getpid())+"."+str(threading.current_thread().ident)
+			fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+			with os.fdopen(fd, "w") as cached:
+				json.dump(entry, cached)
+			os.rename(tmpfile, self.path(key))
+		except (IOError, OSError):
+			pass
+
+
+def resource_key(api_url):
+	#----- cache key of a resource url: path case-insensitive like arm, query (api-version) as it is -----
+	path, _, query = api_url.partition("?")
+	return path.lower().rstrip("/")+"?"+query
+
+
+def affected_keys(keys, api_url):
+	#----- keys a mutation of api_url makes stale: the resource, its children and the collection it is listed in -----
+	path = resource_key(api_url).partition("?")[0]
+	return [key for key in keys if key.partition("?")[0] in (path, path.rpartition("/")[0]) or key.startswith(path+"/")]
+
+
+class ResourceSnapshot(object):
+	# state of all resources read in one run, from single GETs, list items and finished long running operations.
+	# later reads of the same url are answered from here until the run changes the resource, so they cost no request.
+
+	def __init__(self):
+		self.resources = {}
+		self.lock = threading.Lock()
+		self.saved = 0
+
+	def lookup(self, api_url):
+		with self.lock:
+			body = self.resources.get(resource_key(api_url))
+			if body is not None:
+				self.saved += 1
+			return body
+
+	def store(self, api_url, body):
+		with self.lock:
+			self.resources[resource_key(api_url)] = body
+
+	def invalidate(self, api_url):
+		with self.lock:
+			for key in affected_keys(self.resources, api_url):
+				del self.resources[key]
+
+
+ETAG_MAX_BODY = 1048576 # list pages up to this size are read at once to be cached, larger ones stay streamed
+
+
+class EtagCache(object):
+	# last body and ETag per resource url of one account in a 0600 file below cache_dir. reads send If-None-Match and a
+	# 304 reuses the cached body. any mutation drops the entries of the resource, its children and its collection.
+
+	def __init__(self, data):
+		self.enabled = data.get('etag_cache', True)
+		self.entries = None
+		self.lock = threading.Lock()
+		self.cachefile = None
+		if self.enabled and data.get('cache_dir'):
+			cachekey = hashlib.sha256((data['subscription_id']+"/"+data['resource_group']+"/"+data['accountname']).encode("utf-8")).hexdigest()[:32]
+			self.cachefile = os.path.join(os.path.expanduser(data['cache_dir']), "etag-"+cachekey+".json")
+
+	def load(self):
+		if self.entries is None:
+			self.entries = {}
+			if self.cachefile is not None:
+				try:
+					with open(self.cachefile) as cached:
+						self.entries = json.load(cached)
+				except (IOError, OSError, ValueError):
+					pass
+		return self.entries
+
+	def save(self):
+		if self.cachefile is None:
+			return
+		try:
+			cachedir = os.path.dirname(self.cachefile)
+			if not os.path.isdir(cachedir):
+				os.makedirs(cachedir, 0o700)
+			tmpfile = self.cachefile+"."+str(os.getpid())+"."+str(threading.current_thread().ident)
+			fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+			with os.fdopen(fd, "w") as cached:
+				json.dump(self.entries, cached)
+			os.rename(tmpfile, self.cachefile)
+		except (IOError, OSError):
+			pass
+
+	def lookup(self, api_url):
+		if not self.enabled:
+			return None
+		with self.lock:
+			return self.load().get(resource_key(api_url))
+
+	def store(self, api_url, etag, body):
+		if not self.enabled:
+			return
+		with self.lock:
+			self.load()[resource_key(api_url)] = {"etag": etag, "body": body}
+			self.save()
+
+	def invalidate(self, api_url):
+		if not self.enabled:
+			return
+		with self.lock:
+			entries = self.load()
+			dropped = affected_keys(entries, api_url)
+			for key in dropped:
+				del entries[key]
+			if len(dropped) != 0:
+				self.save()
+
+
+def update_state_file(path, change, fallback):
+	#----- change(state, now) on the json state in path under an exclusive flock, shared by all processes of this host.
+	# returns the result of change. if the file can not be opened, fallback (a process local dict) is changed instead -----
+	try:
+		cachedir = os.path.dirname(path)
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir, 0o700)
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+	except (IOError, OSError):
+		return change(fallback, time.time())
+	with os.fdopen(fd, "r+") as statefile:
+		fcntl.flock(statefile, fcntl.LOCK_EX)
+		try:
+			state = json.loads(statefile.read() or "{}")
+		except ValueError:
+			state = {}
+		result = change(state, time.time())
+		statefile.seek(0)
+		statefile.truncate()
+		json.dump(state, statefile)
+		return result
+
+
+#----- arm throttling per subscription: (bucket size, refill per second) for reads/writes/deletes -----
+RATE_LIMITS = {
+	"reads": (250, 25.0),
+	"writes": (200, 10.0),
+	"deletes": (200, 10.0),
+}
+RATE_KINDS = {"GET": "reads", "DELETE": "deletes"}
+RETRY_MAX_DELAY = 60 # seconds
+
+
+class RateLimiter(object):
+	# token bucket per subscription and request kind, shared by all forks on this host through a locked state file in
+	# cache_dir. x-ms-ratelimit-remaining-subscription-* lowers the bucket, so calls slow down before arm throttles, and a
+	# 429/503 Retry-After pauses every process of the subscription, not only the one that got it.
+
+	def __init__(self, data):
+		self.lock = threading.Lock()
+		self.state = {}
+		self.statefile = None
+		if data.get('cache_dir'):
+			cachekey = hashlib.sha256(data['subscription_id'].encode("utf-8")).hexdigest()[:32]
+			self.statefile = os.path.join(os.path.expanduser(data['cache_dir']), "ratelimit-"+cachekey+".json")
+
+	def update(self, change):
+		#----- change(state, now) under the thread lock and the file lock of all processes, returns its result -----
+		with self.lock:
+			if self.statefile is None:
+				return change(self.state, time.time())
+			return update_state_file(self.statefile, change, self.state)
+
+	def bucket(self, state, kind, now):
+		size, rate = RATE_LIMITS[kind]
+		bucket = state.setdefault(kind, {"tokens": size, "stamp": now})
+		bucket["tokens"] = min(size, bucket["tokens"] + (now - bucket["stamp"]) * rate)
+		bucket["stamp"] = now
+		return bucket
+
+	def acquire(self, kind):
+		#----- takes one token, or returns the seconds to wait for the next one -----
+		def take(state, now):
+			blocked = state.get("blocked_until", 0) - now
+			if blocked > 0:
+				return blocked
+			bucket = self.bucket(state, kind, now)
+			if bucket["tokens"] >= 1:
+				bucket["tokens"] -= 1
+				return 0
+			return (1 - bucket["tokens"]) / RATE_LIMITS[kind][1]
+		return self.update(take)
+
+	def observe(self, kind, httpreturn):
+		#----- arm's own count wins once it is below our bucket size -----
+		remaining = httpreturn.headers.get("x-ms-ratelimit-remaining-subscription-"+kind)
+		if not remaining or not remaining.isdigit() or int(remaining) >= RATE_LIMITS[kind][0]:
+			return
+
+		def lower(state, now):
+			bucket = self.bucket(state, kind, now)
+			bucket["tokens"] = min(bucket["tokens"], int(remaining))
+		self.update(lower)
+
+	def throttled(self, seconds):
+		def block(state, now):
+			state["blocked_until"] = max(state.get("blocked_until", 0), now + seconds)
+		self.update(block)
+
+
+LRO_FIRST_INTERVAL = 1 # seconds
+LRO_MAX_INTERVAL = 30
+LRO_TIMEOUT = 1800
+
+
+class LroPoller(object):
+	# waits for one long running arm operation. follows the Azure-AsyncOperation (or Location) url, then confirms the
+	# resource itself is Succeeded (or gone after a delete). starts with a short interval and doubles it with jitter up to
+	# LRO_MAX_INTERVAL, a Retry-After header from azure wins. gives up at the deadline instead of looping forever.
+
+	def __init__(self, client, timeout=None):
+		self.client = client
+		self.timeout = timeout or LRO_TIMEOUT
+
+	def wait(self, httpreturn, resource_url=None, deleted=False):
+		self.deadline = time.time() + self.timeout
+		self.interval = LRO_FIRST_INTERVAL
+		self.resource = resource_url or httpreturn.url
+		returndata = {}
+
+		#----- operation status -----
+		asyncurl = httpreturn.headers.get("Azure-AsyncOperation")
+		locationurl = httpreturn.headers.get("Location")
+		if asyncurl:
+			httpreturn = self.client.poll(asyncurl, self.resource)
+			while True:
+				returndata = self.json(httpreturn)
+				if returndata.get("status") == "Succeeded":
+					break
+				if returndata.get("status") in ("Failed", "Canceled"):
+					return ("Failed", returndata)
+				if not self.sleep(httpreturn):
+					return ("Timeout", returndata)
+				httpreturn = self.client.poll(asyncurl, self.resource)
+		elif locationurl and httpreturn.status_code == 202:
+			httpreturn = self.client.poll(locationurl, self.resource)
+			while httpreturn.status_code == 202:
+				if not self.sleep(httpreturn):
+					return ("Timeout", returndata)
+				httpreturn = self.client.poll(locationurl, self.resource)
+			returndata = self.json(httpreturn)
+
+		if resource_url is None:
+			return ("Succeeded", returndata)
+
+		#----- resource state: provisioningState "Succeeded" or not found any more -----
+		self.interval = LRO_FIRST_INTERVAL
+		while True:
+			httpreturn = self.client.poll(resource_url, self.resource)
+			returndata = self.json(httpreturn)
+			if deleted:
+				if httpreturn.status_code == 404 or (httpreturn.status_code != 200 and "not found" in httpreturn.text):
+					return ("Succeeded", returndata)
+			else:
+				state = returndata.get("properties", {}).get("provisioningState")
+				if state == "Succeeded":
+					return ("Succeeded", returndata)
+				if state in ("Failed", "Canceled"):
+					return ("Failed", returndata)
+			if not self.sleep(httpreturn):
+				return ("Timeout", returndata)
+
+	def sleep(self, httpreturn):
+		delay = self.interval * random.uniform(0.8, 1.2)
+		self.interval = min(self.interval * 2, LRO_MAX_INTERVAL)
+		retryafter = httpreturn.headers.get("Retry-After")
+		if retryafter and retryafter.isdigit():
+			delay = int(retryafter)
+
+		remaining = self.deadline - time.time()
+		if remaining <= 0:
+			return False
+		started = time.time()
+		time.sleep(min(delay, remaining))
+		self.client.span("sleep", "", self.resource, None, started)
+		return True
+
+	def json(self, httpreturn):
+		try:
+			returndata = httpreturn.json()
+		except ValueError:
+			return {}
+		return returndata if isinstance(returndata, dict) else {}
+
+
+#----- resource type in an arm url -> phase in the timings totals -----
+TIMING_PHASES = {
+	"token": "auth",
+	"netappaccounts": "account",
+	"snapshotpolicies": "account",
+	"backuppolicies": "account",
+	"vaults": "account",
+	"capacitypools": "pool",
+	"volumes": "volume",
+	"metrics": "volume",
+	"snapshots": "snapshot",
+	"backups": "backup",
+}
+
+
+class TimingTrace(object):
+	# opt-in (timings: true) record of every http call, lro poll and sleep of one client. phase is taken from the
+	# resource type unless a state function set one for the current thread (e.g. "retention").
+
+	def __init__(self):
+		self.started = time.time()
+		self.spans = []
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def resource_type(self, api_url):
+		segments = api_url.split("?")[0].rstrip("/").split("/")
+		for segment in reversed(segments):
+			if segment.lower() in TIMING_PHASES:
+				return segment
+		if "operationResults" in segments:
+			return "operationResults"
+		return segments[-1]
+
+	def add(self, kind, method, api_url, status, started, retries=0):
+		resource = self.resource_type(api_url)
+		span = {
+			"kind": kind,
+			"method": method,
+			"resource": resource,
+			"phase": getattr(self.local, "phase", None) or TIMING_PHASES.get(resource.lower(), "other"),
+			"status": status,
+			"start": round(started - self.started, 3),
+			"seconds": round(time.time() - started, 3),
+			"retries": retries,
+		}
+		with self.lock:
+			self.spans.append(span)
+
+	def summary(self):
+		totals = {}
+		for span in self.spans:
+			total = totals.setdefault(span["phase"], {"seconds": 0.0, "calls": 0, "polls": 0, "sleeps": 0, "sleep_seconds": 0.0, "retries": 0})
+			if span["kind"] == "sleep":
+				total["sleeps"] += 1
+				total["sleep_seconds"] += span["seconds"]
+			else:
+				total["calls" if span["kind"] != "poll" else "polls"] += 1
+				total["seconds"] += span["seconds"]
+			#----- the span of an attempt carries how many retries of the call came before it, each retry counts once -----
+			total["retries"] += 1 if span["retries"] else 0
+		for total in totals.values():
+			total["seconds"] = round(total["seconds"], 3)
+			total["sleep_seconds"] = round(total["sleep_seconds"], 3)
+		return {"wall_seconds": round(time.time() - self.started, 3), "totals": totals, "spans": self.spans}
+
+
+class ArmClient(object):
+	# one pooled requests session for a whole module run. all calls against login/management endpoints reuse the
+	# same keep-alive connections, and the anf urls and the authorization header are built only here.
+
+	def __init__(self, data, api_version):
+		self.data = data
+		self.api_version = api_version
+		self.headers = {
+			'content-type': 'application/json'
+		}
+
+		self.session = arm_session(data)
+		self.tokens = token_manager(data, self.session)
+		self.limiter = rate_limiter(data)
+		self.etags = EtagCache(data)
+		self.snapshot = ResourceSnapshot()
+		self.sent = 0
+		self.not_modified = 0
+
+		#----- additional result keys of this run, handed to exit_json next to msg -----
+		self.results = {}
+		self.trace = TimingTrace() if data.get('timings') else None
+
+	def login(self):
+		started = time.time()
+		token_status, tokeninfo = self.tokens.token()
+		self.span("token", "GET", "/oauth2/token", token_status, started)
+		if token_status == 200 and tokeninfo.get('token_type') == "Bearer":
+			self.headers['Authorization'] = tokeninfo['token_type']+' '+tokeninfo['access_token']
+		return (token_status, tokeninfo)
+
+	def authorize(self):
+		#----- refresh ahead: renew the header before the token runs out during long waits -----
+		if 'Authorization' in self.headers and self.tokens.expiring():
+			self.login()
+
+	#----- url builder -----
+	def account_url(self, path="", api_version=None):
+		return ARM_ENDPOINT+"/subscriptions/"+self.data['subscription_id']+"/resourceGroups/"+self.data['resource_group']+"/providers/Microsoft.NetApp/netAppAccounts/"+self.data['accountname']+path+"?api-version="+(api_version or self.api_version)
+
+	def pool_url(self, capacitypool, path="", api_version=None):
+		return self.account_url("/capacityPools/"+capacitypool+path, api_version)
+
+	def volume_url(self, capacitypool, volname, path="", api_version=None):
+		return self.pool_url(capacitypool, "/volumes/"+volname+path, api_version)
+
+	def resource_url(self, resource_id, api_version=None):
+		return ARM_ENDPOINT+"/"+resource_id.lstrip("/")+"?api-version="+(api_version or self.api_version)
+
+	#----- http calls -----
+	def request(self, method, api_url, body_raw=None, stream=False, kind="http", resource_url=None, headers=None, tokens=None, read=False):
+		#----- tokens: token manager of another endpoint (azure monitor), its bearer replaces the arm one for this call and
+		# is renewed ahead like it. read: a POST that only reads (metrics:getBatch), rate limited and retried like a GET -----
+		read = read or method == "GET"
+		if not read:
+			self.snapshot.invalidate(api_url)
+			self.etags.invalidate(api_url)
+		ratekind = "reads" if read else RATE_KINDS.get(method, "writes")
+		retries = 0
+
+		while True:
+			self.throttle(ratekind, resource_url or api_url)
+			self.authorize()
+			started = time.time()
+			requestheaders = dict(self.headers, **headers) if headers else self.headers
+			if tokens is not None:
+				token_status, tokeninfo = tokens.token()
+				if token_status == 200 and tokeninfo.get('token_type') == "Bearer":
+					requestheaders = dict(requestheaders, Authorization=tokeninfo['token_type']+' '+tokeninfo['access_token'])
+			self.sent += 1
+			if body_raw is None:
+				httpreturn = self.session.request(method, api_url, headers=requestheaders, stream=stream)
+			else:
+				httpreturn = self.session.request(method, api_url, data=json.dumps(body_raw), headers=requestheaders, stream=stream)
+			self.span(kind, method, resource_url or api_url, httpreturn.status_code, started, retries)
+
+			#----- 429 always, 503 not for a writing POST (may have run) is retried after Retry-After or an exponential backoff -----
+			if self.limiter is not None:
+				self.limiter.observe(ratekind, httpreturn)
+			if httpreturn.status_code not in (429, 503) or (httpreturn.status_code == 503 and method == "POST" and not read) or retries >= self.data.get('max_retries', 5):
+				return httpreturn
+			retryafter = httpreturn.headers.get("Retry-After")
+			delay = int(retryafter) if retryafter and retryafter.isdigit() else min(2 ** retries, RETRY_MAX_DELAY) * random.uniform(0.8, 1.2)
+			if self.limiter is not None:
+				self.limiter.throttled(delay)
+			else:
+				self.backoff(delay, resource_url or api_url)
+			httpreturn.close()
+			retries += 1
+
+	def throttle(self, ratekind, api_url):
+		#----- wait until the shared bucket hands out a token for this request -----
+		while self.limiter is not None:
+			delay = self.limiter.acquire(ratekind)
+			if delay <= 0:
+				return
+			self.backoff(delay, api_url)
+
+	def backoff(self, delay, api_url):
+		started = time.time()
+		time.sleep(min(delay, RETRY_MAX_DELAY))
+		self.span("sleep", "", api_url, None, started)
+
+	def poll(self, api_url, resource_url=None):
+		#----- one status poll of a long running operation, traced against the resource it waits for -----
+		httpreturn = self.request("GET", api_url, kind="poll", resource_url=resource_url)
+		if httpreturn.status_code == 200 and api_url == resource_url and '"Succeeded"' in httpreturn.text:
+			self.snapshot.store(api_url, httpreturn.text)
+			if httpreturn.headers.get("ETag"):
+				self.etags.store(api_url, httpreturn.headers["ETag"], httpreturn.text)
+		return httpreturn
+
+	#----- timings -----
+	def span(self, kind, method, api_url, status, started, retries=0):
+		if self.trace is not None:
+			self.trace.add(kind, method, api_url, status, started, retries)
+
+	def phase(self, phase):
+		#----- phase for the following calls of this thread in the timings totals, None = by resource type -----
+		if self.trace is not None:
+			self.trace.local.phase = phase
+
+	def phased(self, fn):
+		#----- fn for a worker thread, counted under the phase of the calling thread: phase() holds only for its own thread -----
+		phase = getattr(self.trace.local, "phase", None) if self.trace is not None else None
+
+		def run(*args):
+			self.phase(phase)
+			try:
+				return fn(*args)
+			finally:
+				self.phase(None)
+		return run
+
+	def get(self, api_url):
+		#----- resources already read in this run come from the snapshot, all others from a conditional GET -----
+		body = self.snapshot.lookup(api_url)
+		if body is not None:
+			return self.cached(body, api_url)
+		httpreturn = self.conditional(api_url)
+		if httpreturn.status_code == 200:
+			self.snapshot.store(api_url, httpreturn.text)
+		return httpreturn
+
+	def cached(self, body, api_url, httpreturn=None):
+		#----- a 200 answer with a body known already, for the snapshot and etag cache -----
+		if not isinstance(body, str):
+			body = json.dumps(body)
+		cached = requests.models.Response()
+		cached.status_code = 200
+		cached._content = body.encode("utf-8")
+		cached._content_consumed = True
+		cached.encoding = "utf-8"
+		cached.url = api_url
+		if httpreturn is not None:
+			cached.headers = httpreturn.headers
+			cached.request = httpreturn.request
+		cached.from_cache = True
+		return cached
+
+	def conditional(self, api_url, stream=False):
+		#----- GET with If-None-Match from the etag cache, a 304 is answered with the cached body as a 200 -----
+		entry = self.etags.lookup(api_url)
+		if entry is None:
+			httpreturn = self.request("GET", api_url, stream=stream)
+		else:
+			httpreturn = self.request("GET", api_url, stream=stream, headers={'If-None-Match': entry["etag"]})
+
+		if httpreturn.status_code == 304 and entry is not None:
+			self.not_modified += 1
+			return self.cached(entry["body"], api_url, httpreturn)
+
+		etag = httpreturn.headers.get("ETag")
+		if httpreturn.status_code == 200 and etag:
+			if not stream or int(httpreturn.headers.get("Content-Length") or ETAG_MAX_BODY + 1) <= ETAG_MAX_BODY:
+				self.etags.store(api_url, etag, httpreturn.text)
+		return httpreturn
+
+	def put(self, api_url, body_raw):
+		return self.request("PUT", api_url, body_raw)
+
+	def patch(self, api_url, body_raw):
+		return self.request("PATCH", api_url, body_raw)
+
+	def post(self, api_url, body_raw=None):
+		return self.request("POST", api_url, body_raw)
+
+	def delete(self, api_url):
+		return self.request("DELETE", api_url)
+
+	#----- list calls -----
+	def list(self, api_url):
+		#----- returns (first httpreturn, lazy iterator over "value" of all pages) -----
+		# the first page is requested right away so callers can check the status code as before. the iterator follows
+		# nextLink only when the previous page is consumed and parses each page streamed, so memory stays one item.
+		httpreturn = self.conditional(api_url, stream=True)
+		if httpreturn.status_code != 200:
+			return (httpreturn, iter(()))
+		return (httpreturn, self.pages(httpreturn, api_url.partition("?")[2]))
+
+	def pages(self, httpreturn, query):
+		#----- every listed item goes into the snapshot, so a GET of it later in this run is free -----
+		while True:
+			page = {}
+			for item in self.items(httpreturn, page):
+				if item.get("id"):
+					self.snapshot.store(ARM_ENDPOINT+item["id"]+"?"+query, item)
+				yield item
+			if not page.get("nextLink"):
+				return
+			httpreturn = self.request("GET", page["nextLink"], stream=True)
+			if httpreturn.status_code != 200:
+				httpreturn.raise_for_status()
+
+	def items(self, httpreturn, page):
+		#----- items of one page, nextLink is stored in page -----
+		ijson = lazy_import("ijson")
+		if ijson is None or httpreturn._content_consumed:
+			returndata = httpreturn.json()
+			page["nextLink"] = returndata.get("nextLink")
+			for item in returndata.get("value", []):
+				yield item
+			return
+
+		httpreturn.raw.decode_content = True
+		builder = None
+		#----- floats as float, not Decimal: the items go into the run snapshot and are json dumped again from there -----
+		for prefix, event, value in ijson.parse(httpreturn.raw, use_float=True):
+			if builder is None and prefix == "value.item" and event == "start_map":
+				builder = ijson.common.ObjectBuilder()
+			if builder is not None:
+				builder.event(event, value)
+				if prefix == "value.item" and event == "end_map":
+					yield builder.value
+					builder = None
+			elif prefix == "nextLink" and event == "string":
+				page["nextLink"] = value
+
+	def wait(self, httpreturn, resource_url=None, deleted=False, timeout=None):
+		#----- returns ("Succeeded"|"Failed"|"Timeout", last json body) -----
+		return LroPoller(self, timeout or self.data.get('lro_timeout')).wait(httpreturn, resource_url, deleted)
+
+
+_arm_session = None
+_token_managers = {}
+_rate_limiters = {}
+_arm_clients = {}
+_registry_lock = threading.RLock()
+
+def arm_session(data):
+	#----- one pooled session per run: one pool per host, http_pool_size parallel connections per host -----
+	global _arm_session
+	with _registry_lock:
+		if _arm_session is None:
+			_arm_session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=data.get('http_pool_size') or 10)
+			_arm_session.mount("https://", adapter)
+			_arm_session.mount("http://", adapter)
+		return _arm_session
+
+
+def token_manager(data, session, resource=MANAGEMENT_RESOURCE):
+	#----- one token per tenant/client_id and resource, shared by all clients of this run -----
+	with _registry_lock:
+		key = (data['tenant'], data['client_id'], resource)
+		if key not in _token_managers:
+			_token_managers[key] = TokenManager(data, session, resource)
+		return _token_managers[key]
+
+
+def rate_limiter(data):
+	#----- one limiter per subscription in this process, None with rate_limit: false -----
+	if not data.get('rate_limit', True):
+		return None
+	with _registry_lock:
+		if data['subscription_id'] not in _rate_limiters:
+			_rate_limiters[data['subscription_id']] = RateLimiter(data)
+		return _rate_limiters[data['subscription_id']]
+
+
+def arm_client(data, api_version=None):
+	#----- one client per parameter set (the module params, or one fleet item). state functions called again with the
+	# same data get the same client and its results, all clients talk through the same session. api_version is the
+	# default of the calling module, the fleet engine only keeps its results in the client -----
+	with _registry_lock:
+		client = _arm_clients.get(id(data))
+		if client is None:
+			client = ArmClient(data, api_version)
+			_arm_clients[id(data)] = client
+	return client
+
+
+def run_results(data):
+	client = _arm_clients.get(id(data))
+	if client is None:
+		return {}
+	if client.trace is not None:
+		client.results["timings"] = client.trace.summary()
+	client.results["arm_requests"] = {"sent": client.sent, "saved": client.snapshot.saved, "not_modified": client.not_modified}
+	return client.results
+
+
+#----- capacity pool sizing and the pool lease, for every module that adds volumes to a pool -----
+TIB = 1099511627776
+MIN_POOL_SIZE = 4398046511104 # 4 TiB, smallest capacity pool
+
+
+def min_pool_size(poolused):
+	#----- tightest legal pool size for poolused bytes: whole TiB, at least 4 TiB -----
+	return max(MIN_POOL_SIZE, int(math.ceil(poolused / float(TIB)) * TIB))
+
+
+def pool_sizes(actualpoolsize, poolvolumes, requested):
+	#----- one pool size target for all requested volumes -----
+	# actualpoolsize: current pool size in bytes, None if the pool does not exist
+	# poolvolumes: {volname: usageThreshold} of all volumes in the pool, requested: {volname: usageThreshold}
+	# returns (poolsize, lowerpoolsize): grow to poolsize before the volume updates, shrink to lowerpoolsize after. 0 = no change.
+	if actualpoolsize is None:
+		#----- if capacity pool is not existing, check if volumes are larger than 4TB. If so, set vol size. Else set 4TB. -----
+		return (min_pool_size(sum(requested.values())), 0)
+
+	poolused = sum(poolvolumes.values())
+	poolfreespace = actualpoolsize - poolused
+	neededadditionalspace = 0
+	shrinking = False
+	for volname, volsizeraw in requested.items():
+		neededadditionalspace = neededadditionalspace + volsizeraw - poolvolumes.get(volname, 0)
+		if volname in poolvolumes and poolvolumes[volname] > volsizeraw:
+			shrinking = True
+
+	if poolfreespace < neededadditionalspace:
+		reallyneeded = neededadditionalspace - poolfreespace
+		poolincrease = int(math.ceil(reallyneeded / float(TIB)) * TIB)
+		return (actualpoolsize + poolincrease, 0)
+
+	if shrinking:
+		totalfree = poolfreespace - neededadditionalspace
+		if totalfree >= TIB:
+			pooldecrease = int(math.floor(totalfree / float(TIB)) * TIB)
+			lowerpoolsize = max(MIN_POOL_SIZE, actualpoolsize - pooldecrease)
+			if lowerpoolsize < actualpoolsize:
+				return (0, lowerpoolsize)
+
+	return (0, 0)
+
+
+def pool_volumes(client, capacitypool):
+	#----- all volumes of the pool in one list call. the items land in the run snapshot, so the GETs of single volumes that follow are free -----
+	# returns (is_failed, {volname: volume} or the error text): a failed list is no empty pool
+	api_url = client.pool_url(capacitypool, "/volumes")
+	httpreturn, volinfo = client.list(api_url)
+	if httpreturn.status_code != 200:
+		return (True, httpreturn.text)
+	try:
+		return (False, dict((i["name"].split('/')[2], i) for i in volinfo))
+	except requests.exceptions.RequestException as error:
+		return (True, str(error))
+
+
+class PoolCoordinator(object):
+	# coordinates all runs on this host that change one capacity pool: a lease (flock on a file in cache_dir) for pool
+	# resizes and a registry of the volume sizes every run is about to apply. the run holding the lease reads the pool
+	# fresh and resizes once for all registered needs, runs after it find the pool big enough and skip their pool PUT.
+
+	def __init__(self, data, capacitypool):
+		cachekey = hashlib.sha256((data['subscription_id']+"/"+data['resource_group']+"/"+data['accountname']+"/"+capacitypool).encode("utf-8")).hexdigest()[:32]
+		cachedir = os.path.expanduser(data['cache_dir'])
+		self.registryfile = os.path.join(cachedir, "pool-"+cachekey+".json")
+		self.leasefile = os.path.join(cachedir, "pool-"+cachekey+".lease")
+		self.runid = str(os.getpid())+"."+str(threading.current_thread().ident)+"."+str(time.time())
+		self.stale = 2 * (data.get('lro_timeout') or LRO_TIMEOUT)
+		self.window = data.get('pool_coalesce_window') or 0
+		self.fallback = {}
+		self.lease = None
+		self.stats = {"pending_runs": 0, "resized": 0, "covered": 0, "lease_wait_seconds": 0.0}
+
+	def register(self, needs):
+		#----- needs: {volname: usageThreshold} this run will apply. entries of crashed runs expire after 2x lro_timeout -----
+		def add(state, now):
+			for runid in [runid for runid, entry in state.items() if now - entry["stamp"] > self.stale]:
+				del state[runid]
+			state[self.runid] = {"stamp": now, "needs": needs}
+		update_state_file(self.registryfile, add, self.fallback)
+
+	def release(self):
+		def remove(state, now):
+			state.pop(self.runid, None)
+		update_state_file(self.registryfile, remove, self.fallback)
+
+	def pending(self):
+		#----- largest registered size per volume over all live runs -----
+		def merge(state, now):
+			needs = {}
+			for entry in state.values():
+				if now - entry["stamp"] <= self.stale:
+					for volname, volsizeraw in entry["needs"].items():
+						needs[volname] = max(needs.get(volname, 0), volsizeraw)
+			return (len(state), needs)
+		runs, needs = update_state_file(self.registryfile, merge, self.fallback)
+		self.stats["pending_runs"] = max(self.stats["pending_runs"], runs)
+		return needs
+
+	def lock(self):
+		started = time.time()
+		if not os.path.isdir(os.path.dirname(self.leasefile)):
+			os.makedirs(os.path.dirname(self.leasefile), 0o700)
+		self.lease = open(self.leasefile, "a")
+		fcntl.flock(self.lease, fcntl.LOCK_EX)
+		self.stats["lease_wait_seconds"] = round(self.stats["lease_wait_seconds"] + time.time() - started, 3)
+
+	def unlock(self):
+		fcntl.flock(self.lease, fcntl.LOCK_UN)
+		self.lease.close()
+		self.lease = None
+
+
+def pool_state(client, capacitypool):
+	#----- (is_failed, pool size, {volname: usageThreshold}) read fresh, not from this run's snapshot. size None if there is
+	# no pool, the error text instead of the volumes if pool or volumes could not be read -----
+	api_url = client.pool_url(capacitypool)
+	client.snapshot.invalidate(api_url)
+	httpreturn = client.get(api_url)
+	if httpreturn.status_code == 404:
+		return (False, None, {})
+	if httpreturn.status_code != 200:
+		return (True, None, httpreturn.text)
+	is_failed, volumes = pool_volumes(client, capacitypool)
+	if is_failed:
+		return (True, None, volumes)
+	return (False, httpreturn.json()["properties"]["size"], dict((volname, i["properties"]["usageThreshold"]) for volname, i in volumes.items()))
+
+
+def pool_step(client, data, coordinator, capacitypool, step):
+	#----- one pool step of a plan. with a coordinator the size is computed under the pool lease from the fresh pool and
+	# the needs of all concurrent runs, so one resize covers everybody and nobody resizes from a stale poolused -----
+	growing = step["action"] == "create" or step.get("ensure") or step["after"] > step["before"]
+	if coordinator is None:
+		return pool_put(client, data, capacitypool, step["after"], "created" if step["action"] == "create" else ("increased" if growing else "decreased"))
+
+	coordinator.lock()
+	try:
+		is_failed, poolsize, action = pool_target(client, coordinator, capacitypool, growing)
+		if not is_failed and poolsize != 0 and growing and coordinator.window > 0:
+			#----- a resize is due: give runs started at the same time the chance to register, so it covers them too -----
+			started = time.time()
+			time.sleep(coordinator.window)
+			client.span("sleep", "", client.pool_url(capacitypool), None, started)
+			is_failed, poolsize, action = pool_target(client, coordinator, capacitypool, growing)
+		if is_failed:
+			return (True, False, {"capacity pool "+capacitypool+" could not be read: "+action})
+		if poolsize == 0:
+			coordinator.stats["covered"] += 1
+			return (False, False, {"capacity pool size covered"})
+		coordinator.stats["resized"] += 1
+		return pool_put(client, data, capacitypool, poolsize, action)
+	finally:
+		coordinator.unlock()
+
+
+def pool_shrink(client, data, capacitypool, actualpoolsize, lowerpoolsize):
+	#----- decrease a pool outside of a plan (compact, absent), under the pool lease like present: never below what a
+	# concurrent run on this host registered. returns (is_failed, has_changed, meta, coalescing stats or None) -----
+	coordinator = None
+	if data.get('pool_lease', True) and data.get('cache_dir'):
+		coordinator = PoolCoordinator(data, capacitypool)
+	step = {"action": "resize", "type": "pool", "name": capacitypool, "before": actualpoolsize, "after": lowerpoolsize}
+	is_failed, has_changed, meta = pool_step(client, data, coordinator, capacitypool, step)
+	return (is_failed, has_changed, meta, coordinator.stats if coordinator is not None else None)
+
+
+def pool_target(client, coordinator, capacitypool, growing):
+	#----- (is_failed, poolsize, action or error text) from the fresh pool and the needs of all live runs, poolsize 0 = nothing
+	# to do. call with the lease held -----
+	is_failed, actualpoolsize, poolvolumes = pool_state(client, capacitypool)
+	if is_failed:
+		return (True, 0, poolvolumes)
+	pending = coordinator.pending()
+	if growing:
+		needs = dict((volname, volsizeraw) for volname, volsizeraw in pending.items() if volsizeraw > poolvolumes.get(volname, 0))
+		poolsize, lowerpoolsize = pool_sizes(actualpoolsize, poolvolumes, needs)
+		return (False, poolsize, "created" if actualpoolsize is None else "increased")
+	#----- never below what a concurrent run still has to apply -----
+	needed = sum(max(poolvolumes.get(volname, 0), pending.get(volname, 0)) for volname in set(poolvolumes) | set(pending))
+	poolsize = min_pool_size(needed) if actualpoolsize is not None and min_pool_size(needed) < actualpoolsize else 0
+	return (False, poolsize, "decreased")
+
+
+def pool_put(client, data, capacitypool, poolsize, action):
+	#----- create or resize the capacity pool and wait until it is "Succeeded" -----
+	api_url = client.pool_url(capacitypool)
+	body_raw = {
+		'location': data['location'],
+		'properties': {
+			'serviceLevel': data['sku'],
+			'size': poolsize
+		}
+	}
+	httpreturn = client.put(api_url, body_raw)
+
+	if (httpreturn.status_code == 200) or (httpreturn.status_code == 201):
+		#----- wait for the async operation (201) and the pool in provisioningState "Succeeded" -----
+		lro_status, returndata = client.wait(httpreturn, api_url)
+		if lro_status != "Succeeded":
+			return (True, False, {"capacity pool "+action+" "+lro_status+": "+json.dumps(returndata)})
+		return (False, True, {"capacity pool "+action})
+
+	return (True, False, {httpreturn.text})
+
+
+#----- fleet engine -----
+FLEET_KEYS = ("subscription_id", "resource_group", "accountname", "sku", "volname", "state")
+
+
+def fleet_run(data, choice_map, exclusive=()):
+	#----- runs the state function of every fleet item concurrently. returns (is_failed, has_changed, meta) like a
+	# single state function, the result of every item is stored in "fleet". items with a state in exclusive run one
+	# after the other per capacity pool, because they size the pool from what they read before -----
+	jobs = []
+	for item in data['fleet']:
+		job = dict(data)
+		job['fleet'] = None
+		job.update(item)
+		jobs.append(job)
+
+	import asyncio
+	started = time.time()
+	fleetresults = asyncio.run(fleet_gather(data, jobs, choice_map, exclusive))
+
+	client = arm_client(data)
+	client.results["fleet"] = fleetresults
+	client.results["fleet_seconds"] = round(time.time() - started, 3)
+
+	failed = [fleetresult for fleetresult in fleetresults if fleetresult["failed"]]
+	changed = [fleetresult for fleetresult in fleetresults if fleetresult["changed"]]
+	meta = {"fleet: "+str(len(fleetresults))+" items, "+str(len(changed))+" changed, "+str(len(failed))+" failed"}
+	return (len(failed) != 0, len(changed) != 0, meta)
+
+
+async def fleet_gather(data, jobs, choice_map, exclusive):
+	#----- blocking state functions run in a thread pool, asyncio limits them per subscription and overall -----
+	import asyncio
+	loop = asyncio.get_running_loop()
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, data['fleet_workers']))
+	semaphores = {}
+	poollocks = {}
+
+	async def run_one(item, job):
+		fleetresult = dict((key, job.get(key)) for key in FLEET_KEYS if job.get(key) is not None)
+		unknown = [key for key in item if key not in data]
+		if len(unknown) != 0:
+			fleetresult.update({"failed": True, "changed": False, "msg": ["unknown fleet parameter: "+", ".join(unknown)]})
+			return fleetresult
+		if job['state'] not in choice_map:
+			fleetresult.update({"failed": True, "changed": False, "msg": ["unsupported state: "+str(job['state'])]})
+			return fleetresult
+
+		poolkey = (job['subscription_id'], job['resource_group'], job['accountname'], job['sku'].lower())
+		poollock = poollocks.setdefault(poolkey, asyncio.Lock()) if job['state'] in exclusive else None
+		semaphore = semaphores.setdefault(job['subscription_id'], asyncio.Semaphore(max(1, data['fleet_subscription_limit'])))
+		if poollock is not None:
+			await poollock.acquire()
+		try:
+			async with semaphore:
+				is_failed, has_changed, meta = await loop.run_in_executor(executor, choice_map[job['state']], job)
+		except Exception as error:
+			is_failed, has_changed, meta = (True, False, {type(error).__name__+": "+str(error)})
+		finally:
+			if poollock is not None:
+				poollock.release()
+
+		fleetresult.update({"failed": is_failed, "changed": has_changed, "msg": list(meta) if isinstance(meta, set) else meta})
+		fleetresult.update(run_results(job))
+		return fleetresult
+
+	try:
+		return await asyncio.gather(*[run_one(item, job) for item, job in zip(data['fleet'], jobs)])
+	finally:
+		executor.shutdown(wait=False)
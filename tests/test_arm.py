@@ -0,0 +1,133 @@
+# plain function tests of the shared arm client in module_utils/anf_arm.py. no azure, no mock server: responses are
+# built in memory.
+#
+# python -m pytest -q tests
+
+import io
+import json
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#----- anf_arm is imported from ansible.module_utils, like ansible ships it -----
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(REPO_DIR, "module_utils"))
+
+import pytest
+import requests
+
+from ansible.module_utils import anf_arm
+
+QUERY = "api-version=2020-02-01"
+POOL_ID = "/subscriptions/s/resourceGroups/rg/providers/Microsoft.NetApp/netAppAccounts/acc/capacityPools/standard"
+
+
+def client_data():
+	return {'tenant': 't', 'subscription_id': 's', 'client_id': 'c', 'secret': 'x', 'resource_group': 'rg', 'accountname': 'acc', 'token_cache': False, 'etag_cache': False, 'rate_limit': False}
+
+
+def streamed(body):
+	#----- a 200 list page that was not read yet, like a GET with stream=True -----
+	httpreturn = requests.models.Response()
+	httpreturn.status_code = 200
+	httpreturn.raw = io.BytesIO(json.dumps(body).encode("utf-8"))
+	return httpreturn
+
+
+
+#######################################################################################################################################################################################################
+############################## LIST ###################################################################################################################################################################
+
+
+
+def test_streamed_list_items_are_served_again_from_the_snapshot():
+	pytest.importorskip("ijson")
+	client = anf_arm.ArmClient(client_data(), "2020-02-01")
+	volume = {"id": POOL_ID+"/volumes/vol1", "name": "acc/standard/vol1", "properties": {"usageThreshold": 107374182400, "throughputMibps": 12.5}}
+
+	items = list(client.pages(streamed({"value": [volume]}), QUERY))
+	assert items == [volume]
+	assert isinstance(items[0]["properties"]["throughputMibps"], float)
+
+	httpreturn = client.get(anf_arm.ARM_ENDPOINT+volume["id"]+"?"+QUERY)
+	assert httpreturn.status_code == 200
+	assert httpreturn.json() == volume
+	assert client.sent == 0
+
+
+def test_streamed_list_follows_next_link():
+	pytest.importorskip("ijson")
+	client = anf_arm.ArmClient(client_data(), "2020-02-01")
+	page = {}
+	items = list(client.items(streamed({"value": [{"name": "a"}, {"name": "b"}], "nextLink": "https://next"}), page))
+	assert [item["name"] for item in items] == ["a", "b"]
+	assert page["nextLink"] == "https://next"
+
+
+
+#######################################################################################################################################################################################################
+############################## REQUEST ################################################################################################################################################################
+
+
+
+class StubSession(object):
+	# answers the queued status codes in order and remembers the calls
+	def __init__(self, statuses):
+		self.statuses = list(statuses)
+		self.calls = []
+
+	def request(self, method, api_url, **kwargs):
+		self.calls.append(method)
+		httpreturn = requests.models.Response()
+		httpreturn.status_code = self.statuses.pop(0)
+		httpreturn.headers["Retry-After"] = "0"
+		httpreturn._content = b"{}"
+		httpreturn._content_consumed = True
+		return httpreturn
+
+
+class StubLimiter(object):
+	def __init__(self):
+		self.kinds = []
+
+	def acquire(self, ratekind):
+		self.kinds.append(ratekind)
+		return 0
+
+	def observe(self, ratekind, httpreturn):
+		pass
+
+	def throttled(self, delay):
+		pass
+
+
+def stub_client(statuses):
+	client = anf_arm.ArmClient(client_data(), "2020-02-01")
+	client.session = StubSession(statuses)
+	client.limiter = StubLimiter()
+	return client
+
+
+def test_reading_post_is_a_read_and_retried_on_503():
+	client = stub_client([503, 200])
+	httpreturn = client.request("POST", "https://metrics/getBatch", {"resourceids": []}, read=True)
+	assert httpreturn.status_code == 200
+	assert client.session.calls == ["POST", "POST"]
+	assert client.limiter.kinds == ["reads", "reads"]
+
+
+def test_writing_post_is_not_retried_on_503():
+	client = stub_client([503, 200])
+	httpreturn = client.request("POST", "https://arm/action", {})
+	assert httpreturn.status_code == 503
+	assert client.limiter.kinds == ["writes"]
+
+
+def test_spans_carry_the_retry_count_of_the_call():
+	client = stub_client([429, 429, 200])
+	client.trace = anf_arm.TimingTrace()
+	client.request("GET", anf_arm.ARM_ENDPOINT+POOL_ID+"?"+QUERY)
+	summary = client.trace.summary()
+	assert [span["retries"] for span in summary["spans"] if span["kind"] == "http"] == [0, 1, 2]
+	assert summary["totals"]["pool"]["retries"] == 2
+	assert summary["totals"]["pool"]["calls"] == 3
@@ -0,0 +1,220 @@
+# plain function tests of the sizing math of anf_volume and anf_volume_backup: pool sizes, watch decisions, growth
+# trend and forecast, right-sizing, the metrics cache and retention. no azure, no mock server.
+#
+# python -m pytest -q tests
+
+import os
+import sys
+import time
+import calendar
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+#----- the modules import anf_arm from ansible.module_utils, like ansible ships it -----
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(REPO_DIR, "module_utils"))
+
+import numpy
+import pytest
+
+import anf_volume
+import anf_volume_backup
+
+TIB = anf_volume.TIB
+GIB = anf_volume.GIB
+STEP = anf_volume.WATCH_STEP
+DAY = 86400
+
+WATCH = {"watch_cooldown": 3600, "watch_headroom": 30, "watch_grow_at": 80, "watch_shrink_at": 50}
+
+
+
+#######################################################################################################################################################################################################
+############################## POOL SIZES #############################################################################################################################################################
+
+
+
+def test_min_pool_size_is_whole_tib_min_4():
+	assert anf_volume.min_pool_size(0) == 4 * TIB
+	assert anf_volume.min_pool_size(4 * TIB) == 4 * TIB
+	assert anf_volume.min_pool_size(4 * TIB + 1) == 5 * TIB
+
+
+def test_pool_sizes_new_pool():
+	assert anf_volume.pool_sizes(None, {}, {"a": 3 * TIB}) == (4 * TIB, 0)
+	assert anf_volume.pool_sizes(None, {}, {"a": 3 * TIB, "b": int(2.5 * TIB)}) == (6 * TIB, 0)
+
+
+def test_pool_sizes_grows_by_whole_tib():
+	assert anf_volume.pool_sizes(4 * TIB, {"a": 3 * TIB}, {"b": int(1.5 * TIB)}) == (5 * TIB, 0)
+
+
+def test_pool_sizes_no_change_when_it_fits():
+	assert anf_volume.pool_sizes(4 * TIB, {"a": 3 * TIB}, {"b": TIB}) == (0, 0)
+	assert anf_volume.pool_sizes(4 * TIB, {"a": 3 * TIB}, {"a": 3 * TIB}) == (0, 0)
+
+
+def test_pool_sizes_shrinks_not_below_4_tib():
+	assert anf_volume.pool_sizes(5 * TIB, {"a": 4 * TIB}, {"a": 2 * TIB}) == (0, 4 * TIB)
+	assert anf_volume.pool_sizes(4 * TIB, {"a": 3 * TIB}, {"a": TIB}) == (0, 0)
+
+
+def test_pool_sizes_shrinks_by_whole_free_tib_only():
+	assert anf_volume.pool_sizes(6 * TIB, {"a": 5 * TIB}, {"a": int(4.5 * TIB)}) == (0, 5 * TIB)
+	assert anf_volume.pool_sizes(6 * TIB, {"a": 5 * TIB}, {"a": int(4.5 * TIB), "b": TIB}) == (0, 0)
+
+
+
+#######################################################################################################################################################################################################
+############################## WATCH ##################################################################################################################################################################
+
+
+
+def test_watch_decision_grows_above_threshold():
+	assert anf_volume.watch_decision(WATCH, 10 * STEP, 9 * STEP, False, 0, time.time()) == ("grow", 12 * STEP)
+
+
+def test_watch_decision_shrinks_in_quiet_hours_only():
+	assert anf_volume.watch_decision(WATCH, 10 * STEP, 3 * STEP, True, 0, time.time()) == ("shrink", 4 * STEP)
+	assert anf_volume.watch_decision(WATCH, 10 * STEP, 3 * STEP, False, 0, time.time()) == (None, 10 * STEP)
+
+
+def test_watch_decision_rests_after_resize():
+	now = time.time()
+	assert anf_volume.watch_decision(WATCH, 10 * STEP, 9 * STEP, False, now - 10, now) == (None, 10 * STEP)
+
+
+def test_watch_decision_between_thresholds():
+	assert anf_volume.watch_decision(WATCH, 10 * STEP, 6 * STEP, True, 0, time.time()) == (None, 10 * STEP)
+
+
+
+#######################################################################################################################################################################################################
+############################## FORECAST ###############################################################################################################################################################
+
+
+
+def test_interval_seconds():
+	assert anf_volume.interval_seconds("PT5M") == 300
+	assert anf_volume.interval_seconds("PT1H") == 3600
+	assert anf_volume.interval_seconds("P1D") == DAY
+	assert anf_volume.interval_seconds("1h") is None
+
+
+def test_growth_trend_linear_series():
+	usage = numpy.array([[100.0 + 5 * i for i in range(10)]])
+	for method in ("linear", "robust"):
+		now, slope = anf_volume.growth_trend(usage, DAY, method)
+		assert now[0] == pytest.approx(145.0)
+		assert slope[0] == pytest.approx(5.0)
+
+
+def test_growth_trend_hourly_steps_are_per_day():
+	usage = numpy.array([[float(i) for i in range(48)]])
+	now, slope = anf_volume.growth_trend(usage, 3600, "linear")
+	assert slope[0] == pytest.approx(24.0)
+
+
+def test_growth_trend_robust_ignores_spike():
+	series = [100.0 + 5 * i for i in range(20)]
+	series[10] = 5000.0
+	usage = numpy.array([series])
+	now, slope = anf_volume.growth_trend(usage, DAY, "robust")
+	assert slope[0] == pytest.approx(5.0, abs=0.5)
+	now, slope = anf_volume.growth_trend(usage, DAY, "linear")
+	assert abs(slope[0] - 5.0) > 2.0
+
+
+def test_growth_trend_gaps_and_empty_rows():
+	usage = numpy.array([[100.0, numpy.nan, 120.0, 130.0], [numpy.nan] * 4])
+	now, slope = anf_volume.growth_trend(usage, DAY, "robust")
+	assert slope[0] == pytest.approx(10.0)
+	assert slope[1] == 0.0
+
+
+def test_forecast_grows_volume_running_out():
+	#----- 2 GiB a day from 50 GiB: 70 GiB now, 130 GiB in 30 days, plus 10% headroom -> 200 gb -----
+	history = [(50 + 2 * i) * GIB for i in range(11)]
+	volumerows, poolrows = anf_volume.forecast(["a"], ["standard"], [anf_volume.volsize_raw(100)], {"standard": 4 * TIB}, [history], DAY, 30, 10, "linear")
+	assert volumerows[0]["recommended_gb"] == 200
+	assert volumerows[0]["grow"] is True
+	assert volumerows[0]["days_until_full"] == pytest.approx(14.5)
+	assert poolrows[0]["recommended_size"] == 4 * TIB
+	assert poolrows[0]["volumes"] == [{"volname": "a", "volsize": 200}]
+
+
+def test_forecast_keeps_flat_and_unknown_volumes():
+	flat = [40 * GIB] * 10
+	volumerows, poolrows = anf_volume.forecast(["a", "b"], ["standard", "standard"], [anf_volume.volsize_raw(100)] * 2, {"standard": 4 * TIB}, [flat, []], DAY, 30, 10, "robust")
+	assert [row["grow"] for row in volumerows] == [False, False]
+	assert volumerows[0]["days_until_full"] is None
+	assert volumerows[1]["metrics"] is False
+	assert poolrows[0]["volumes"] == []
+
+
+def test_forecast_pool_grows_in_whole_tib():
+	#----- 3200 GiB now, 3800 GiB in 30 days, plus 10% -> 4200 gb, more than the 4 TiB pool -----
+	history = [(3000 + 20 * i) * GIB for i in range(11)]
+	volumerows, poolrows = anf_volume.forecast(["a"], ["standard"], [anf_volume.volsize_raw(3300)], {"standard": 4 * TIB}, [history], DAY, 30, 10, "linear")
+	assert volumerows[0]["recommended_gb"] == 4200
+	assert poolrows[0]["recommended_size"] == 5 * TIB
+
+
+
+#######################################################################################################################################################################################################
+############################## REPORT #################################################################################################################################################################
+
+
+
+def test_rightsizing_recommends_peak_plus_headroom():
+	histories = [[100 * GIB, 200 * GIB, 300 * GIB], []]
+	volumerows, poolrows = anf_volume.rightsizing(["a", "b"], ["standard", "standard"], [anf_volume.volsize_raw(500)] * 2, histories, 10)
+	assert volumerows[0]["p50_bytes"] == 200 * GIB
+	assert volumerows[0]["max_bytes"] == 300 * GIB
+	assert volumerows[0]["recommended_gb"] == 400
+	assert volumerows[1]["recommended_gb"] == 500
+	assert volumerows[1]["metrics"] is False
+	assert poolrows[0]["recommended_size"] == 4 * TIB
+
+
+
+#######################################################################################################################################################################################################
+############################## METRICS CACHE ##########################################################################################################################################################
+
+
+
+def test_metrics_cache_per_cache_dir_and_ttl(tmp_path):
+	first = anf_volume.metrics_cache({"cache_dir": str(tmp_path / "a"), "metrics_cache_ttl": 300})
+	assert anf_volume.metrics_cache({"cache_dir": str(tmp_path / "a"), "metrics_cache_ttl": 300}) is first
+	assert anf_volume.metrics_cache({"cache_dir": str(tmp_path / "b"), "metrics_cache_ttl": 300}) is not first
+	off = anf_volume.metrics_cache({"cache_dir": str(tmp_path / "a"), "metrics_cache_ttl": 0})
+	assert off is not first
+	assert off.ttl == 0
+
+
+
+#######################################################################################################################################################################################################
+############################## RETENTION ##############################################################################################################################################################
+
+
+
+def snapshot_item(name, age_days, now):
+	created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - age_days * DAY))
+	return {"name": "acc/pool/vol/"+name, "properties": {"created": created}}
+
+
+def test_retention_expired_oldest_first():
+	now = calendar.timegm(time.strptime("2024-06-01T12:00:00", "%Y-%m-%dT%H:%M:%S"))
+	items = [snapshot_item("s%d" % age, age, now) for age in (1, 10, 3, 8, 30)]
+	expired, kept = anf_volume_backup.retention_expired(items, 7, now)
+	assert [item["name"].split('/')[-1] for item in expired] == ["s30", "s10", "s8"]
+	assert kept == 2
+
+
+def test_retention_expired_skips_undated():
+	now = time.time()
+	items = [snapshot_item("old", 30, now), {"name": "acc/pool/vol/undated", "properties": {}}]
+	expired, kept = anf_volume_backup.retention_expired(items, 7, now)
+	assert [item["name"] for item in expired] == ["acc/pool/vol/old"]
+	assert kept == 0